@@ -25,11 +25,12 @@ articles database table.
 from __future__ import unicode_literals, print_function, absolute_import
 
 from amcat.tools.model import AmcatModel, PostgresNativeUUIDField
-from amcat.tools import amcates
+from amcat.tools import amcates, minhash
 from amcat.models.authorisation import Role
 from amcat.models.medium import Medium
 
-from django.db import models, transaction
+from django.db import models, transaction, connection
+from django.db.models import sql
 from django.db.utils import IntegrityError, DatabaseError
 from django.core.exceptions import ValidationError
 
@@ -38,6 +39,10 @@ import logging;
 log = logging.getLogger(__name__)
 
 import re
+import time
+
+# Number of articles per multi-row insert in Article.create_articles
+INSERT_BATCH_SIZE = 1000
 
 WORD_RE = re.compile('[{L}{N}]+') # {L} --> All (unicode) letters
                                   # {N} --> All numbers
@@ -148,6 +153,7 @@ class Article(AmcatModel):
         """
         # TODO: test parent logic (esp. together with hash/dupes)
         es = amcates.ES()
+        start = time.time()
 
         # add dict (+hash) as property on articles so we know who is who
         sets = [articleset.id] if articleset else None
@@ -155,9 +161,7 @@ class Article(AmcatModel):
             a.es_dict = amcates.get_article_dict(a, sets=sets)
 
         if check_duplicate:
-            hashes = [a.es_dict['hash'] for a in articles]
-            results =es.query(filters={'hashes' : hashes}, fields=["hash", "sets"], score=False)
-            dupes = {r.hash : r for r in results}
+            dupes = es.lookup_hashes(a.es_dict['hash'] for a in articles)
         else:
             dupes = {}
 
@@ -167,32 +171,40 @@ class Article(AmcatModel):
         add_to_index = [] # es_dicts to add to index
         result = [] # return result
         errors = [] # return errors
-        for a in articles:
-            dupe = dupes.get(a.es_dict['hash'], None)
-            if dupe:
-                a.duplicate_of = dupe.id
-                if articleset and not (dupe.sets and articleset.id in dupe.sets):
-                    add_to_set.add(dupe.id)
-            else:
-                if a.parent:
-                    a.parent_id = a.parent.duplicate_of if hasattr(a.parent, 'duplicate_of') else a.parent.id
-                sid = transaction.savepoint()
-                try:
-                    sid = transaction.savepoint()
-                    a.save()
-                    transaction.savepoint_commit(sid)
-                except (IntegrityError, ValidationError, DatabaseError) as e:
-                    log.warning(str(e))
-                    transaction.savepoint_rollback(sid)
-                    errors.append(e)
-                    continue
+
+        def flush(batch):
+            saved, failed = cls._insert_articles(batch)
+            errors.extend(failed)
+            for a in saved:
                 result.append(a)
                 a.es_dict['id'] = a.pk
                 add_to_index.append(a.es_dict)
                 add_new_to_set.add(a.pk)
-
-        log.info("Considered {} articles: {} saved to db, {} new to add to index, {} duplicates to add to set"
-                 .format(len(articles), len(add_new_to_set), len(add_to_index), len(add_to_set)))
+            del batch[:]
+
+        batch = []
+        with transaction.atomic():
+            for a in articles:
+                dupe = dupes.get(a.es_dict['hash'], None)
+                if dupe:
+                    a.duplicate_of = dupe.id
+                    if articleset and not (dupe.sets and articleset.id in dupe.sets):
+                        add_to_set.add(dupe.id)
+                else:
+                    if a.parent:
+                        if a.parent.pk is None and not hasattr(a.parent, 'duplicate_of'):
+                            flush(batch) # the parent may be in this batch, and it needs an id first
+                        a.parent_id = a.parent.duplicate_of if hasattr(a.parent, 'duplicate_of') else a.parent.id
+                    batch.append(a)
+                    if len(batch) >= INSERT_BATCH_SIZE:
+                        flush(batch)
+            flush(batch)
+
+        duration = time.time() - start
+        rate = len(articles) / duration if duration else 0
+        log.info("Considered {} articles: {} saved to db, {} new to add to index, {} duplicates to add to set "
+                 "({:.0f} articles/sec)"
+                 .format(len(articles), len(add_new_to_set), len(add_to_index), len(add_to_set), rate))
 
         # add to index
         if add_to_index:
@@ -205,6 +217,50 @@ class Article(AmcatModel):
 
         return result, errors
 
+    @classmethod
+    def _insert_articles(cls, articles):
+        """
+        Insert the given articles into the database. On postgres, a single multi-row
+        insert is used; if that fails (or on other databases) the articles are saved
+        one by one, each in its own savepoint so failing articles can be skipped.
+        @return: a pair of the saved articles and a list of errors
+        """
+        if not articles:
+            return [], []
+        for a in articles:
+            if a.length is None:
+                a.length = word_len(a.text) + word_len(a.headline) + word_len(a.byline)
+
+        if connection.vendor == "postgresql":
+            try:
+                with transaction.atomic():
+                    query = sql.InsertQuery(cls)
+                    query.insert_values([f for f in cls._meta.local_fields if f is not cls._meta.pk], articles)
+                    raw_sql, params = query.sql_with_params()[0]
+                    cursor = connection.cursor()
+                    cursor.execute("%s RETURNING article_id" % raw_sql, params)
+                    ids = [row[0] for row in cursor.fetchall()]
+            except (IntegrityError, ValidationError, DatabaseError) as e:
+                log.warning("Multi-row insert of {} articles failed, saving one by one: {}".format(len(articles), e))
+            else:
+                for a, aid in zip(articles, ids):
+                    a.id = aid
+                    a._state.adding = False
+                    a._state.db = connection.alias
+                return list(articles), []
+
+        saved, errors = [], []
+        for a in articles:
+            try:
+                with transaction.atomic():
+                    a.save()
+            except (IntegrityError, ValidationError, DatabaseError) as e:
+                log.warning(str(e))
+                errors.append(e)
+            else:
+                saved.append(a)
+        return saved, errors
+
     @classmethod
     def ordered_save(cls, articles, *args, **kwargs):
         """Figures out parent-child relationships, saves parent first
@@ -224,6 +280,26 @@ class Article(AmcatModel):
 
 
 
+class ArticleSignature(AmcatModel):
+    """
+    MinHash signature of the text of an article, used to find near-duplicates
+    (see amcat.tools.minhash). Signatures with an older version are recomputed.
+    """
+    article = models.OneToOneField(Article, primary_key=True, db_column="article_id",
+                                   related_name="signature")
+    signature = models.BinaryField()
+    version = models.IntegerField()
+
+    class Meta():
+        db_table = 'articles_signatures'
+        app_label = 'amcat'
+
+    def get_signature(self):
+        """Return the signature as an array of integers"""
+        return minhash.from_bytes(self.signature)
+
+
+
 ###########################################################################
 #                          U N I T   T E S T S                            #
 ###########################################################################
@@ -284,6 +360,42 @@ class TestArticle(amcattest.AmCATTestCase):
         self.assertIn(a4.id, q(mediumid=art['medium']))
 
 
+    @amcattest.use_elastic
+    def test_deduplication_many(self):
+        """Are duplicates found and new articles inserted beyond a single page/batch?"""
+        import amcat.models.article
+        m, p, s = amcattest.create_test_medium(), amcattest.create_test_project(), amcattest.create_test_set()
+        def create(n):
+            return [Article(headline="test {}".format(i), text="text {}".format(i), date='2001-01-01',
+                            medium=m, project=p) for i in range(n)]
+
+        old_size = amcat.models.article.INSERT_BATCH_SIZE
+        amcat.models.article.INSERT_BATCH_SIZE = 7
+        try:
+            articles, errors = Article.create_articles(create(25), articleset=s)
+            self.assertEqual(len(articles), 25)
+            self.assertEqual(errors, [])
+            ids = {a.id for a in articles}
+            self.assertEqual(len(ids), 25)
+            self.assertEqual(ids, set(Article.objects.filter(pk__in=ids).values_list("id", flat=True)))
+            self.assertEqual(set(s.get_article_ids()), ids)
+            self.assertEqual(Article.objects.get(pk=articles[0].id).length, 4)
+
+            # all 25 duplicates should be found, not just the first page of results
+            amcates.ES().flush()
+            dupes = create(25)
+            articles, errors = Article.create_articles(dupes)
+            self.assertEqual(articles, [])
+            self.assertEqual({a.duplicate_of for a in dupes}, ids)
+
+            # a child can be in the same batch as its parent
+            parent, child = create(27)[25:]
+            child.parent = parent
+            articles, errors = Article.create_articles([parent, child])
+            self.assertEqual(Article.objects.get(pk=child.id).parent_id, parent.id)
+        finally:
+            amcat.models.article.INSERT_BATCH_SIZE = old_size
+
     def test_unicode_word_len(self):
         """Does the word counter eat unicode??"""
         u = u'Kim says: \u07c4\u07d0\u07f0\u07cb\u07f9'
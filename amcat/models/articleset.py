@@ -91,6 +91,7 @@ class ArticleSet(AmcatModel):
         ArticleSetArticle.objects.bulk_create(
             [ArticleSetArticle(articleset=self, article_id=artid) for artid in to_add]
         )
+        ArticleSetChange.record(self, to_add, added=True)
         monitor.update(20, "{n} articles added in database, adding to index".format(n=len(to_add)))
                 
         if add_to_index:
@@ -105,10 +106,11 @@ class ArticleSet(AmcatModel):
         Add the given articles to this article set
         If refresh or deduplicate are True, schedule a new celery task to do this
         """
-        ArticleSetArticle.objects.filter(articleset=self, article__in=articles).delete()
-        
+        to_remove = {(art if type(art) is int else art.id) for art in articles}
+        ArticleSetArticle.objects.filter(articleset=self, article__in=to_remove).delete()
+        ArticleSetChange.record(self, to_remove, added=False)
+
         if remove_from_index:
-            to_remove = {(art if type(art) is int else art.id) for art in articles}
             amcates.ES().remove_from_set(self.id, to_remove)
 
     def get_article_ids(self, use_elastic=False):
@@ -135,15 +137,18 @@ class ArticleSet(AmcatModel):
 
         @rtype: set
         """
-        return set(ES().query_ids(filters={"sets" : [self.id]}))
+        return set(ES().query_ids(filters={"sets" : [self.id]}, slices=None))
 
-    def refresh_index(self, full_refresh=False):
+    def refresh_index(self, full_refresh=False, repair=False):
         """
         Make sure that the index for this set is up to date
+
+        By default, only the membership changes since the last refresh are
+        applied. Use repair=True to compare the whole set with the index.
         """
         from amcat.tools.amcates import ES
         ES().check_index()
-        ES().synchronize_articleset(self, full_refresh=full_refresh)
+        ES().synchronize_articleset(self, full_refresh=full_refresh, repair=repair)
         self.save()
 
     def save(self, *args, **kargs):
@@ -177,6 +182,57 @@ class ArticleSet(AmcatModel):
 # Legacy
 ArticleSetArticle = ArticleSet.articles.through
 
+
+class ArticleSetChange(AmcatModel):
+    """
+    Journal of membership changes of article sets. Every article added to or
+    removed from a set is recorded here, so the index can be synchronised by
+    replaying the changes rather than comparing the full set. Changes are
+    deleted once they have been replayed (see ES.synchronize_articleset).
+    """
+    id = models.AutoField(primary_key=True, db_column='change_id')
+
+    articleset = models.ForeignKey(ArticleSet, related_name='changes')
+    article_id = models.IntegerField()
+    added = models.BooleanField(default=True) # False means removed
+
+    class Meta():
+        app_label = 'amcat'
+        db_table = 'articlesets_changes'
+
+    @classmethod
+    def record(cls, articleset, article_ids, added=True):
+        """Record that the given article ids were added to (or removed from) the set"""
+        cls.objects.bulk_create([cls(articleset=articleset, article_id=aid, added=added)
+                                 for aid in article_ids])
+
+    @classmethod
+    def get_checkpoint(cls, articleset):
+        """
+        Return the id of the last recorded change for this set, or None if there
+        are no pending changes
+        """
+        return cls.objects.filter(articleset=articleset).aggregate(m=models.Max('id'))['m']
+
+    @classmethod
+    def get_changes(cls, articleset, checkpoint):
+        """
+        Return the net effect of the changes up to and including checkpoint as
+        two sets (added_ids, removed_ids)
+        """
+        added, removed = set(), set()
+        changes = (cls.objects.filter(articleset=articleset, id__lte=checkpoint)
+                   .order_by("id").values_list("article_id", "added"))
+        for aid, is_added in changes:
+            (added if is_added else removed).add(aid)
+            (removed if is_added else added).discard(aid)
+        return added, removed
+
+    @classmethod
+    def clear(cls, articleset, checkpoint):
+        """Remove the changes up to and including checkpoint from the journal"""
+        cls.objects.filter(articleset=articleset, id__lte=checkpoint).delete()
+
 ###########################################################################
 #                          U N I T   T E S T S                            #
 ###########################################################################
@@ -210,6 +266,26 @@ class TestArticleSet(amcattest.AmCATTestCase):
         self.assertEqual(set(s.get_mediums()), {a.medium for a in arts})
 
 
+    def test_changes(self):
+        """Are membership changes recorded in the journal?"""
+        s = amcattest.create_test_set()
+        a, b, c = [amcattest.create_test_article() for _x in range(3)]
+        ArticleSetChange.clear(s, ArticleSetChange.get_checkpoint(s))
+        self.assertIsNone(ArticleSetChange.get_checkpoint(s))
+
+        s.add_articles([a, b], add_to_index=False)
+        s.remove_articles([b], remove_from_index=False)
+        s.add_articles([c], add_to_index=False)
+        s.remove_articles([c], remove_from_index=False)
+        checkpoint = ArticleSetChange.get_checkpoint(s)
+        self.assertEqual(ArticleSetChange.get_changes(s, checkpoint), ({a.id}, {b.id, c.id}))
+
+        # changes after the checkpoint should be kept when clearing
+        s.add_articles([b], add_to_index=False)
+        ArticleSetChange.clear(s, checkpoint)
+        self.assertEqual(ArticleSetChange.get_changes(s, ArticleSetChange.get_checkpoint(s)),
+                         ({b.id}, set()))
+
     @amcattest.use_elastic
     def test_get_mediums(self):
         from django.core.cache import cache
@@ -20,18 +20,28 @@ import collections
 from functools import partial
 
 from django.db import models, transaction, connection, IntegrityError
+from django.db.models import F
 
 import logging
 from django.db.models import sql
 import itertools
+import time
 from amcat.models.coding.codingschemafield import CodingSchemaField
 from amcat.models.coding.coding import CodingValue, Coding
 from amcat.tools.model import AmcatModel
+from amcat.tools.progress import NullMonitor
+from amcat.tools.toolkit import splitlist
 
 log = logging.getLogger(__name__)
 
+# Number of coded articles whose codings are replaced per batch in bulk_replace_codings
+REPLACE_BATCH_SIZE = 1000
+
 STATUS_NOTSTARTED, STATUS_INPROGRESS, STATUS_COMPLETE, STATUS_IRRELEVANT = 0, 1, 2, 9
 
+class VersionConflict(Exception):
+    """Raised if a coded article was changed since the version a coder started from"""
+
 class CodedArticleStatus(AmcatModel):
     id = models.IntegerField(primary_key=True, db_column='status_id')
     label = models.CharField(max_length=50)
@@ -77,6 +87,118 @@ def _to_codingvalues(coding, values):
     return map(partial(_to_codingvalue, coding), values)
 
 
+def get_field_ids(codingjob_ids):
+    """
+    Get the ids of the schema fields that can be coded in the given codingjobs
+    @return: a dict of {codingjob_id : set of field ids}, which also contain None (see replace_codings)
+    """
+    from amcat.models.coding.codingjob import CodingJob
+    jobs = CodingJob.objects.filter(pk__in=codingjob_ids).values_list("id", "unitschema_id", "articleschema_id")
+    schema_fields = collections.defaultdict(set)
+    schemas = {schema_id for (_, unitschema_id, articleschema_id) in jobs for schema_id in (unitschema_id, articleschema_id)}
+    for schema_id, field_id in (CodingSchemaField.objects.filter(codingschema__id__in=schemas)
+                                .values_list("codingschema_id", "id")):
+        schema_fields[schema_id].add(field_id)
+    return {job_id : schema_fields[unitschema_id] | schema_fields[articleschema_id] | {None}
+            for (job_id, unitschema_id, articleschema_id) in jobs}
+
+def _validate_values(values, field_ids):
+    """
+    Check the given codingvalue dictionaries (see replace_codings)
+    @param field_ids: the ids of the schema fields that can be coded
+    """
+    for v in values:
+        intval, strval = v.get("intval"), v.get("strval")
+        if intval is None and strval is None:
+            raise ValueError("intval and strval cannot both be None")
+        if intval is not None and strval is not None:
+            raise ValueError("intval and strval cannot both be not None")
+        if v.get("codingschemafield_id") not in field_ids:
+            raise ValueError("codingschemafield_id must be in codingjob")
+
+def _get_coding_key(sentence_id, start, end):
+    return sentence_id, start, end
+
+def _get_values_key(values):
+    """Return a hashable representation of the given (field_id, intval, strval) tuples"""
+    return tuple(sorted(values))
+
+def _get_coding_delta(old_codings, new_codings):
+    """
+    Compute which codings and values should be deleted and inserted to change the old
+    codings into the new codings. Old codings with exactly the same values as a new coding
+    are kept. Other old codings are paired with a new coding on the same sentence (and
+    start/end), which keeps the values that did not change.
+
+    @param old_codings: a sequence of (coding_id, key, {value_id : (field_id, intval, strval)}) tuples
+    @param new_codings: a sequence of (key, [(field_id, intval, strval)]) tuples, where key is
+                        given by _get_coding_key
+    @return: a tuple (coding ids to delete, value ids to delete, [(coding_id, value)] to add,
+             [(key, [value])] codings to create)
+    """
+    unchanged = collections.defaultdict(list) # (key, values) : [coding_id, ..]
+    old_values = {} # coding_id : {value_id : value}
+    for coding_id, key, values in old_codings:
+        unchanged[key, _get_values_key(values.values())].append(coding_id)
+        old_values[coding_id] = values
+
+    # keep codings that did not change
+    changed = []
+    for key, values in new_codings:
+        existing = unchanged.get((key, _get_values_key(values)))
+        if existing:
+            old_values.pop(existing.pop(0))
+        else:
+            changed.append((key, values))
+
+    # pair the remaining codings on their key, and compare their values
+    remaining = collections.defaultdict(list) # key : [coding_id, ..]
+    for coding_id, key, _ in old_codings:
+        if coding_id in old_values:
+            remaining[key].append(coding_id)
+
+    delete_values, add_values, create_codings = [], [], []
+    for key, values in changed:
+        if not remaining[key]:
+            create_codings.append((key, values))
+            continue
+        coding_id = remaining[key].pop(0)
+        existing = collections.defaultdict(list) # value : [value_id, ..]
+        for value_id, value in old_values.pop(coding_id).iteritems():
+            existing[value].append(value_id)
+        for value in values:
+            if existing[value]:
+                existing[value].pop(0)
+            else:
+                add_values.append((coding_id, value))
+        delete_values += [value_id for value_ids in existing.itervalues() for value_id in value_ids]
+
+    delete_codings = old_values.keys()
+    delete_values += [value_id for values in old_values.itervalues() for value_id in values]
+    return delete_codings, delete_values, add_values, create_codings
+
+def _insert_codings(codings):
+    """
+    Insert the given (unsaved) Coding objects
+    @return: a list of the saved codings, in the same order
+    """
+    if not codings:
+        return []
+
+    # Saving each coding is pretty inefficient, but Django doesn't allow retrieving
+    # id's when using bulk_create. See Django ticket #19527.
+    if connection.vendor == "postgresql":
+        query = sql.InsertQuery(Coding)
+        query.insert_values(Coding._meta.fields[1:], codings)
+        raw_sql, params = query.sql_with_params()[0]
+        return list(Coding.objects.raw("%s %s" % (raw_sql, "RETURNING coding_id"), params))
+
+    # Do naive O(n) approach
+    for coding in codings:
+        coding.save()
+    return codings
+
+
 class CodedArticle(models.Model):
     """
     A CodedArticle is an article in a context of two other objects: a codingjob and an
@@ -90,6 +212,9 @@ class CodedArticle(models.Model):
     article = models.ForeignKey("amcat.Article", related_name="coded_articles")
     codingjob = models.ForeignKey("amcat.CodingJob", related_name="coded_articles")
 
+    # Increased on every save from the annotator, used to detect conflicting saves (see update_status)
+    version = models.IntegerField(default=0)
+
     def __unicode__(self):
         return "Article: {self.article}, Codingjob: {self.codingjob}".format(**locals())
 
@@ -119,19 +244,7 @@ class CodedArticle(models.Model):
         CodingValue.objects.filter(coding__coded_article=self).delete()
         Coding.objects.filter(coded_article=self).delete()
 
-        new_coding_objects = map(partial(_to_coding, self), new_codings)
-
-        # Saving each coding is pretty inefficient, but Django doesn't allow retrieving
-        # id's when using bulk_create. See Django ticket #19527.
-        if connection.vendor == "postgresql":
-            query = sql.InsertQuery(Coding)
-            query.insert_values(Coding._meta.fields[1:], new_coding_objects)
-            raw_sql, params = query.sql_with_params()[0]
-            new_coding_objects = Coding.objects.raw("%s %s" % (raw_sql, "RETURNING coding_id"), params)
-        else:
-            # Do naive O(n) approach
-            for coding in new_coding_objects:
-                coding.save()
+        new_coding_objects = _insert_codings(map(partial(_to_coding, self), new_codings))
 
         coding_values = itertools.chain.from_iterable(
             _to_codingvalues(co, c["values"]) for c, co in itertools.izip(new_codings, new_coding_objects)
@@ -166,23 +279,130 @@ class CodedArticle(models.Model):
         @returns: ([Coding], [CodingValue])
         """
         coding_dicts = tuple(coding_dicts)
+        field_ids = get_field_ids([self.codingjob_id])[self.codingjob_id]
+        _validate_values(itertools.chain.from_iterable(cd["values"] for cd in coding_dicts), field_ids)
 
-        values = tuple(itertools.chain.from_iterable(cd["values"] for cd in coding_dicts))
-        if any(v.get("intval") == v.get("strval") == None for v in values):
-            raise ValueError("intval and strval cannot both be None")
+        with transaction.atomic():
+            return self._replace_codings(coding_dicts)
 
-        if any(v.get("intval") is not None and v.get("strval") is not None for v in values):
-            raise ValueError("intval and strval cannot both be not None")
+    def update_status(self, status_id, comments, version=None):
+        """
+        Set the status and comments of this coded article and increase its version.
 
-        schemas = (self.codingjob.unitschema_id, self.codingjob.articleschema_id)
-        fields = CodingSchemaField.objects.filter(codingschema__id__in=schemas)
-        field_ids = set(fields.values_list("id", flat=True)) | {None}
+        @param version: the version the changes are based on. If given and the coded article
+                        has been changed since (ie it has a different version), nothing is
+                        changed and VersionConflict is raised.
+        @return: the new version
+        """
+        query = CodedArticle.objects.filter(pk=self.pk)
+        if version is not None:
+            query = query.filter(version=version)
+        if not query.update(status=status_id, comments=comments, version=F("version") + 1):
+            raise VersionConflict("Coded article {self.id} was changed since version {version}".format(**locals()))
+
+        self.status_id, self.comments = status_id, comments
+        if version is None:
+            self.version = CodedArticle.objects.filter(pk=self.pk).values_list("version", flat=True)[0]
+        else:
+            self.version = version + 1
+        return self.version
+
+    def _update_codings(self, new_codings):
+        old_values = collections.defaultdict(dict)
+        for value_id, coding_id, field_id, intval, strval in (
+                CodingValue.objects.filter(coding__coded_article=self)
+                .values_list("id", "coding_id", "field_id", "intval", "strval")):
+            old_values[coding_id][value_id] = (field_id, intval, strval)
+        old_codings = [(coding_id, _get_coding_key(sentence_id, start, end), old_values[coding_id])
+                       for (coding_id, sentence_id, start, end) in
+                       Coding.objects.filter(coded_article=self).values_list("id", "sentence_id", "start", "end")]
+
+        new_codings = [(_get_coding_key(c.get("sentence_id"), c.get("start"), c.get("end")),
+                        [(v.get("codingschemafield_id"), v.get("intval"), v.get("strval")) for v in c["values"]])
+                       for c in new_codings]
+
+        delete_codings, delete_values, add_values, create_codings = _get_coding_delta(old_codings, new_codings)
+
+        if delete_values:
+            CodingValue.objects.filter(id__in=delete_values).delete()
+        if delete_codings:
+            Coding.objects.filter(id__in=delete_codings).delete()
+
+        created = _insert_codings([Coding(coded_article=self, sentence_id=sentence_id, start=start, end=end)
+                                   for ((sentence_id, start, end), _) in create_codings])
+        add_values += [(coding.id, value) for (coding, (_, values)) in zip(created, create_codings)
+                       for value in values]
+        if add_values:
+            CodingValue.objects.bulk_create(
+                CodingValue(coding_id=coding_id, field_id=field_id, intval=intval, strval=strval)
+                for (coding_id, (field_id, intval, strval)) in add_values)
+
+        return len(created) + len(add_values), len(delete_codings) + len(delete_values)
+
+    def update_codings(self, coding_dicts, field_ids=None):
+        """
+        Change the codings of this coded article into the given codings, like replace_codings.
+        Instead of replacing all codings, only the codings and values that changed are
+        deleted and inserted.
+
+        @param coding_dicts: the codings, see replace_codings for the format
+        @param field_ids: the ids of the schema fields that can be coded in the codingjob (see
+                          get_field_ids), if they are known already
+        @raises: see replace_codings
+        @returns: a tuple (number of rows inserted, number of rows deleted) of codings and values
+        """
+        coding_dicts = tuple(coding_dicts)
+        if field_ids is None:
+            field_ids = get_field_ids([self.codingjob_id])[self.codingjob_id]
+        _validate_values(itertools.chain.from_iterable(cd["values"] for cd in coding_dicts), field_ids)
 
-        if any(v.get("codingschemafield_id") not in field_ids for v in values):
-            raise ValueError("codingschemafield_id must be in codingjob")
+        with transaction.atomic():
+            return self._update_codings(coding_dicts)
 
+    @classmethod
+    def bulk_replace_codings(cls, codings, batch_size=REPLACE_BATCH_SIZE, monitor=NullMonitor()):
+        """
+        Replace the codings of many coded articles in one transaction. The input is
+        validated before anything is changed, after which the codings are replaced in
+        batches of batch_size coded articles, using a fixed number of queries per batch.
+
+        @param codings: a sequence of (coded_article, [coding_dict]) pairs, with every coded
+                        article occurring once. See replace_codings for the coding_dict format.
+        @raises: see replace_codings
+        @returns: a tuple (number of codings, number of codingvalues) created
+        """
+        codings = [(ca, tuple(coding_dicts)) for (ca, coding_dicts) in codings]
+        if not codings:
+            return 0, 0
+
+        field_ids = get_field_ids({ca.codingjob_id for (ca, _) in codings})
+        for ca, coding_dicts in codings:
+            _validate_values(itertools.chain.from_iterable(cd["values"] for cd in coding_dicts),
+                             field_ids[ca.codingjob_id])
+
+        n, ncodings, nvalues, start = len(codings), 0, 0, time.time()
+        nbatches = (n - 1) // batch_size + 1
         with transaction.atomic():
-            return self._replace_codings(coding_dicts)
+            for i, batch in enumerate(splitlist(codings, itemsperbatch=batch_size)):
+                ids = [ca.id for (ca, _) in batch]
+                CodingValue.objects.filter(coding__coded_article__id__in=ids).delete()
+                Coding.objects.filter(coded_article__id__in=ids).delete()
+
+                coding_dicts = [cd for (_, cds) in batch for cd in cds]
+                coding_objects = _insert_codings([_to_coding(ca, cd) for (ca, cds) in batch for cd in cds])
+                values = CodingValue.objects.bulk_create(itertools.chain.from_iterable(
+                    _to_codingvalues(co, cd["values"]) for cd, co in itertools.izip(coding_dicts, coding_objects)))
+
+                ncodings += len(coding_objects)
+                nvalues += len(values)
+                done = min((i + 1) * batch_size, n)
+                rate = done / (time.time() - start)
+                message = ("Replaced codings of {done}/{n} coded articles ({ncodings} codings, {nvalues} values, "
+                           "{rate:.0f} articles/sec)".format(**locals()))
+                monitor.update(100 * (i + 1) // nbatches - 100 * i // nbatches, message)
+                log.info(message)
+
+        return ncodings, nvalues
 
     class Meta():
         db_table = 'coded_articles'
@@ -275,6 +495,80 @@ class TestCodedArticle(amcattest.AmCATTestCase):
         self.assertEqual(value.strval, "a")
         self.assertEqual(value.intval, None)
 
+    def test_bulk_replace_codings(self):
+        schema, codebook, strf, intf, codef = amcattest.create_test_schema_with_fields(isarticleschema=True)
+        schema2, codebook2, strf2, intf2, codef2 = amcattest.create_test_schema_with_fields(isarticleschema=True)
+        codingjob = amcattest.create_test_job(articleschema=schema, narticles=5)
+        coded_articles = list(CodedArticle.objects.filter(codingjob=codingjob).order_by("id"))
+
+        codings = [(ca, [self._get_coding_dict(intval=ca.id, field_id=intf.id),
+                         self._get_coding_dict(strval="a", field_id=strf.id)])
+                   for ca in coded_articles]
+        self.assertEqual(CodedArticle.bulk_replace_codings(codings, batch_size=2), (10, 10))
+
+        # Replacing removes the old codings, and uses a fixed number of queries per batch
+        codings = [(ca, [self._get_coding_dict(intval=ca.id, field_id=intf.id)]) for ca in coded_articles]
+        with self.checkMaxQueries(4 + 3 * 8): # validation and transaction, 3 batches of delete, insert, create values
+            CodedArticle.bulk_replace_codings(codings, batch_size=2)
+        for ca in coded_articles:
+            self.assertEqual([(v.field, v.intval) for (c, vs) in ca.get_codings() for v in vs], [(intf, ca.id)])
+
+        # Nothing is changed if any of the codings is invalid
+        illegal = codings + [(coded_articles[0], [self._get_coding_dict(intval=1, field_id=strf2.id)])]
+        self.assertRaises(ValueError, CodedArticle.bulk_replace_codings, illegal)
+        self.assertEqual(Coding.objects.filter(coded_article__codingjob=codingjob).count(), 5)
+
+
+    def test_update_codings(self):
+        schema, codebook, strf, intf, codef = amcattest.create_test_schema_with_fields(isarticleschema=True)
+        codingjob = amcattest.create_test_job(unitschema=schema, articleschema=schema, narticles=1)
+        coded_article = codingjob.coded_articles.get()
+        s1, s2 = [amcattest.create_test_sentence() for _ in range(2)]
+
+        def coding(sentence, *values):
+            return {"sentence_id" : sentence and sentence.id, "start" : None, "end" : None,
+                    "values" : [{"codingschemafield_id" : f.id, "intval" : i, "strval" : s}
+                                for (f, i, s) in values]}
+        def get_codings():
+            return sorted((c.sentence_id, sorted((v.field_id, v.intval, v.strval) for v in vs))
+                          for (c, vs) in coded_article.get_codings())
+
+        codings = [coding(None, (intf, 1, None), (strf, None, "a")),
+                   coding(s1, (intf, 2, None)), coding(s1, (intf, 3, None)), coding(s2, (strf, None, "b"))]
+        self.assertEqual(coded_article.update_codings(codings), (9, 0))
+        self.assertEqual(get_codings(), [(None, [(strf.id, None, "a"), (intf.id, 1, None)]),
+                                         (s1.id, [(intf.id, 2, None)]), (s1.id, [(intf.id, 3, None)]),
+                                         (s2.id, [(strf.id, None, "b")])])
+        coding_ids = set(Coding.objects.filter(coded_article=coded_article).values_list("id", flat=True))
+
+        # nothing changed: nothing is written
+        self.assertEqual(coded_article.update_codings(codings), (0, 0))
+
+        # change one value, remove one coding and add one coding
+        codings = [coding(None, (intf, 1, None), (strf, None, "changed")),
+                   coding(s1, (intf, 3, None)), coding(s2, (strf, None, "b")), coding(s2, (intf, 4, None))]
+        self.assertEqual(coded_article.update_codings(codings), (3, 3))
+        self.assertEqual(get_codings(), [(None, [(strf.id, None, "changed"), (intf.id, 1, None)]),
+                                         (s1.id, [(intf.id, 3, None)]),
+                                         (s2.id, [(strf.id, None, "b")]), (s2.id, [(intf.id, 4, None)])])
+        # the unchanged and modified codings were kept
+        self.assertEqual(len(coding_ids & set(Coding.objects.filter(coded_article=coded_article)
+                                               .values_list("id", flat=True))), 3)
+
+        self.assertEqual(coded_article.update_codings([]), (0, 9))
+        self.assertEqual(get_codings(), [])
+        self.assertRaises(ValueError, coded_article.update_codings, [coding(None, (intf, 1, "a"))])
+
+    def test_update_status(self):
+        coded_article = amcattest.create_test_coded_article()
+        self.assertEqual(coded_article.version, 0)
+        self.assertEqual(coded_article.update_status(STATUS_INPROGRESS, "comment", version=0), 1)
+        self.assertEqual(coded_article.update_status(STATUS_INPROGRESS, "comment"), 2)
+        self.assertRaises(VersionConflict, coded_article.update_status, STATUS_COMPLETE, "", version=1)
+
+        coded_article = CodedArticle.objects.get(pk=coded_article.id)
+        self.assertEqual((coded_article.status_id, coded_article.comments, coded_article.version),
+                         (STATUS_INPROGRESS, "comment", 2))
 
 class TestCodedArticleStatus(amcattest.AmCATTestCase):
     def test_status(self):
@@ -22,41 +22,64 @@
 
 import logging; log = logging.getLogger(__name__)
 
+import multiprocessing
+import time
+
 from django import forms
 from django.db import transaction
 
 from amcat.scripts.script import Script
 from amcat.models import ArticleSet, Article, Sentence
 
-from amcat.tools import sbd
+from amcat.tools import sbd, toolkit
+
+# Number of articles split and committed at once
+CHUNK_SIZE = 1000
 
 class CreateSentences(Script):
     """
-    Perform a keyword query on an articleset.
+    Split the articles in the given sets into sentences.
+
+    Articles are split in chunks on a process pool, and the sentences of every
+    chunk are inserted and committed at once. Articles that already have
+    sentences are skipped, so an interrupted run can simply be restarted.
     """
     class options_form(forms.Form):
         articlesets = forms.ModelMultipleChoiceField(queryset=ArticleSet.objects.all())
 
-    @transaction.commit_on_success
+    def get_articles_to_split(self, sets):
+        """Return the number of articles in the given sets and the (sorted) ids of those without sentences"""
+        all_ids = set(Article.objects.filter(articlesets_set__in=sets).values_list("id", flat=True))
+        splitted_ids = Sentence.objects.filter(article__articlesets_set__in=sets).values_list("article_id", flat=True)
+        return len(all_ids), sorted(all_ids - set(splitted_ids.order_by().distinct()))
+
     def run(self, _input=None):
         sets = self.options['articlesets']
         log.info("Listing articles from sets {sets}".format(**locals()))
 
-        # Determine which articles are already splitted, and which are not
-        all_articles = Article.objects.filter(articlesets_set__in=sets)
-        all_ids = all_articles.values_list("id", flat=True)
-        splitteds_ids = all_articles.filter(sentences__id__gte=0).values_list("id", flat=True)
-
-        # Get articles to be split and precache headline, byline, text
-        to_split = Article.objects.filter(id__in=set(all_ids) - set(splitteds_ids)).only("headline", "byline", "text")
+        m, to_split = self.get_articles_to_split(sets)
         n = len(to_split)
+        log.info("Total articles: {m}. To be split: {n}.".format(**locals()))
+        self.progress_monitor.update(10, "{n} of {m} articles need to be split".format(**locals()))
+        if not to_split:
+            return
 
-        log.info("Total articles: {m}. To be split: {n}.".format(m=len(all_ids), **locals()))
-        for i, article in enumerate(to_split):
-            if not i % 100:
-                log.info("Processing article {i}/{n}".format(**locals()))
+        nchunks = (n - 1) // CHUNK_SIZE + 1
+        nsents, start = 0, time.time()
+        pool = multiprocessing.Pool()
+        try:
+            for i, chunk in enumerate(toolkit.splitlist(to_split, itemsperbatch=CHUNK_SIZE)):
+                with transaction.atomic():
+                    nsents += sbd.create_sentences_bulk(chunk, pool)
 
-            sbd.create_sentences(article)
+                done = min((i + 1) * CHUNK_SIZE, n)
+                rate = done / (time.time() - start)
+                units = 90 * (i + 1) // nchunks - 90 * i // nchunks
+                self.progress_monitor.update(units, "Split {done}/{n} articles into {nsents} sentences ({rate:.0f} articles/sec)"
+                                             .format(**locals()))
+                log.info("Split {done}/{n} articles into {nsents} sentences ({rate:.0f} articles/sec)".format(**locals()))
+        finally:
+            pool.terminate()
 
         log.info("Splitted {n} articles!".format(**locals()))
 
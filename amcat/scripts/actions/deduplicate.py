@@ -23,6 +23,7 @@ import logging; log = logging.getLogger(__name__)
 
 import collections
 import itertools
+import multiprocessing
 import pprint
 
 from django import forms
@@ -30,7 +31,8 @@ from django.forms import widgets
 from django.core.exceptions import ValidationError
 from amcat.scripts.script import Script
 
-from amcat.models import ArticleSet
+from amcat.models import ArticleSet, Article, ArticleSignature
+from amcat.tools import minhash, toolkit
 
 try:
     import Levenshtein
@@ -38,10 +40,76 @@ except ImportError:
     Levenshtein = None
     log.error("Levenshtein module not installed. Deduplicate cannot be used.")
 
+# Number of articles to fetch / compare per batch
+BATCH_SIZE = 1000
+
+# Use a process pool only if there are at least this many items to process
+POOL_THRESHOLD = 1000
+
+def _get_signature(args):
+    aid, text = args
+    return aid, minhash.to_bytes(minhash.get_signature(text))
+
+def _get_matching(args):
+    """
+    Compare an article with its candidate duplicates
+    @param args: (article id, headline, text, [(id, headline, text), ..], text_ratio, headline_ratio, skip_simple)
+    @return: (article id, [ids of duplicates])
+    """
+    aid, headline, text, candidates, text_ratio, headline_ratio, skip_simple = args
+    if not skip_simple:
+        min_length = text_ratio * len(text)
+        max_length = ((1 - text_ratio) + 1) * len(text)
+        candidates = [c for c in candidates if min_length <= len(c[2]) <= max_length]
+    return aid, [cid for (cid, cheadline, ctext) in candidates
+                 if Levenshtein.ratio(headline, cheadline) >= headline_ratio
+                 and Levenshtein.ratio(text, ctext) >= text_ratio]
+
+def _map(func, items, pool=None):
+    """Map func over items, using the pool only if it is worth the overhead"""
+    if pool is None or len(items) < POOL_THRESHOLD:
+        return itertools.imap(func, items)
+    return pool.imap_unordered(func, items, chunksize=100)
+
+def get_signatures(article_ids, pool=None):
+    """
+    Get the minhash signatures for the given articles. Signatures that are not
+    stored yet (or were computed with another version) are computed and stored,
+    so subsequent calls only need to compute signatures for new articles.
+    @return: a dict of {article_id : signature}
+    """
+    result = {}
+    for batch in toolkit.splitlist(list(article_ids), itemsperbatch=BATCH_SIZE):
+        stored = ArticleSignature.objects.filter(article_id__in=batch, version=minhash.SIGNATURE_VERSION)
+        for aid, signature in stored.values_list("article_id", "signature"):
+            result[aid] = minhash.from_bytes(signature)
+
+    missing = [aid for aid in article_ids if aid not in result]
+    if missing:
+        log.info("Computing signatures for {} articles".format(len(missing)))
+
+    for batch in toolkit.splitlist(missing, itemsperbatch=BATCH_SIZE):
+        texts = Article.objects.filter(pk__in=batch).values_list("id", "text")
+        signatures = list(_map(_get_signature, list(texts), pool))
+        ArticleSignature.objects.filter(article_id__in=batch).delete()
+        ArticleSignature.objects.bulk_create(
+            ArticleSignature(article_id=aid, signature=signature, version=minhash.SIGNATURE_VERSION)
+            for (aid, signature) in signatures)
+        result.update((aid, minhash.from_bytes(signature)) for (aid, signature) in signatures)
+
+    return result
+
 class Deduplicate(Script):
     """
     Deduplicate articles using two articlesets. For all duplicated articles
     the articles in set 2 will be removed. 
+
+    Candidate duplicates are found with a minhash / LSH index on the texts of
+    set 2, after which only candidate pairs are compared exactly. The banding of
+    the index depends on text_ratio, so that duplicates are found with at least
+    99% probability (see minhash.get_lsh_bands). For a text_ratio below about 91%
+    no banding can guarantee that, and all articles with the same medium and date
+    are compared, as with the exhaustive option.
     """
     def __init__(self, *args, **kwargs):
         super(Deduplicate, self).__init__(*args, **kwargs)
@@ -56,6 +124,7 @@ class Deduplicate(Script):
         headline_ratio = forms.IntegerField(initial=80, help_text="Compare articles which headlines match ..%%")
         delete_same = forms.BooleanField(initial=False, required=False, help_text="Remove articles with same id's")
         skip_simple = forms.BooleanField(initial=False, required=False, help_text="Do not use an approximation of levenhstein ratio")
+        exhaustive = forms.BooleanField(initial=False, required=False, help_text="Compare all articles with the same medium and date, instead of only similar articles. This is always done for a text ratio below 91%%")
 
         def clean_ratio(self, ratio):
             if not (0 <= self.cleaned_data[ratio] <= 100):
@@ -93,7 +162,70 @@ class Deduplicate(Script):
 
         return self._articles_cache
 
-    def _get_deduplicates(self, articleset_1, articleset_2, text_ratio, headline_ratio, skip_simple, delete_same):
+    def get_candidates(self, articleset_1, articleset_2, delete_same, pool=None, bands=minhash.LSH_BANDS):
+        """
+        Find candidate duplicates using a minhash index of articleset_2
+        @param bands: the number of LSH bands, see minhash.get_lsh_bands
+        @return: a dict of {article id (set 1): set of article ids (set 2)}
+        """
+        articles_2 = list(articleset_2.articles.values_list("id", "medium_id", "date"))
+        signatures = get_signatures([aid for (aid, _, _) in articles_2], pool)
+
+        index = minhash.LSHIndex(bands)
+        for aid, medium_id, date in articles_2:
+            index.add(aid, signatures[aid], partition=(medium_id, date))
+        del signatures
+
+        articles_1 = list(articleset_1.articles.values_list("id", "medium_id", "date"))
+        signatures = get_signatures([aid for (aid, _, _) in articles_1], pool)
+
+        candidates = {}
+        for aid, medium_id, date in articles_1:
+            found = index.get_candidates(signatures[aid], partition=(medium_id, date))
+            if not delete_same:
+                found.discard(aid)
+            if found:
+                candidates[aid] = found
+
+        n_pairs = sum(map(len, candidates.itervalues()))
+        log.info("Found {n_pairs} candidate pairs for {} articles".format(len(candidates), **locals()))
+        return candidates
+
+    def _get_deduplicates(self, articleset_1, articleset_2, text_ratio, headline_ratio, skip_simple, delete_same, exhaustive=False):
+        bands = minhash.get_lsh_bands(text_ratio)
+        if bands is None and not exhaustive:
+            log.info("Text ratio {text_ratio} is too low to find candidates with minhash, "
+                     "comparing all articles".format(**locals()))
+            exhaustive = True
+        if exhaustive:
+            for result in self._get_deduplicates_exhaustive(articleset_1, articleset_2, text_ratio,
+                                                            headline_ratio, skip_simple, delete_same):
+                yield result
+            return
+
+        log.info("Start deduplicating ({articleset_1}, {articleset_2})..".format(**locals()))
+        pool = multiprocessing.Pool()
+        try:
+            candidates = self.get_candidates(articleset_1, articleset_2, delete_same, pool, bands)
+            n_articles = len(candidates)
+
+            for i, batch in enumerate(toolkit.splitlist(candidates.keys(), itemsperbatch=BATCH_SIZE)):
+                log.info("Checking articles {} - {} of {n_articles}".format(
+                        i*BATCH_SIZE, i*BATCH_SIZE + len(batch), **locals()))
+                ids = set(batch).union(*(candidates[aid] for aid in batch))
+                articles = Article.objects.only("id", "text", "headline").in_bulk(ids)
+
+                todo = [(aid, articles[aid].headline, articles[aid].text,
+                         [(cid, articles[cid].headline, articles[cid].text) for cid in candidates[aid]],
+                         text_ratio, headline_ratio, skip_simple) for aid in batch]
+
+                for aid, dupes in _map(_get_matching, todo, pool):
+                    if dupes:
+                        yield (articles[aid], {articles[cid] for cid in dupes})
+        finally:
+            pool.terminate()
+
+    def _get_deduplicates_exhaustive(self, articleset_1, articleset_2, text_ratio, headline_ratio, skip_simple, delete_same):
         log.info("Start deduplicating ({articleset_1}, {articleset_2})..".format(**locals()))
         all_articles = articleset_1.articles.only("id", "date", "medium", "text", "headline")
         n_articles = all_articles.count()
@@ -127,15 +259,52 @@ class Deduplicate(Script):
                 duplicates[art].append(dupe)
             
         if not dry_run:
-            articleset_2.articles.through.objects.filter(articleset=articleset_2,
-                article__in=itertools.chain.from_iterable(duplicates.values())
-            ).delete()
+            articleset_2.remove_articles(list(itertools.chain.from_iterable(duplicates.values())))
         else:
             pprint.pprint(dict(duplicates))
 
         return duplicates
 
 
+###########################################################################
+#                          U N I T   T E S T S                            #
+###########################################################################
+
+from amcat.tools import amcattest
+
+class TestDeduplicate(amcattest.AmCATTestCase):
+    TEXT = ("The quick brown fox jumps over the lazy dog while the cat watches "
+            "from the window, wondering why anyone would jump over a dog at all.")
+
+    @amcattest.use_elastic
+    def test_candidates(self):
+        m1, m2 = amcattest.create_test_medium(), amcattest.create_test_medium()
+        a = amcattest.create_test_article(text=self.TEXT, medium=m1)
+        b = amcattest.create_test_article(text=self.TEXT.replace("lazy", "sleepy"), medium=m1)
+        c = amcattest.create_test_article(text=self.TEXT, medium=m2)
+        d = amcattest.create_test_article(text="Something completely different", medium=m1)
+        s1 = amcattest.create_test_set(articles=[a])
+        s2 = amcattest.create_test_set(articles=[a, b, c, d])
+
+        candidates = Deduplicate(articleset_1=s1.id, articleset_2=s2.id, text_ratio=99, headline_ratio=80).get_candidates
+        self.assertEqual(candidates(s1, s2, delete_same=False), {a.id: {b.id}})
+        self.assertEqual(candidates(s1, s2, delete_same=True), {a.id: {a.id, b.id}})
+
+    @amcattest.use_elastic
+    def test_signatures(self):
+        a = amcattest.create_test_article(text=self.TEXT)
+        b = amcattest.create_test_article(text="Something completely different")
+
+        self.assertEqual(get_signatures([a.id]), {a.id: minhash.get_signature(self.TEXT)})
+        self.assertEqual(ArticleSignature.objects.filter(article__in=[a, b]).count(), 1)
+
+        # stored signatures are reused, outdated signatures are recomputed
+        ArticleSignature.objects.filter(article=a).update(version=minhash.SIGNATURE_VERSION - 1)
+        self.assertEqual(set(get_signatures([a.id, b.id])), {a.id, b.id})
+        self.assertEqual(set(ArticleSignature.objects.filter(article__in=[a, b])
+                             .values_list("version", flat=True)), {minhash.SIGNATURE_VERSION})
+
+
 if __name__ == '__main__':
     from amcat.scripts.tools import cli
     cli.run_cli()
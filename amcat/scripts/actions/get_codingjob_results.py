@@ -28,7 +28,7 @@ from django.utils.datastructures import MultiValueDict
 from django.db.models import Q
 
 from amcat.models import Coding, CodingJob, CodingSchemaField, Label, CodingSchema
-from amcat.models import Article, CodingSchemaFieldType, Sentence
+from amcat.models import Article, CodingSchemaFieldType, Sentence, CodedArticle, CodingValue
 from amcat.scripts.script import Script
 from amcat.tools.table import table3
 
@@ -195,73 +195,112 @@ def _get_schemafields(codingjobs, level):
 
 CodingRow = collections.namedtuple('CodingRow', ['job', 'coded_article', 'article', 'sentence', 'article_coding', 'sentence_coding'])
 
+def _get_job_codings(job, include_sentences):
+    """
+    Get the coded articles and codings of a job using a fixed number of queries
+    @return: a tuple of the coded articles (ordered by article), a dict of {coded_article_id : article coding},
+             a dict of {coded_article_id : [(sentence, sentence coding), ..]} (ordered by sentence)
+    """
+    coded_articles = list(CodedArticle.objects.filter(codingjob=job).order_by("article__id")
+                          .select_related("article__medium", "status"))
+    codings = list(Coding.objects.filter(coded_article__codingjob=job).order_by("id"))
+
+    # Pivot the values of the codings into {field_id : (strval, intval)} dicts, see CodingColumn
+    raw_values = collections.defaultdict(dict)
+    for coding_id, field_id, strval, intval in (CodingValue.objects.filter(coding__coded_article__codingjob=job)
+                                                .values_list("coding_id", "field_id", "strval", "intval")):
+        raw_values[coding_id][field_id] = (strval, intval)
+
+    sentence_ids = {c.sentence_id for c in codings if c.sentence_id is not None}
+    sentences = Sentence.objects.in_bulk(sentence_ids) if (include_sentences and sentence_ids) else {}
+
+    coded_articles_by_id = {ca.id : ca for ca in coded_articles}
+    article_codings = {} # {ca : coding}
+    sentence_codings = collections.defaultdict(list) # {ca : [(sentence, coding), ..]}
+    for c in codings:
+        c.coded_article = coded_articles_by_id[c.coded_article_id]
+        c.raw_values = raw_values.get(c.id, {})
+        if c.sentence_id is None:
+            # take first entry of duplicate article codings (#79)
+            article_codings.setdefault(c.coded_article_id, c)
+        elif include_sentences:
+            sentence_codings[c.coded_article_id].append((sentences[c.sentence_id], c))
+
+    for pairs in sentence_codings.itervalues():
+        pairs.sort(key=lambda (s, c): (s.parnr, s.sentnr, c.id))
+    return coded_articles, article_codings, sentence_codings
+
 def _get_rows(jobs, include_sentences=False, include_multiple=True, include_uncoded_articles=False):
     """
-    @param jobs: output rows for these jobs. Make sure this is a QuerySet object with .prefetch_related("codings__values")
+    Yield the rows for the given jobs, ordered by job and article. The codings, values,
+    articles and sentences are retrieved per job, so only the data of one job is in memory.
+    @param jobs: output rows for these jobs. Use .select_related("coder") if the coder is needed.
     @param sentences: include sentence level codings (if False, row.sentence and .sentence_coding are always None)
     @param include_multiple: include multiple codedarticles per article
     @param include_uncoded_articles: include articles without corresponding codings
     """
-    art_filter = Q(coded_articles__codingjob__in=jobs)
-    if include_uncoded_articles:
-        art_filter |= Q(articlesets_set__codingjob_set__in=jobs)
-
-    job_articles = { a.id : a for a in Article.objects.filter(art_filter)}
-    job_sentences = { s.id : s for s in Sentence.objects.filter(article__id__in=job_articles.keys())}
-
     # Articles that have been seen in a codingjob already (so we can skip duplicate codings on the same article)
-    seen_articles = set() 
+    seen_articles = set()
 
     for job in jobs:
-        # Get all codings in dicts for later lookup
-        coded_articles = set()
-        article_codings = {} # {ca : coding} 
-        sentence_codings = collections.defaultdict(lambda : collections.defaultdict(list)) # {ca : {sentence_id : [codings]}}
-
-        for ca in job.coded_articles.order_by('id').prefetch_related("codings"):
-            coded_articles.add(ca)
-            for c in ca.codings.all():
-                if c.sentence_id is None:
-                    if ca not in article_codings: # HACK, take first entry of duplicate article codings (#79)
-                        article_codings[ca.id] = c
-                else:
-                    sentence_codings[ca.id][c.sentence_id].append(c)
-        # output the rows for this job
+        coded_articles, article_codings, sentence_codings = _get_job_codings(job, include_sentences)
+        uncoded = []
+
         for ca in coded_articles:
-            a = job_articles[ca.article_id]
-            if a in seen_articles and not include_multiple:
+            a = ca.article
+            if a.id in seen_articles and not include_multiple:
                 continue
-            
+
             article_coding = article_codings.get(ca.id)
-            sentence_ids = sentence_codings[ca.id]
-            if include_sentences and sentence_ids:
-                seen_articles.add(a)
-                for sid in sentence_ids:
-                    s = job_sentences[sid]
-                    for sentence_coding in sentence_codings[ca.id][sid]:
-                        yield CodingRow(job, ca, a, s, article_coding, sentence_coding)
+            if include_sentences and sentence_codings[ca.id]:
+                seen_articles.add(a.id)
+                for s, sentence_coding in sentence_codings[ca.id]:
+                    yield CodingRow(job, ca, a, s, article_coding, sentence_coding)
             elif article_coding:
-                seen_articles.add(a)
+                seen_articles.add(a.id)
                 yield CodingRow(job, ca, a, None, article_coding, None)
+            else:
+                uncoded.append(ca)
 
+        if include_uncoded_articles:
+            for ca in uncoded:
+                if ca.article_id not in seen_articles:
+                    seen_articles.add(ca.article_id)
+                    yield CodingRow(job, ca, ca.article, None, None, None)
 
-    if include_uncoded_articles:
-        for article in set(job_articles.values()) - seen_articles:
-            yield CodingRow(job, job.get_coded_article(article), article, None, None, None)
+class CodingRows(object):
+    """Iterable over the rows of the given jobs (see _get_rows), which are queried upon iteration"""
+    def __init__(self, jobs, **kargs):
+        self.jobs = jobs
+        self.kargs = kargs
+
+    def __iter__(self):
+        return _get_rows(self.jobs, **self.kargs)
 
 class CodingColumn(table3.ObjectColumn):
     def __init__(self, field, label, function):
         self.function = function
         self.field = field
+        self.is_unicode = field.serialiser.deserialised_type == unicode
+        self.isarticleschema = field.codingschema.isarticleschema
         label = self.field.label + label
         self.cache = {} # assume that the function is deterministic!
         super(CodingColumn, self).__init__(label)
 
+    def get_value(self, coding):
+        """Get the serialised value of this field, using the values pivoted by _get_job_codings if possible"""
+        try:
+            raw_values = coding.raw_values
+        except AttributeError:
+            return coding.get_value(field=self.field)
+        strval, intval = raw_values.get(self.field.id, (None, None))
+        return strval if self.is_unicode else intval
+
     def getCell(self, row):
-        coding = row.article_coding if self.field.codingschema.isarticleschema else row.sentence_coding
+        coding = row.article_coding if self.isarticleschema else row.sentence_coding
         if coding is None:
             return None
-        value = coding.get_value(field=self.field)
+        value = self.get_value(coding)
         if value is not None:
             try:
                 return self.cache[value]
@@ -303,15 +342,14 @@ class GetCodingJobResults(Script):
     options_form = CodingJobResultsForm
 
     def get_table(self, codingjobs, export_level, **kargs):
-        codingjobs = CodingJob.objects.prefetch_related("coded_articles__codings__values").filter(pk__in=codingjobs)
-        
-        # Get all row of table
-        rows = list(_get_rows(
+        codingjobs = CodingJob.objects.filter(pk__in=codingjobs).select_related("coder").order_by("id")
+
+        # Rows are generated per job while the table is exported
+        rows = CodingRows(
             codingjobs, include_sentences=(int(export_level) != CODING_LEVEL_ARTICLE),
             include_multiple=True, include_uncoded_articles=False
-            ))
+            )
 
-        
         table = table3.ObjectTable(rows=rows)
 
         # Meta field columns
@@ -412,6 +450,21 @@ class TestGetCodingJobResults(amcattest.AmCATTestCase):
         
         
 
+    def test_rows_order(self):
+        schema, codebook, strf, intf, codef = amcattest.create_test_schema_with_fields(isarticleschema=True)
+        job = amcattest.create_test_job(unitschema=schema, articleschema=schema, narticles=5)
+        articles = sorted(job.articleset.articles.all(), key=lambda a: a.id)
+        for a in reversed(articles):
+            amcattest.create_test_coding(codingjob=job, article=a).update_values({intf: a.id})
+
+        # rows are in article order, and values are retrieved in bulk
+        with self.checkMaxQueries(3):
+            rows = list(CodingRows([job]))
+        self.assertEqual([r.article for r in rows], articles)
+        column = CodingColumn(intf, "", lambda x: x)
+        with self.checkMaxQueries(0):
+            self.assertEqual([column.getCell(r) for r in rows], [a.id for a in articles])
+
     def test_results(self):
         codebook, codes = amcattest.create_test_codebook_with_codes()
         schema, codebook, strf, intf, codef = amcattest.create_test_schema_with_fields(codebook=codebook, isarticleschema=True)
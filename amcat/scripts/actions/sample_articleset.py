@@ -20,24 +20,115 @@
 ###########################################################################
 
 """
-Script to get queries for a codebook
+Script to draw a random sample from an article set
 """
 
 import logging; log = logging.getLogger(__name__)
 
+import collections
+import random
+from array import array
+
 from django import forms
-from django.db import transaction
+from django.db import connection
 
 from amcat.scripts.script import Script
-from amcat.models import ArticleSet, Plugin
+from amcat.models import ArticleSet, ArticleSetArticle, Plugin
 
 PLUGINTYPE_PARSER=1
 
+# Number of rows fetched at once while reading the article ids of a set
+FETCH_SIZE = 10000
+
+STRATIFY_CHOICES = [("", "No stratification"), ("medium", "Medium"), ("date", "Date")]
+
+def get_article_ids(articleset, stratify=None):
+    """
+    Get the ids of the articles in the set as compact arrays, optionally per stratum
+    @param stratify: None, 'medium' or 'date'
+    @return: a dict of {stratum : array of article ids}, with a single stratum None if not stratifying
+    """
+    fields = {None : [], "medium" : ["article__medium_id"], "date" : ["article__date"]}[stratify or None]
+    qs = ArticleSetArticle.objects.filter(articleset=articleset).order_by("article_id")
+    query, params = qs.values_list("article_id", *fields).query.sql_with_params()
+
+    result = collections.defaultdict(lambda: array(b'l'))
+    cursor = connection.cursor()
+    try:
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                stratum = row[1] if fields else None
+                if stratify == "date":
+                    stratum = stratum.date()
+                result[stratum].append(row[0])
+    finally:
+        cursor.close()
+    return result
+
+def allocate(sizes, n):
+    """
+    Divide a sample of n over strata proportional to their sizes, rounding using the largest remainders
+    @param sizes: a dict of {stratum : size}
+    @return: a dict of {stratum : sample size}
+    """
+    total = sum(sizes.itervalues())
+    if not total:
+        return {stratum : 0 for stratum in sizes}
+    n = min(n, total)
+    quota = {stratum : float(size) * n / total for (stratum, size) in sizes.iteritems()}
+    result = {stratum : int(q) for (stratum, q) in quota.iteritems()}
+    remainders = sorted(sizes, key=lambda stratum: (result[stratum] - quota[stratum], stratum))
+    for stratum in remainders[:n - sum(result.itervalues())]:
+        result[stratum] += 1
+    return result
+
+def sample_indices(rnd, n, k):
+    """
+    Draw k distinct indices from range(n) using Floyd's algorithm, in O(k) time and memory
+    @return: a sorted list of indices
+    """
+    if k >= n:
+        return range(n)
+    if k > n // 2:
+        excluded = set(sample_indices(rnd, n, n - k))
+        return [i for i in xrange(n) if i not in excluded]
+    selected = set()
+    for j in xrange(n - k, n):
+        i = rnd.randint(0, j)
+        selected.add(j if i in selected else i)
+    return sorted(selected)
+
+def draw_sample(ids, n, seed=None):
+    """
+    Draw a sample of n ids from the given {stratum : ids} dict, proportionally allocated over the strata
+    @param seed: the random seed, the same seed and ids give the same sample
+    @return: a list of sampled ids
+    """
+    rnd = random.Random(seed)
+    allocation = allocate({stratum : len(stratum_ids) for (stratum, stratum_ids) in ids.iteritems()}, n)
+    result = []
+    for stratum in sorted(ids):
+        stratum_ids = ids[stratum]
+        result += [stratum_ids[i] for i in sample_indices(rnd, len(stratum_ids), allocation[stratum])]
+    return result
+
 class SampleSet(Script):
+    """
+    Create a new article set with a random sample of the articles in the given set.
+    The sample can be stratified by medium or date, in which case each stratum is
+    sampled proportionally. Give a seed to get a reproducible sample.
+    """
     class options_form(forms.Form):
         articleset = forms.ModelChoiceField(queryset=ArticleSet.objects.all())
         sample = forms.CharField(help_text="Sample in absolute number or percentage")
         target_articleset_name = forms.CharField(help_text="Name for the new article set")
+        stratify = forms.ChoiceField(choices=STRATIFY_CHOICES, required=False,
+                                     help_text="Sample proportionally from each medium or date")
+        seed = forms.IntegerField(required=False, help_text="Random seed, use the same seed to get the same sample")
 
         def clean_sample(self):
             sample = self.cleaned_data["sample"]
@@ -51,21 +142,24 @@ class SampleSet(Script):
             self.cleaned_data["sample"] = result
             return result
 
-    def _run(self, articleset, sample, target_articleset_name):
-        log.info("Sampling {sample} from {articleset}".format(**locals()))
+    def _run(self, articleset, sample, target_articleset_name, stratify=None, seed=None):
+        if seed is None:
+            seed = random.SystemRandom().randint(0, 2**31)
+        log.info("Sampling {sample} from {articleset}, stratify={stratify!r}, seed={seed}".format(**locals()))
+
+        ids = get_article_ids(articleset, stratify)
+        n = sum(map(len, ids.itervalues()))
         if not isinstance(sample, int):
-            n = articleset.articles.count()
             sample = int(round(n * sample))
-            log.info("Sampling {sample} of {n} articles".format(**locals()))
-
+        log.info("Sampling {sample} of {n} articles in {} strata".format(len(ids), **locals()))
+        self.progress_monitor.update(20, "Sampling {sample} of {n} articles".format(**locals()))
 
-        selected = articleset.articles.order_by('?')[:sample]
-        ids = [x for (x,) in selected.values_list("pk")]
+        selected = draw_sample(ids, sample, seed)
 
         target_set = ArticleSet.objects.create(name=target_articleset_name, project=articleset.project)
         log.info("Created set {target_set.id}:{target_set} in project {target_set.project_id}:{target_set.project}!".format(**locals()))
 
-        target_set.add_articles(ids)
+        target_set.add_articles(selected, monitor=self.progress_monitor)
 
         log.info("Done!")
 
@@ -75,3 +169,48 @@ if __name__ == '__main__':
     from amcat.scripts.tools import cli
     result = cli.run_cli()
     #print result.output()
+
+###########################################################################
+#                          U N I T   T E S T S                            #
+###########################################################################
+
+from amcat.tools import amcattest
+
+class TestSampleSet(amcattest.AmCATTestCase):
+    def test_allocate(self):
+        self.assertEqual(allocate({"a" : 50, "b" : 30, "c" : 20}, 10), {"a" : 5, "b" : 3, "c" : 2})
+        self.assertEqual(allocate({"a" : 2, "b" : 1}, 2), {"a" : 1, "b" : 1})
+        self.assertEqual(allocate({"a" : 2, "b" : 1}, 10), {"a" : 2, "b" : 1})
+        self.assertEqual(allocate({"a" : 0}, 10), {"a" : 0})
+
+    def test_sample_indices(self):
+        for n, k in [(100, 0), (100, 10), (100, 90), (10, 10), (10, 20)]:
+            indices = sample_indices(random.Random(1), n, k)
+            self.assertEqual(len(set(indices)), min(n, k))
+            self.assertEqual(indices, sorted(indices))
+            self.assertTrue(all(0 <= i < n for i in indices))
+            self.assertEqual(indices, sample_indices(random.Random(1), n, k))
+
+    def test_draw_sample(self):
+        ids = {"a" : array(b'l', range(100)), "b" : array(b'l', range(100, 150))}
+        result = draw_sample(ids, 15, seed=42)
+        self.assertEqual(len([i for i in result if i < 100]), 10)
+        self.assertEqual(len([i for i in result if i >= 100]), 5)
+        self.assertEqual(result, draw_sample(ids, 15, seed=42))
+        self.assertNotEqual(result, draw_sample(ids, 15, seed=43))
+
+    @amcattest.use_elastic
+    def test_sample_set(self):
+        m1, m2 = amcattest.create_test_medium(), amcattest.create_test_medium()
+        articles = [amcattest.create_test_article(medium=m) for m in [m1] * 6 + [m2] * 3]
+        s = amcattest.create_test_set(articles=articles)
+
+        self.assertEqual({k : set(v) for (k, v) in get_article_ids(s).items()}, {None : {a.id for a in articles}})
+        ids = get_article_ids(s, stratify="medium")
+        self.assertEqual(set(ids[m1.id]), {a.id for a in articles[:6]})
+
+        sample = SampleSet(articleset=s.id, sample="33%", target_articleset_name="sample",
+                           stratify="medium", seed=1).run()
+        sampled = sample.get_article_ids()
+        self.assertEqual(len(sampled & set(ids[m1.id])), 2)
+        self.assertEqual(len(sampled & set(ids[m2.id])), 1)
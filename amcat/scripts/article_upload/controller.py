@@ -23,46 +23,139 @@ Module for running scrapers
 """
 
 import logging;log = logging.getLogger(__name__)
+import itertools
+import multiprocessing
+import time
 from collections import namedtuple
 
+from django.db import connections
+
 from amcat.models import Article, Project
+from amcat.tools.progress import NullMonitor
 
 ScrapeError = namedtuple("ScrapeError", ["i", "unit", "error"])
 
+# Number of articles that are saved (and added to the set and index) at once
+CHUNK_SIZE = 1000
+
+# The scraper used by the pool workers, set before the pool is created
+_scraper = None
+# Database connections inherited from the parent process, see _init_worker
+_inherited_connections = []
+
+def _init_worker():
+    """
+    Make sure pool workers do not use the database connection of the parent process.
+    The old connection objects are kept, so they are not closed (which would also close
+    the connection of the parent); workers open a new connection when needed.
+    """
+    for conn in connections.all():
+        _inherited_connections.append(conn.connection)
+        conn.connection = None
+
+def _scrape_unit(args):
+    """Scrape a unit in a pool worker, returning (i, unit, articles, error)"""
+    i, unit = args
+    try:
+        return i, unit, list(_scraper._scrape_unit(unit)), None
+    except Exception as e:
+        log.exception("scraper._scrape_unit failed")
+        return i, unit, [], e
+
 class Controller(object):
-    def __init__(self):
+    """
+    Runs a scraper by lazily getting its units, scraping them (on a process pool if
+    the scraper supports parallel_parsing), and saving the articles in chunks.
+    """
+    def __init__(self, chunk_size=CHUNK_SIZE, processes=None, monitor=NullMonitor()):
+        """
+        @param chunk_size: save articles after this many articles have been scraped
+        @param processes: the number of processes to scrape with, default is the number of cpus
+        """
         self.errors = []
-        self.articles = []
+        self.saved_article_ids = set()
+        self.chunk_size = chunk_size
+        self.processes = processes
+        self.monitor = monitor
+        self.nunits = self.narticles = 0
+
+    def scrape(self, scraper, units):
+        """Yield (i, unit, articles, error) tuples for the given units"""
+        units = enumerate(units)
+        if not getattr(scraper, "parallel_parsing", False) or self.processes == 1:
+            for i, unit in units:
+                try:
+                    yield i, unit, list(scraper._scrape_unit(unit)), None
+                except Exception as e:
+                    log.exception("scraper._scrape_unit failed")
+                    yield i, unit, [], e
+            return
+
+        global _scraper
+        _scraper = scraper
+        pool = multiprocessing.Pool(self.processes, initializer=_init_worker)
+        try:
+            # pool.imap consumes its input eagerly, so feed it batches to bound memory use
+            for batch in iter(lambda: list(itertools.islice(units, self.chunk_size)), []):
+                for result in pool.imap(_scrape_unit, batch, chunksize=10):
+                    yield result
+        finally:
+            pool.terminate()
+            _scraper = None
+
+    def save(self, scraper, articles):
+        """Save the given articles, adding them to the articleset of the scraper"""
+        for article in articles:
+            _set_default(article, 'project', scraper.project)
+        try:
+            articles, errors = Article.create_articles(articles, scraper.articleset)
+        except Exception as e:
+            self.errors.append(ScrapeError(None,None,e))
+            log.exception("Article.create_articles failed")
+            return
+
+        self.saved_article_ids |= {getattr(a, "duplicate_of", a.id) for a in articles}
+        for e in errors:
+            self.errors.append(ScrapeError(None,None,e))
+
+    def report(self, start, final=False):
+        t = (time.time() - start) or 1e-6
+        ups, aps = self.nunits / t, self.narticles / t
+        message = ("{}Scraped {self.nunits} units into {self.narticles} articles, saved {n} "
+                   "({ups:.1f} units/sec, {aps:.1f} articles/sec)".format("Done! " if final else "",
+                                                                          n=len(self.saved_article_ids), **locals()))
+        log.info(message)
+        self.monitor.update(0, message)
 
     def run(self, scraper):
         try:
-            units = list(scraper._get_units())
+            units = scraper._get_units()
         except Exception as e:
             self.errors.append(ScrapeError(None,None,e))
             log.exception("scraper._get_units failed")
-            return self.articles
-
-        for i, unit in enumerate(units):
-            try:
-                articles = list(scraper._scrape_unit(unit))
-            except Exception as e:
-                log.exception("scraper._scrape_unit failed")
-                self.errors.append(ScrapeError(i,unit,e))
-                continue
-            self.articles += articles
-
-        for article in self.articles:
-            _set_default(article, 'project', scraper.project)
+            return self.saved_article_ids
 
+        start, chunk = time.time(), []
         try:
-            articles, errors = Article.create_articles(self.articles, scraper.articleset)
-            self.saved_article_ids = {getattr(a, "duplicate_of", a.id) for a in self.articles}
-            for e in errors:
-                self.errors.append(ScrapeError(None,None,e))
+            for i, unit, articles, error in self.scrape(scraper, units):
+                self.nunits += 1
+                if error is not None:
+                    self.errors.append(ScrapeError(i,unit,error))
+                    continue
+                chunk += articles
+                self.narticles += len(articles)
+                # articles from one unit are saved in the same chunk, so parents stay with their children
+                if len(chunk) >= self.chunk_size:
+                    self.save(scraper, chunk)
+                    self.report(start)
+                    chunk = []
         except Exception as e:
             self.errors.append(ScrapeError(None,None,e))
             log.exception("scraper._get_units failed")
 
+        if chunk:
+            self.save(scraper, chunk)
+        self.report(start, final=True)
         return self.saved_article_ids
 
 def _set_default(obj, attr, val):
@@ -71,3 +164,58 @@ def _set_default(obj, attr, val):
     except Project.DoesNotExist:
         pass # django throws DNE on x.y if y is not set and not nullable
     setattr(obj, attr, val)
+
+###########################################################################
+#                          U N I T   T E S T S                            #
+###########################################################################
+
+from amcat.tools import amcattest
+
+class _TestScraper(object):
+    """Scraper for the controller tests, defined at module level so pool workers can use it"""
+    def __init__(self, project, articleset, medium, units, parallel_parsing=False):
+        self.project, self.articleset, self.medium, self.units = project, articleset, medium, units
+        self.parallel_parsing = parallel_parsing
+    def _get_units(self):
+        return iter(self.units)
+    def _scrape_unit(self, unit):
+        if unit is None:
+            raise ValueError("Cannot scrape unit")
+        # no id or new objects, as pool workers have their own id counter and database connection
+        yield Article(project=self.project, medium=self.medium, date="2000-01-01", headline=unit, text=unit)
+
+class TestController(amcattest.AmCATTestCase):
+    @amcattest.use_elastic
+    def test_run(self):
+        s = amcattest.create_test_set()
+        scraper = _TestScraper(s.project, s, amcattest.create_test_medium(), ["a", "b", None, "c", "d", "e"])
+        controller = Controller(chunk_size=2)
+        ids = controller.run(scraper)
+
+        self.assertEqual(len(ids), 5)
+        self.assertEqual(set(s.articles.values_list("headline", flat=True)), {"a", "b", "c", "d", "e"})
+        self.assertEqual([(e.i, e.unit) for e in controller.errors], [(2, None)])
+        self.assertEqual((controller.nunits, controller.narticles), (6, 5))
+
+    @amcattest.use_elastic
+    def test_run_parallel(self):
+        """Does scraping on a process pool give the same result as scraping serially?"""
+        from amcat.tools import amcates
+        medium = amcattest.create_test_medium()
+        units = ["a", "b", None, "c", "d", "e", None, "f"]
+        results = []
+        for parallel_parsing, processes in [(False, None), (True, 2)]:
+            s = amcattest.create_test_set()
+            scraper = _TestScraper(s.project, s, medium, units, parallel_parsing=parallel_parsing)
+            controller = Controller(chunk_size=3, processes=processes)
+            ids = controller.run(scraper)
+            self.assertEqual(set(s.articles.values_list("id", flat=True)), ids)
+            results.append((ids, [(e.i, e.unit) for e in controller.errors],
+                            controller.nunits, controller.narticles))
+            # make the articles visible to the duplicate check of the next run
+            amcates.ES().refresh()
+
+        serial, parallel = results
+        self.assertEqual(serial[1:], ([(2, None), (6, None)], 8, 6))
+        # the articles of the parallel run are duplicates of those of the serial run
+        self.assertEqual(parallel, serial)
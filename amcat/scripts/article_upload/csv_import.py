@@ -25,11 +25,14 @@ Plugin for uploading csv files
 
 from __future__ import unicode_literals, absolute_import
 
+import logging; log = logging.getLogger(__name__)
 import csv
 from cStringIO import StringIO
 from types import NoneType
 
 from django import forms
+from django.db import connection
+from django.db.models import Q
 from django.db.models.fields import FieldDoesNotExist
 
 from amcat.scripts.article_upload.upload import UploadScript
@@ -38,9 +41,16 @@ from amcat.scripts.article_upload import fileupload
 from amcat.models.article import Article
 from amcat.models.medium import Medium
 
+from amcat.tools import toolkit
 from amcat.tools.toolkit import readDate
 import datetime
 
+# Number of rows that are read and parsed at once
+CHUNK_SIZE = 1000
+
+# Number of articles per query when linking articles to their parents
+UPDATE_BATCH_SIZE = 10000
+
 FIELDS = ("text", "date", "medium", "pagenr", "section", "headline", "byline",  "url", "externalid",
           "author", "addressee", "parent_url", "parent_externalid")
 REQUIRED = [True] * 2 + [False] * (len(FIELDS) - 2)
@@ -64,6 +74,67 @@ def is_nullable(field_name):
     except FieldDoesNotExist:
         return True
 
+def get_value_parser(fieldname):
+    """
+    Return a function that converts a csv (or xlsx) value into the value for the given field:
+    empty values become None (or '' if the field is not nullable), other values are parsed
+    with the parser from PARSERS, if any.
+    """
+    parser = PARSERS.get(fieldname)
+    nullable = is_nullable(fieldname)
+    def parse(val):
+        if val is None or (isinstance(val, basestring) and not val.strip()):
+            return None if nullable else ""
+        if fieldname == 'date' and isinstance(val, datetime.datetime):
+            return val # no need to parse
+        if parser is None:
+            return val
+        return parser(val)
+    return parse
+
+def _parse_column(values, parse):
+    """
+    Parse the values of a column, parsing every distinct value only once.
+    @return: a list of parsed values, containing the exception instead of the value
+             for values that could not be parsed
+    """
+    parsed = {}
+    result = []
+    for val in values:
+        try:
+            result.append(parsed[val])
+        except KeyError:
+            try:
+                p = parse(val)
+            except Exception as e:
+                p = e
+            parsed[val] = p
+            result.append(p)
+    return result
+
+def _update_parents(links):
+    """
+    Set the parent and, if it is empty and an addressee is given, the addressee of articles
+    @param links: a list of (article id, parent article id, addressee) tuples
+    """
+    for batch in toolkit.splitlist(links, itemsperbatch=UPDATE_BATCH_SIZE):
+        if connection.vendor == "postgresql":
+            values = ",".join(["(%s, %s, %s)"] * len(batch))
+            params = [x for link in batch for x in link]
+            cursor = connection.cursor()
+            cursor.execute("UPDATE articles SET parent_article_id = v.parent_id, "
+                           "       addressee = CASE WHEN COALESCE(articles.addressee, '') = '' "
+                           "                        AND v.addressee IS NOT NULL "
+                           "                        THEN v.addressee ELSE articles.addressee END "
+                           "FROM (VALUES {values}) AS v(article_id, parent_id, addressee) "
+                           "WHERE articles.article_id = v.article_id".format(**locals()), params)
+        else:
+            for aid, parent_id, addressee in batch:
+                Article.objects.filter(pk=aid).update(parent=parent_id)
+                if addressee is not None:
+                    (Article.objects.filter(pk=aid).filter(Q(addressee__isnull=True) | Q(addressee=""))
+                     .update(addressee=addressee))
+
 class CSVForm(UploadScript.options_form, fileupload.CSVUploadForm):
     medium_name = forms.CharField(
         max_length=Article._meta.get_field_by_name('medium')[0].max_length,
@@ -141,6 +212,8 @@ class CSV(UploadScript):
     options_form = CSVForm
 
     def explain_error(self, error):
+        if isinstance(error.error, KeyError) and error.i is None:
+            return "Field {error.error} not found in the header. Check field name and/or csv dialect".format(**locals())
         if isinstance(error.error, KeyError):
             return "Field {error.error} not found in row {error.i}. Check field name and/or csv dialect".format(**locals())
         return super(CSV, self).explain_error(error)
@@ -156,7 +229,9 @@ class CSV(UploadScript):
 
         if self.parent_field:
             self.parents = {} # id/url : id/url
-            self.articles = {} # id/url : article
+
+        self.csvfields = [(fieldname, self.options[fieldname]) for fieldname in FIELDS if self.options[fieldname]]
+        self.parsers = {fieldname : get_value_parser(fieldname) for (fieldname, _) in self.csvfields}
 
         return super(CSV, self).run(*args, **kargs)
 
@@ -175,33 +250,52 @@ class CSV(UploadScript):
 
         raise ValueError("No medium specified!")
 
-    def parse_document(self, row):
-        kargs = dict(medium = self._medium, metastring = {})
-        csvfields = [(fieldname, self.options[fieldname]) for fieldname in FIELDS if self.options[fieldname]]
-        for fieldname, csvfield in csvfields:
-            val = row[csvfield]
-            if fieldname == 'date' and isinstance(val, datetime.datetime):
-                pass # no need to parse
-            elif val.strip():
-                if fieldname in PARSERS:
-                    val = PARSERS[fieldname](val)
-            elif is_nullable(fieldname):
-                val = None
-            else:
-                val = val.strip()
-
-            kargs[fieldname] = val
+    def _get_units(self):
+        """
+        Read the rows in chunks and parse each chunk column by column (see parse_rows)
+        """
+        for rows in toolkit.splitlist(self.bound_form.get_entries(), itemsperbatch=CHUNK_SIZE):
+            for unit in self.parse_rows(rows):
+                yield unit
+
+    def parse_rows(self, rows):
+        """
+        Parse the values of a chunk of rows per column
+        @return: a list of (kargs, error) pairs with the Article arguments for each row,
+                 or the error that occurred while parsing the row
+        """
+        column_names = list(rows[0].column_names)
+        columns = []
+        for fieldname, csvfield in self.csvfields:
+            if csvfield not in column_names:
+                raise KeyError(csvfield)
+            j = column_names.index(csvfield)
+            columns.append((fieldname, _parse_column([row[j] for row in rows], self.parsers[fieldname])))
 
         # Metadata to metastring
-        csvfields = [tup[1] for tup in csvfields]
-        for key, value in row.items():
-            if key not in csvfields:
-                kargs["metastring"][key] = value
+        csvcolumns = {csvfield for (_, csvfield) in self.csvfields}
+        metafields = [(i, key) for (i, key) in enumerate(column_names) if key not in csvcolumns]
 
         # In case medium wasn't defined in csv
         medium = self._medium
-        if medium is not None:
-            kargs["medium"] = medium
+
+        result = []
+        for i, row in enumerate(rows):
+            kargs = {fieldname : values[i] for (fieldname, values) in columns}
+            errors = [val for val in kargs.itervalues() if isinstance(val, Exception)]
+            if errors:
+                result.append((None, errors[0]))
+                continue
+            kargs["metastring"] = {key : row[j] for (j, key) in metafields}
+            if medium is not None:
+                kargs["medium"] = medium
+            result.append((kargs, None))
+        return result
+
+    def parse_document(self, parsed):
+        kargs, error = parsed
+        if error is not None:
+            raise error
 
         if self.parent_field:
             doc_id = kargs.get(self.id_field)
@@ -209,22 +303,37 @@ class CSV(UploadScript):
             if parent_id:
                 self.parents[doc_id] = parent_id
 
-        article = Article(**kargs)
-        if self.parent_field:
-            self.articles[doc_id] = article
-
-        return article
-
-    def postprocess(self, articles):
-        if self.parent_field:
-            for doc_id, parent_id in self.parents.iteritems():
-                doc = self.articles[doc_id]
-                doc.parent = self.articles[parent_id]
-                if not doc.addressee and self.options['addressee_from_parent']:
-                    doc.addressee = doc.parent.author
-
-                doc.save()
-        super(CSV, self).postprocess(articles)
+        return Article(**kargs)
+
+    def postprocess(self, article_ids):
+        if self.parent_field and self.parents:
+            self.link_parents(article_ids)
+        super(CSV, self).postprocess(article_ids)
+
+    def link_parents(self, article_ids):
+        """
+        Set the parents of the uploaded articles after they have been saved, by looking up
+        the article id and author for each id/url and updating the children at once.
+        """
+        doc_ids = set(self.parents) | set(self.parents.itervalues())
+        articles = {} # id/url : (article id, author)
+        for batch in toolkit.splitlist(list(article_ids), itemsperbatch=UPDATE_BATCH_SIZE):
+            for doc_id, aid, author in (Article.objects.filter(pk__in=batch)
+                                        .values_list(self.id_field, "id", "author")):
+                if doc_id in doc_ids:
+                    articles[doc_id] = (aid, author)
+
+        links = []
+        for doc_id, parent_id in self.parents.iteritems():
+            if doc_id not in articles or parent_id not in articles:
+                log.warning("Cannot link article {doc_id!r} to parent {parent_id!r}: article not found"
+                            .format(**locals()))
+                continue
+            aid, _author = articles[doc_id]
+            parent_aid, parent_author = articles[parent_id]
+            addressee = parent_author if self.options['addressee_from_parent'] else None
+            links.append((aid, parent_aid, addressee))
+        _update_parents(links)
 
 if __name__ == '__main__':
     from amcat.scripts.tools import cli
@@ -235,7 +344,6 @@ if __name__ == '__main__':
 ###########################################################################
 
 from amcat.tools import amcattest
-import unittest
 
 
 def _run_test_csv(header, rows, **options):
@@ -300,46 +408,66 @@ class TestCSV(amcattest.AmCATTestCase):
         self.assertEqual(len(articles), 1)
         self.assertEqual(articles[0].medium.name, "2")
 
-    @unittest.skip("Controller is a mess")
-    def test_parents(self):
-        header = ('kop', 'datum', 'tekst', 'id', 'parent', 'van')
-        data = [
-            ('kop1', '2001-01-01', 'text1', "7", "12", 'piet'),
-            ('kop2', '2001-01-01', 'text2', "12", None, 'jan')
-        ]
-        articles = _run_test_csv(header, data, text="tekst", headline="kop", date="datum",
-                                 externalid='id',  parent_externalid='parent', author='van')
-
+    def test_parse_column(self):
+        calls = []
+        def parse(val):
+            calls.append(val)
+            return int(val)
+        self.assertEqual(_parse_column(["1", "2", "1"], parse), [1, 2, 1])
+        self.assertEqual(calls, ["1", "2"])
 
-        # for strange reasons, it seems that the order is sometimes messed up
-        # since this is not something we care about, we order the results
-        articles = sorted(articles, key=lambda a: a.externalid)
-
-        self.assertEqual(len(articles), 2)
-        self.assertEqual(articles[0].parent, articles[1])
-        self.assertEqual(articles[0].externalid, 7)
-        self.assertEqual(articles[0].author, 'piet')
-        self.assertEqual(articles[0].addressee, None)
+        result = _parse_column(["1", "x"], parse)
+        self.assertEqual(result[0], 1)
+        self.assertIsInstance(result[1], ValueError)
 
+        parse = get_value_parser("pagenr")
+        self.assertEqual(_parse_column(["12", " ", None, 3.0], parse), [12, None, None, 3])
+        date = datetime.datetime(2001, 1, 1)
+        self.assertEqual(_parse_column([date, "2001-01-01"], get_value_parser("date")), [date, date])
 
-        self.assertEqual(articles[1].parent, None)
-        self.assertEqual(articles[1].externalid, 12)
-        self.assertEqual(articles[1].author, 'jan')
-        self.assertEqual(articles[1].addressee, None)
-
-
-        articles = _run_test_csv(header, data, text="tekst", headline="kop", date="datum",
-                                 externalid='id',  parent_externalid='parent', author='van',
-                                 addressee_from_parent=True)
-
-        # see above
-        articles = sorted(articles, key=lambda a: a.externalid)
-
-        self.assertEqual(articles[0].author, 'piet')
-        self.assertEqual(articles[0].addressee, 'jan')
-        self.assertEqual(articles[1].author, 'jan')
-        self.assertEqual(articles[1].addressee, None)
-
+    @amcattest.use_elastic
+    def test_parents(self):
+        header = ('kop', 'datum', 'tekst', 'id', 'parent', 'url', 'parent_url', 'van', 'aan')
+        def upload(text, **options):
+            # different texts per upload, to prevent the articles being seen as duplicates
+            data = [
+                ('kop1', '2001-01-01', text + '1', "7", "12", 'http://a/7', 'http://a/12', 'piet', None),
+                ('kop2', '2001-01-01', text + '2', "12", None, 'http://a/12', None, 'jan', None),
+                ('kop3', '2001-01-01', text + '3', "13", "12", 'http://a/13', 'http://a/12', 'kees', 'klaas'),
+                ('kop4', '2001-01-01', text + '4', "14", "99", 'http://a/14', 'http://a/99', 'joop', None),
+            ]
+            ids = _run_test_csv(header, data, text="tekst", headline="kop", date="datum",
+                                author='van', addressee='aan', **options)
+            return {a.headline : a for a in Article.objects.filter(pk__in=ids)}
+
+        arts = upload("externalid", externalid='id', parent_externalid='parent')
+        self.assertEqual(len(arts), 4)
+        self.assertEqual(arts['kop1'].externalid, 7)
+        self.assertEqual(arts['kop1'].parent_id, arts['kop2'].id)
+        self.assertEqual(arts['kop3'].parent_id, arts['kop2'].id)
+        self.assertEqual(arts['kop2'].parent_id, None)
+        self.assertEqual(arts['kop4'].parent_id, None) # parent not in the file
+        self.assertEqual([arts[k].addressee for k in ('kop1', 'kop2', 'kop3')], [None, None, 'klaas'])
+
+        # addressee from parent should only be set if the article has no addressee
+        arts = upload("url", url='url', parent_url='parent_url', addressee_from_parent=True)
+        self.assertEqual(arts['kop1'].url, 'http://a/7')
+        self.assertEqual(arts['kop1'].parent_id, arts['kop2'].id)
+        self.assertEqual(arts['kop3'].parent_id, arts['kop2'].id)
+        self.assertEqual(arts['kop2'].parent_id, None)
+        self.assertEqual([arts[k].addressee for k in ('kop1', 'kop2', 'kop3', 'kop4')],
+                         ['jan', None, 'klaas', None])
+
+        # the same, but without the postgres specific update
+        links = [(arts['kop1'].id, arts['kop3'].id, 'kees'), (arts['kop3'].id, arts['kop1'].id, 'piet')]
+        vendor, connection.vendor = connection.vendor, "other"
+        try:
+            _update_parents(links)
+        finally:
+            connection.vendor = vendor
+        kop1, kop3 = [Article.objects.get(pk=arts[k].id) for k in ('kop1', 'kop3')]
+        self.assertEqual((kop1.parent_id, kop1.addressee), (kop3.id, 'jan'))
+        self.assertEqual((kop3.parent_id, kop3.addressee), (kop1.id, 'klaas'))
 
     @amcattest.use_elastic
     def test_date_format(self):
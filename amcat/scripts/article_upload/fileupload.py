@@ -140,15 +140,23 @@ def namedtuple_csv_reader(csv_file, encoding='utf-8', **kargs):
     return namedtuples_from_reader(r, encoding=encoding)
 
 
+def _cell_value(cell):
+    try:
+        return cell.value
+    except AttributeError:
+        # older openpyxl versions yield RawCell tuples in iterator mode
+        return cell.internal_value
+
 def _xlsx_as_csv(file):
     """
-    Supply a csv reader-like interface to an xlsx file
+    Supply a csv reader-like interface to an xlsx file. The rows are read lazily
+    (openpyxl iterator mode), so the sheet is not loaded into memory at once.
     """
     from openpyxl import load_workbook
-    wb = load_workbook(file)
+    wb = load_workbook(file, use_iterators=True)
     ws = wb.get_sheet_by_name(wb.get_sheet_names()[0])
-    for row in ws.rows:
-        row = [c.value for c in row]
+    for row in ws.iter_rows():
+        row = [_cell_value(c) for c in row]
         yield row
     
 def namedtuple_xlsx_reader(xlsx_file):
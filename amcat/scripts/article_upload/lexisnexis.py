@@ -34,12 +34,19 @@ from amcat.models.medium import Medium
 
 import re, os.path
 import collections
-import StringIO
+import multiprocessing
+import time
 from itertools import takewhile, count
 from string import strip
 
 import logging; log = logging.getLogger(__name__)
 
+# Files with at least this many documents are parsed on a process pool
+POOL_THRESHOLD = 500
+
+# Throughput (documents per second per process) that the benchmark should reach
+BENCHMARK_TARGET = 2000
+
 # Regular expressions used for parsing document
 class RES:
     # Match at least 20 whitespace characters, followed by # of # DOCUMENTS.
@@ -166,18 +173,19 @@ def split_body(body):
 
     @return: generator yielding unicode strings
     """
-    art = StringIO.StringIO()
+    art = []
     for line in body.split("\n")[1:]:
-        if RES.DOCUMENT_COUNT.match(line):
-            yield art.getvalue()
-
-            art = StringIO.StringIO()
-
+        # cheap check first: DOCUMENT_COUNT lines start with at least 20 spaces
+        if line.startswith(_DOCUMENT_COUNT_INDENT) and RES.DOCUMENT_COUNT.match(line):
+            yield "".join(art)
+            art = []
         else:
-            art.write(line)
-            art.write("\n")
+            art.append(line)
+            art.append("\n")
 
-    yield art.getvalue()
+    yield "".join(art)
+
+_DOCUMENT_COUNT_INDENT = " " * 20
 
 def _strip_article(art):
     """
@@ -193,6 +201,9 @@ def _strip_article(art):
     return "\n".join(art).replace("\r", "")
 
 def _is_date(string):
+    # every date format needs digits, and failing to read a date is relatively expensive
+    if not _HAS_DIGIT.search(string):
+        return False
     try:
         toolkit.readDate(string)
     except ValueError:
@@ -200,97 +211,105 @@ def _is_date(string):
 
     return True
 
+_HAS_DIGIT = re.compile("\d")
 
-def parse_article(art):
-    """
-    A lexis nexis article consists of five parts:
-    1) a header
-    2) the headline and possibly a byline
-    3) a block of meta fields
-    4) the body
-    5) a block of meta fields
-
-    The header consists of 'centered' lines, ie starting with a whitespace character
-    The headline (and byline) are left justified non-marked lines before the first meta field
-    The meta fields are of the form FIELDNAME: value and can contain various field names
-    The body starts after either two blank lines, or if a line is not of the meta field form.
-    The body ends with a 'load date', which is of form FIELDNAME: DATE ending with a four digit year
-    """
+class _Line(object):
+    """A line of an article with the properties used by the parser, computed once"""
+    __slots__ = ("text", "stripped", "indented")
 
-    header, headline, meta, body = [], [], [], []
+    def __init__(self, text):
+        self.text = text
+        self.stripped = text.strip()
+        self.indented = text.startswith(" ")
 
-    header_headline = []
+def tokenize(art):
+    """
+    Split the article text into lines for parsing (see _strip_article)
+    @return: a list of _Line objects
+    """
+    return [_Line(line) for line in _strip_article(art).split("\n")]
 
-    def next_is_indented(lines, skipblank = True):
-        if len(lines) <= 1: return False
-        if not lines[1].strip():
+class _ArticleParser(object):
+    """
+    Parser for the lines of an article (see parse_article). The lines are not changed,
+    instead the parse methods consume lines by moving the cursor self.i forward.
+    """
+    def __init__(self, lines):
+        self.lines = lines
+        self.n = len(lines)
+        self.i = 0
+        self.header_headline = []
+
+    def next_is_indented(self, i, skipblank=True):
+        lines, n = self.lines, self.n
+        while i + 1 < n:
+            if lines[i+1].stripped:
+                return lines[i+1].indented
             if not skipblank: return False
-            return next_is_indented(lines[1:])
-        return lines[1].startswith(" ")
-
+            i += 1
+        return False
 
-    def followed_by_date_block(lines):
+    def followed_by_date_block(self, i):
         # this text is followed by a date block
         # possibly, there is another line in the first block
         # (blank line)
         #          indented date line
         #          optional second indented date line
         # (blank line)
-        if len(lines) < 5: return False
-        if ((not lines[1].strip()) and
-            lines[2].startswith(" ") and
-            (not lines[3].strip())):
-            return True
-        if ((not lines[1].strip()) and
-            lines[2].startswith(" ") and
-            lines[2].startswith(" ") and
-            (not lines[4].strip())):
-            return True
-        if not lines[1].strip(): return False
-        if lines[1].startswith(" "): return False
-        return followed_by_date_block(lines[1:])
+        lines = self.lines
+        while self.n - i >= 5:
+            if not lines[i+1].stripped:
+                return (lines[i+2].indented and
+                        (not lines[i+3].stripped or not lines[i+4].stripped))
+            if lines[i+1].indented: return False
+            i += 1
+        return False
 
-    def _in_header(lines):
-        if not lines: return False
-        if not lines[0].strip(): return True # blank line
+    def in_header(self):
+        lines = self.lines
+        if self.i >= self.n: return False
+        line = lines[self.i]
+        if not line.stripped: return True # blank line
 
         # indented line spanning page width: header
-        if (not lines[0].startswith(" ")
-            and next_is_indented(lines, skipblank=False)
-            and len(lines[0].strip()) > 75):
+        if (not line.indented
+            and self.next_is_indented(self.i, skipblank=False)
+            and len(line.stripped) > 75):
             return True
 
         # non-indented TITLE or normal line followed by indented line
-        if (not lines[0].startswith(" ")) and next_is_indented(lines):
-            header_headline.append(lines.pop(0))
+        if (not line.indented) and self.next_is_indented(self.i):
+            self.header_headline.append(line.text)
+            self.i += 1
         else:
-            while (not lines[0].startswith(" ")) and followed_by_date_block(lines):
-                header_headline.append(lines.pop(0))
+            while (not lines[self.i].indented) and self.followed_by_date_block(self.i):
+                self.header_headline.append(lines[self.i].text)
+                self.i += 1
 
         # check again after possible removal of header_headline
-        if not lines: return False
-        if not lines[0].strip(): return True # blank line
-        if lines[0].startswith(" "): return True # indented line
-
+        if self.i >= self.n: return False
+        line = lines[self.i]
+        if not line.stripped: return True # blank line
+        if line.indented: return True # indented line
 
     @toolkit.to_list
-    def _get_header(lines):
-        """Consume and return all lines that are indented (ie the list is changed in place)"""
-        while _in_header(lines):
-            line = lines.pop(0)
-            line = line.strip()
+    def get_header(self):
+        """Consume and return all lines that are indented"""
+        while self.in_header():
+            line = self.lines[self.i].stripped
+            self.i += 1
             if line:
-                if re.match('Copyright \d{4}', line):
+                if _COPYRIGHT_YEAR.match(line):
                     line = line[len('Copyright xxxx'):]
                 yield line
 
-    def _get_headline(lines):
+    def get_headline(self):
         """Return headline and byline, consuming the lines"""
         headline, byline = [], []
         target = headline
 
-        while lines:
-            line = lines[0].strip()
+        while self.i < self.n:
+            line = self.lines[self.i].stripped
             if RES.BODY_META.match(line):
                 return None, None
             if not line:
@@ -300,19 +319,20 @@ def parse_article(art):
                 target = byline
             else:
                 target.append(line)
-            del lines[0]
-        return (re.sub("\s+", " ", " ".join(x)) if x else None
+            self.i += 1
+        return (_WHITESPACE.sub(" ", " ".join(x)) if x else None
                 for x in (headline, byline))
 
     @toolkit.wrapped(dict)
-    def _get_meta(lines):
+    def get_meta(self):
         """
         Return meta key-value pairs. Stop if body start criterion is found
         (eg two blank lines or non-meta line)
         """
-        while lines:
-            line = lines[0].strip()
-            next_line = lines[1].strip() if len(lines) >= 2 else None
+        lines, n = self.lines, self.n
+        while self.i < n:
+            line = lines[self.i].stripped
+            next_line = lines[self.i+1].stripped if self.i + 1 < n else None
 
             meta_match = RES.BODY_META.match(line)
             if ((not bool(line) and not bool(next_line))
@@ -320,37 +340,58 @@ def parse_article(art):
                 # either two blank lines or a non-meta line
                 # indicate start of body, so end of meta
                 break
-            del lines[0]
+            self.i += 1
             if meta_match:
                 key, val = meta_match.groups()
                 key = key.lower()
                 key = BODY_KEYS_MAP.get(key, key)
 
                 # multi-line meta: add following non-blank lines
-                while lines and lines[0].strip():
-                    val += " " + lines.pop(0)
-                val = re.sub("\s+", " ", val)
+                while self.i < n and lines[self.i].stripped:
+                    val += " " + lines[self.i].text
+                    self.i += 1
+                val = _WHITESPACE.sub(" ", val)
 
                 yield key, val.strip()
 
-
     @toolkit.to_list
-    def _get_body(lines):
+    def get_body(self):
         """Consume and return all lines until a date line is found"""
-
-        while lines:
-            line = lines[0].strip()
-            if RES.BODY_END.match(line) or RES.COPYRIGHT.match(line):
+        while self.i < self.n:
+            line = self.lines[self.i]
+            if RES.BODY_END.match(line.stripped) or RES.COPYRIGHT.match(line.stripped):
                 break # end of body
-            yield lines.pop(0)
+            yield line.text
+            self.i += 1
 
-    lines = _strip_article(art).split("\n")
-    header = _get_header(lines)
-    if not lines:
+_COPYRIGHT_YEAR = re.compile("Copyright \d{4}")
+_WHITESPACE = re.compile("\s+")
+
+def parse_article(art):
+    """
+    A lexis nexis article consists of five parts:
+    1) a header
+    2) the headline and possibly a byline
+    3) a block of meta fields
+    4) the body
+    5) a block of meta fields
+
+    The header consists of 'centered' lines, ie starting with a whitespace character
+    The headline (and byline) are left justified non-marked lines before the first meta field
+    The meta fields are of the form FIELDNAME: value and can contain various field names
+    The body starts after either two blank lines, or if a line is not of the meta field form.
+    The body ends with a 'load date', which is of form FIELDNAME: DATE ending with a four digit year
+
+    The article is split into lines once (see tokenize), which are then consumed by
+    an _ArticleParser.
+    """
+    parser = _ArticleParser(tokenize(art))
+    header = parser.get_header()
+    if parser.i >= parser.n:
         # Something is wrong with this article, skip it
         return
 
-
+    header_headline = parser.header_headline
     if header_headline:
         headline = re.sub("\s+", " ", " ".join(header_headline)).strip()
         if ";" in headline:
@@ -360,12 +401,12 @@ def parse_article(art):
         if re.match("[A-Z]+:", headline):
             headline = headline.split(":", 1)[1]
     else:
-        headline, byline = _get_headline(lines)
-    meta = _get_meta(lines)
-    body = _get_body(lines)
+        headline, byline = parser.get_headline()
+    meta = parser.get_meta()
+    body = parser.get_body()
 
 
-    meta.update(_get_meta(lines))
+    meta.update(parser.get_meta())
 
     date, dateline = None, None
     for i, line in enumerate(header):
@@ -443,7 +484,32 @@ def parse_article(art):
 
     return headline.strip(), byline, text, date, source, meta
 
-def body_to_article(headline, byline, text, date, source, meta):
+def _parse_article(text):
+    """Parse an article in a pool worker, returning (fields, error)"""
+    try:
+        return parse_article(text), None
+    except Exception as e:
+        return None, e
+
+def parse_articles(texts, processes=None, pool_threshold=POOL_THRESHOLD):
+    """
+    Parse the given article texts (see parse_article), distributing them over
+    worker processes if there are at least pool_threshold texts.
+
+    @param texts: a list of unicode article texts, as given by split_body
+    @param processes: the number of processes to use, default is the number of cpus
+    @return: a list of (fields, error) pairs in the order of the texts, where fields
+             is the result of parse_article and error the exception it raised, if any
+    """
+    if len(texts) < pool_threshold or processes == 1:
+        return map(_parse_article, texts)
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(_parse_article, texts, chunksize=100)
+    finally:
+        pool.terminate()
+
+def body_to_article(headline, byline, text, date, source, meta, media=None):
     """
     Create an Article-object based on given parameters. It raises an
     error (Medium.DoesNotExist) when the given source does not have
@@ -469,6 +535,10 @@ def body_to_article(headline, byline, text, date, source, meta):
                  (author, length) will be extracted.
     @type meta: dictionary
 
+    @param media: optional cache of {source : Medium} to avoid looking up the
+                  medium for every article
+    @type media: dictionary
+
     @return Article-object
 
     """
@@ -476,7 +546,12 @@ def body_to_article(headline, byline, text, date, source, meta):
 
     art = Article(headline=headline, byline=byline, text=text, date=date)
 
-    art.medium = Medium.get_or_create(source)
+    if media is None:
+        art.medium = Medium.get_or_create(source)
+    else:
+        if source not in media:
+            media[source] = Medium.get_or_create(source)
+        art.medium = media[source]
 
     # Author / Section
     meta = meta.copy()
@@ -509,12 +584,20 @@ class LexisNexis(UploadScript):
 
     name = 'Lexis Nexis'
 
-    def split_file(self, file):
+    def __init__(self, *args, **kargs):
+        super(LexisNexis, self).__init__(*args, **kargs)
+        self.media = {}
 
+    def split_file(self, file):
+        """
+        Split the file into articles and parse them (on a process pool for large files).
+        The units are the (fields, error) results of parse_articles, parse_document turns
+        them into articles in the main process.
+        """
         header, body = split_header(file.text)
         self.ln_query  = get_query(parse_header(header))
         fragments = list(split_body(body))
-        return fragments
+        return parse_articles(fragments)
 
     def get_provenance(self, file, articles):
         # FIXME: redundant double reading of file
@@ -525,25 +608,55 @@ class LexisNexis(UploadScript):
 
         return "{provenance}; LexisNexis query: {self.ln_query!r}".format(**locals())
 
-    def parse_document(self, text):
-        fields = parse_article(text)
+    def parse_document(self, parsed):
+        fields, error = parsed
+        if error is not None:
+            raise error
 
         if fields is None:
             return
 
         try:
-            a = body_to_article(*fields)
+            a = body_to_article(*fields, media=self.media)
             a.project = self.options['project']
             yield a
         except:
             log.error("Error on processing fields: {fields}".format(**locals()))
             raise
 
+def benchmark(copies=100, processes=None):
+    """
+    Measure the parsing throughput on a corpus made of copies of the test file.
+    Prints the throughput of parsing in a single process and on a pool.
+    @return: a dict of {processes : documents/sec}
+    """
+    fn = os.path.join(os.path.dirname(__file__), 'test_files', 'lexisnexis', 'test.txt')
+    header, body = split_header(open(fn).read().decode('utf-8'))
+    # concatenate the bodies of the copies, as if it were one large file
+    body = "\n".join([body] * copies)
+
+    rates = {}
+    for nproc in (1, processes or multiprocessing.cpu_count()):
+        t = time.time()
+        results = parse_articles(list(split_body(body)), processes=nproc, pool_threshold=0)
+        t = time.time() - t
+        n, rate = len(results), len(results) / t
+        errors = sum(1 for (fields, error) in results if error is not None)
+        rates[nproc] = rate
+        print("{nproc} process(es): {n} documents ({errors} errors) in {t:.2f} seconds, "
+              "{rate:.0f} documents/sec, target {target} documents/sec"
+              .format(target=BENCHMARK_TARGET * nproc, **locals()))
+    return rates
+
 from amcat.tools import amcatlogging; amcatlogging.debug_module()
 
 if __name__ == '__main__':
-    from amcat.scripts.tools import cli
-    cli.run_cli(handle_output=False)
+    import sys
+    if sys.argv[1:] == ["benchmark"]:
+        benchmark()
+    else:
+        from amcat.scripts.tools import cli
+        cli.run_cli(handle_output=False)
 
 
 
@@ -659,6 +772,25 @@ class TestLexisNexis(amcattest.AmCATTestCase):
             p.project = dp
             p.full_clean()
 
+    def test_parse_articles(self):
+        texts = list(split_body(self.split()[1]))
+        # add a document that cannot be parsed
+        texts.append("\n   No date in this header\n\nHeadline\n\nText\n")
+        expected = _parse_article(texts[0])
+        for processes in (1, 2):
+            results = parse_articles(texts, processes=processes, pool_threshold=0)
+            self.assertEqual(len(results), len(texts))
+            self.assertEqual(results[0], expected)
+            self.assertEqual([r for (r, e) in results[:-1]], [parse_article(t) for t in texts[:-1]])
+            fields, error = results[-1]
+            self.assertIsNone(fields)
+            self.assertIsInstance(error, ParseError)
+
+    def test_tokenize(self):
+        lines = tokenize("\r\n\nHeadline\r\n   indented\n\n")
+        self.assertEqual([(l.text, l.stripped, l.indented) for l in lines],
+                         [("Headline", "Headline", False), ("   indented", "indented", True)])
+
     def test_get_query(self):
         header, body =  split_header(self.test_text)
         q = get_query(parse_header(header))
@@ -86,6 +86,10 @@ class UploadScript(script.Script):
     output_type = ArticleIterator
     options_form = UploadForm
 
+    # Set to True if _scrape_unit does not depend on state of the script and the units and
+    # articles can be pickled, so units can be scraped on a process pool (see Controller)
+    parallel_parsing = False
+
     def __init__(self, *args, **kargs):
         super(UploadScript, self).__init__(*args, **kargs)
         self.project = self.options['project']
@@ -152,7 +156,7 @@ class UploadScript(script.Script):
         log.info(u"Importing {self.__class__.__name__} from {filename} into {self.project}"
                  .format(**locals()))
         from amcat.scripts.article_upload.controller import Controller
-        self.controller = Controller()
+        self.controller = Controller(monitor=self.progress_monitor)
         arts = self.controller.run(self)
 
         if not arts:
@@ -43,14 +43,10 @@ class TableToDatatable(script.Script):
 
 
     def run(self, tableObj):
-        tableData = []
-        for row in tableObj.getRows():
-            rowList = []
-            for column in tableObj.getColumns():
-                rowList.append(tableObj.getValue(row, column))
-            tableData.append(rowList)
+        columns = list(tableObj.getColumns())
+        tableData = list(tableObj.getRowValues(columns))
             
-        tableColumns = [{'sTitle':column, 'sName':column} for column in tableObj.getColumns()] 
+        tableColumns = [{'sTitle':column, 'sName':column} for column in columns] 
            
         dictObj = {}
         dictObj['aaData'] = tableData
@@ -29,7 +29,7 @@ import itertools
 import xml.sax.saxutils
 import collections
 import tempfile, os, subprocess, re
-from amcat.tools import table
+from amcat.tools import table, toolkit
 
 import logging
 log = logging.getLogger(__name__)
@@ -45,48 +45,13 @@ class ClustermapScript(script.Script):
     def run(self, articleidDict):
         allArticleids = set(itertools.chain(*articleidDict.values()))
 
-        objects = []
-        for id in allArticleids:
-            objects.append("""
-            <Object ID="%(id)s">
-             <Name>Click to View Article</Name>
-             <Location>%(id)s</Location>
-            </Object>""" % {'id':id})
-        objects = '\n'.join(objects)
-
-        classifications = []
-        for query, article_ids in articleidDict.items():
-            keywordStr = xml.sax.saxutils.escape(query)
-            keywordQuote = xml.sax.saxutils.quoteattr(query)
-            articleidStr = ' '.join(map(str, article_ids))
-            classifications.append("""
-            <Classification ID=%s>
-             <Name>%s</Name>
-             <SuperClass refs="root" />
-             <Objects objectIDs="%s" />
-            </Classification>""" % (keywordQuote, keywordStr, articleidStr))
-        classifications = '\n'.join(classifications)
-        
-        allArticleidStr = ' '.join(map(str, allArticleids))
-        clusterXml = u"""<?xml version="1.0" encoding="utf-8"?>
-        <ClassificationTree version="1.0">
-          <ObjectSet>%s</ObjectSet>
-          <ClassificationSet>
-            <Classification ID="root">
-                <Name>Root</Name><Objects objectIDs="%s" />
-            </Classification>
-            %s
-          </ClassificationSet>
-        </ClassificationTree>
-        """ % (objects, allArticleidStr, classifications)
-        
+        xmlfiledesc, xmlfilepath = tempfile.mkstemp()
+        with os.fdopen(xmlfiledesc, 'wb') as xmlfile:
+            write_cluster_xml(xmlfile, articleidDict, allArticleids)
+
         imgfiledesc, imgfilepath = tempfile.mkstemp()
         os.close(imgfiledesc)
         
-        xmlfiledesc, xmlfilepath = tempfile.mkstemp()
-        os.write(xmlfiledesc, clusterXml)
-        os.close(xmlfiledesc)
-        
         log.debug('temp files: %s and %s' % (imgfilepath, xmlfilepath))
         
         cmd = """ \
@@ -118,10 +83,67 @@ class ClustermapScript(script.Script):
         
         
         
-def increaseCounter(table, x, y):
-    table.addValue(x, y, table.getValue(x, y) + 1)
-    
-        
+# Number of article ids written per write call in write_cluster_xml
+XML_BATCH_SIZE = 10000
+
+def _write_ids(f, ids):
+    """Write the ids separated by spaces, in batches to limit memory use"""
+    for i, batch in enumerate(toolkit.splitlist(ids, itemsperbatch=XML_BATCH_SIZE)):
+        if i: f.write(" ")
+        f.write(" ".join(map(str, batch)))
+
+def write_cluster_xml(f, articleidDict, allArticleids):
+    """Write the ClusterMap classification XML for the given queries and ids to file f"""
+    f.write("""<?xml version="1.0" encoding="utf-8"?>
+        <ClassificationTree version="1.0">
+          <ObjectSet>""")
+    for id in allArticleids:
+        f.write("""
+            <Object ID="%(id)s">
+             <Name>Click to View Article</Name>
+             <Location>%(id)s</Location>
+            </Object>""" % {'id':id})
+    f.write('''</ObjectSet>
+          <ClassificationSet>
+            <Classification ID="root">
+                <Name>Root</Name><Objects objectIDs="''')
+    _write_ids(f, allArticleids)
+    f.write('''" />
+            </Classification>
+            ''')
+    for query, article_ids in articleidDict.items():
+        keywordStr = xml.sax.saxutils.escape(query)
+        keywordQuote = xml.sax.saxutils.quoteattr(query)
+        f.write((u'''
+            <Classification ID=%s>
+             <Name>%s</Name>
+             <SuperClass refs="root" />
+             <Objects objectIDs="''' % (keywordQuote, keywordStr)).encode("utf-8"))
+        _write_ids(f, article_ids)
+        f.write('''" />
+            </Classification>''')
+    f.write("""
+          </ClassificationSet>
+        </ClassificationTree>
+        """)
+
+def get_overlap_counts(idsets):
+    """
+    Count the number of ids for every combination of the given id collections that occurs
+    @param idsets: a sequence of collections of ids
+    @return: a dict of key : count, where key is a tuple with a 1 or 0 for every collection
+             indicating whether the ids are in that collection
+    """
+    # code every id with a bit per collection that contains it, and count the codes
+    codes = collections.defaultdict(int)
+    for i, ids in enumerate(idsets):
+        bit = 1 << i
+        for id in ids:
+            codes[id] |= bit
+    counts = collections.Counter(codes.itervalues())
+    keys = {code: tuple((code >> i) & 1 for i in range(len(idsets))) for code in counts}
+    return collections.OrderedDict(sorted(((keys[code], n) for (code, n) in counts.iteritems()), reverse=True))
+
 class ClustermapTableScript(script.Script):
     """creates a clustermap as table"""
     
@@ -132,22 +154,14 @@ class ClustermapTableScript(script.Script):
     def run(self, articleidDict):
         if len(articleidDict.keys()) < 2:
             raise Exception('Needs at least two queries')
-        
-        allArticleids = set(itertools.chain(*articleidDict.values()))
-        counterDict = collections.defaultdict(lambda:0)
-        for aid in allArticleids:
-            key = []
-            for query, article_ids in articleidDict.items():
-                if aid in article_ids:
-                    key.append(1)
-                else:
-                    key.append(0)
-            counterDict[tuple(key)] += 1
+
+        queries = articleidDict.keys()
+        counterDict = get_overlap_counts([articleidDict[q] for q in queries])
         
         resultTable = table.table3.DictTable('')#table3.Table(columns=articleidDict.keys() + ['total'])
         i = 0
         for key, total in counterDict.items():
-            for val, query in zip(key, articleidDict.keys()):
+            for val, query in zip(key, queries):
                 resultTable.addValue(i, query, val)
             resultTable.addValue(i, '[total]', total)
             i += 1
@@ -156,3 +170,30 @@ class ClustermapTableScript(script.Script):
 if __name__ == '__main__':
     from amcat.scripts.tools import cli
     cli.run_cli(ClustermapScript)
+
+###########################################################################
+#                          U N I T   T E S T S                            #
+###########################################################################
+
+from amcat.tools import amcattest
+
+class TestClustermap(amcattest.AmCATTestCase):
+    def test_overlap_counts(self):
+        counts = get_overlap_counts([[1, 2, 3], {2, 3, 4}, [3, 3, 5]])
+        self.assertEqual(dict(counts), {(1, 0, 0): 1, (1, 1, 0): 1, (1, 1, 1): 1,
+                                        (0, 1, 0): 1, (0, 0, 1): 1})
+        self.assertEqual(dict(get_overlap_counts([[], []])), {})
+
+    def test_sparse_ids(self):
+        """Large ids should not cost memory or time proportional to their value"""
+        import random
+        rnd = random.Random(1)
+        idsets = [rnd.sample(xrange(90000000, 100000000), 5000) for _i in range(8)]
+        idsets.append([2**62, 2**62 + 1])
+        counts = get_overlap_counts(idsets)
+
+        expected = collections.Counter(tuple(int(id in ids) for ids in map(set, idsets))
+                                       for id in set(itertools.chain(*idsets)))
+        self.assertEqual(dict(counts), dict(expected))
+        self.assertEqual(counts[(0,) * 8 + (1,)], 2)
+        self.assertEqual(sum(counts.values()), len(set(itertools.chain(*idsets))))
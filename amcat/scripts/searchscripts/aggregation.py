@@ -35,6 +35,7 @@ from amcat.tools import keywordsearch
 from django.db import connections
 
 import datetime
+from itertools import izip
 
 class AggregationForm(amcat.scripts.forms.SelectionForm):
     """the form used by the Aggregation script"""
@@ -95,7 +96,15 @@ class RelativeTable(table3.WrappedTable):
         val = self.table.getValue(row, column)
         if val == 0: return val
         total = self.table.getValue(row, total_col)
-        return float(val) / total if total else None
+        return _relative(val, total)
+    def getColumnValues(self, column):
+        total_col = list(self.table.getColumns())[0]
+        totals = self.table.getColumnValues(total_col)
+        return [_relative(val, total) for (val, total) in izip(self.table.getColumnValues(column), totals)]
+
+def _relative(val, total):
+    if val == 0: return val
+    return float(val) / total if total else None
 
 class FilledOutTable(table3.WrappedTable):
     def getRows(self):
@@ -22,6 +22,8 @@ Script that will run a search on the database or the index and return the matchi
 """
 
 
+import itertools
+
 from amcat.scripts import script, types
 from amcat.scripts.tools import database
 from amcat.forms.forms import order_fields
@@ -34,6 +36,9 @@ from django import forms
 import logging
 log = logging.getLogger(__name__)
 
+# Above this length, results are streamed using a scroll cursor instead of fetched as one page
+STREAM_LENGTH = 10000
+
 @order_fields(classes=(amcat.scripts.forms.SelectionForm, amcat.scripts.forms.ArticleColumnsForm))
 class ArticleListForm(amcat.scripts.forms.ArticleColumnsForm, amcat.scripts.forms.SelectionForm):
     start = forms.IntegerField(initial=0, min_value=0, widget=forms.HiddenInput, required=False)
@@ -93,7 +98,11 @@ class ArticleListScript(script.Script):
         if not self.options['sortColumn']:
             self.options['sortColumn'] = 'id'
 
-        return keywordsearch.getArticles(self.options, from_=start)
+        if length > STREAM_LENGTH:
+            articles = keywordsearch.getArticles(self.options, stream=True)
+            return itertools.islice(articles, start, start + length)
+
+        return keywordsearch.getArticles(self.options, from_=start, size=length)
 
 if __name__ == '__main__':
     from amcat.scripts.tools import cli
@@ -24,7 +24,12 @@ log = logging.getLogger(__name__)
 import re
 import requests
 import collections
+import threading
+import time
+from array import array
+from Queue import Queue, Empty, Full
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
 from hashlib import sha224 as hash_class
 from json import dumps as serialize
@@ -32,11 +37,38 @@ from json import dumps as serialize
 from amcat.tools import queryparser, toolkit
 from amcat.tools.toolkit import multidict, splitlist
 from elasticsearch import Elasticsearch, connection
+from elasticsearch.exceptions import ConnectionError, TransportError
 from elasticsearch.client import indices, cluster
 from django.conf import settings
-from amcat.tools.caching import cached
+from django.core.cache import cache
+from amcat.tools.caching import cached, LRUCache
 from amcat.tools.progress import NullMonitor
 
+# Number of independent scan cursors used by query_ids(slices=None)
+QUERY_IDS_SLICES = getattr(settings, 'ES_QUERY_IDS_SLICES', 4)
+# Maximum number of id batches buffered between the scan workers and the consumer
+QUERY_IDS_QUEUE_SIZE = 16
+
+# Limits on the size of a single bulk request, see BulkIndexer
+BULK_MAX_BYTES = getattr(settings, 'ES_BULK_MAX_BYTES', 10 * 1024 * 1024)
+BULK_MAX_DOCS = getattr(settings, 'ES_BULK_MAX_DOCS', 1000)
+BULK_MAX_RETRIES = 5
+
+# Number of articles per bulk request in ES.add_to_set and ES.remove_from_set
+SET_UPDATE_BATCH_SIZE = getattr(settings, 'ES_SET_UPDATE_BATCH_SIZE', 1000)
+
+# Number of hashes per request in ES.lookup_hashes
+HASH_LOOKUP_SIZE = getattr(settings, 'ES_HASH_LOOKUP_SIZE', 1000)
+
+# Cache for the results of count, aggregate_query and statistics, see ES._cached
+RESULT_CACHE = LRUCache(size=getattr(settings, 'ES_RESULT_CACHE_SIZE', 1000),
+                        ttl=getattr(settings, 'ES_RESULT_CACHE_TTL', 3600))
+GENERATION_KEY = "amcates_generation_{index}_{setid}"
+ALL_SETS = "all"
+# Generation of the index itself, which is part of every cache key and only changes
+# when the index is deleted or created
+WHOLE_INDEX = "index"
+
 def _clean(s):
     if s: return re.sub('[\x00-\x08\x0B\x0C\x0E-\x1F]', ' ', s)
 
@@ -92,6 +124,54 @@ UPDATE_SCRIPT_ADD_TO_SET = 'if (!(ctx._source.sets contains set)) {ctx._source.s
 UPDATE_SCRIPT_ADD_TO_SET = ("if (ctx._source.sets == null) {ctx._source.sets = [set]} "
                             "else { if (!(ctx._source.sets contains set)) {ctx._source.sets += set}}")
 
+def _new_generation():
+    return int(time.time() * 1000000)
+
+def get_generations(index, setids):
+    """
+    Return a dict of generation numbers per set id. The generation of a set is
+    changed whenever articles in that set are changed in the index (see
+    bump_generations), so cached results for the set can be recognised as stale.
+    """
+    keys = {GENERATION_KEY.format(index=index, setid=setid) : setid for setid in setids}
+    result = cache.get_many(keys.keys())
+    for key in set(keys) - set(result):
+        cache.add(key, _new_generation())
+        result[key] = cache.get(key) or _new_generation()
+    return {keys[key] : generation for (key, generation) in result.iteritems()}
+
+def bump_generations(index, setids, whole_index=False):
+    """
+    Change the generation of the given sets and of all sets together, to
+    invalidate cached results. The index should be refreshed before calling this,
+    otherwise results computed on the old state can be cached under the new generation.
+    @param whole_index: also change the generation of the index itself, which
+                        invalidates all cached results for the index
+    """
+    setids = set(setids) | {ALL_SETS}
+    if whole_index:
+        setids.add(WHOLE_INDEX)
+    for setid in setids:
+        key = GENERATION_KEY.format(**locals())
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _new_generation())
+
+def _get_filter_sets(dsl):
+    """Return the set ids that are used in 'sets' terms filters in the given DSL"""
+    if isinstance(dsl, dict):
+        if 'terms' in dsl and 'sets' in dsl['terms']:
+            for setid in dsl['terms']['sets']:
+                yield setid
+        for value in dsl.itervalues():
+            for setid in _get_filter_sets(value):
+                yield setid
+    elif isinstance(dsl, list):
+        for value in dsl:
+            for setid in _get_filter_sets(value):
+                yield setid
+
 class SearchResult(object):
     """Iterable collection of results that also has total"""
     def __init__(self, results, fields, score, body):
@@ -106,7 +186,17 @@ class SearchResult(object):
     @property
     @cached
     def results(self):
-        return [Result.from_hit(h, self.fields, self.score) for h in self.hits]
+        return get_rows(self.columns, len(self.hits))
+
+    @property
+    @cached
+    def columns(self):
+        """
+        The results in columnar form: a dict of field name to a list of values (one per hit).
+        The id column is an array of longs, dates are parsed in bulk, and the 'score' and
+        'highlight' columns are only present if there are scores or highlights.
+        """
+        return get_columns(self.hits, self.fields, self.score)
 
     def __len__(self):
         return len(self.hits)
@@ -119,8 +209,133 @@ class SearchResult(object):
 
     def as_dicts(self):
         "Return the results as fieldname : value dicts"
-        return [r.__dict__ for r in self]
+        return [r.as_dict() for r in self]
+
+def _parse_date(s):
+    """Parse an elastic date (yyyy-mm-dd or yyyy-mm-ddThh:mm:ss[...]) without strptime"""
+    if s is None:
+        return None
+    if len(s) == 10:
+        return datetime(int(s[:4]), int(s[5:7]), int(s[8:10]))
+    return datetime(int(s[:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19]))
+
+def parse_dates(values):
+    """
+    Parse a sequence of elastic date strings into a list of datetimes. Each distinct
+    string is only parsed once, which helps as many articles share a date.
+    """
+    parsed = {}
+    result = []
+    for value in values:
+        try:
+            date = parsed[value]
+        except KeyError:
+            date = parsed[value] = _parse_date(value)
+        result.append(date)
+    return result
 
+def get_columns(hits, fields, score=True):
+    """
+    Convert raw elastic hits into columns, see SearchResult.columns
+    @param fields: the requested fields; other fields present in the hits (eg lead) are also included
+    """
+    names = list(fields)
+    seen = set(names)
+    for hit in hits:
+        for k in hit.get('fields', ()):
+            if k not in seen:
+                seen.add(k)
+                names.append(k)
+
+    columns = collections.OrderedDict()
+    columns['id'] = array(b'l', (int(hit['_id']) for hit in hits))
+    for name in names:
+        values = [hit['fields'].get(name) if 'fields' in hit else None for hit in hits]
+        if name != "sets":
+            # elastic 1.0 always returns arrays, we only want
+            # sets in a list, the rest should be 'scalarized'
+            values = [v[0] if isinstance(v, list) else v for v in values]
+        columns[name] = values
+    if 'date' in columns:
+        columns['date'] = parse_dates(columns['date'])
+    if score:
+        columns['score'] = [int(hit['_score']) for hit in hits]
+    if any('highlight' in hit for hit in hits):
+        columns['highlight'] = [hit.get('highlight') for hit in hits]
+    return columns
+
+def get_rows(columns, n):
+    """
+    Convert columns (see get_columns) into a list of n result rows. The rows are
+    instances of a class with __slots__ for the column names, see get_row_class.
+    Like Result, score and highlight are only set if they were retrieved.
+    """
+    optional = [c for c in ("score", "highlight") if c in columns]
+    names = [c for c in columns if c not in optional]
+    cls = get_row_class(names)
+    rows = [cls.__new__(cls) for _i in xrange(n)]
+    for name, values in columns.iteritems():
+        for row, value in zip(rows, values):
+            if value is not None or name not in optional:
+                setattr(row, name, value)
+    return rows
+
+_ROW_CLASSES = {}
+
+def get_row_class(fields):
+    """
+    Return the result row class for the given fields, creating it if needed. The class
+    has __slots__ for id, the fields, and the optional score, highlight and hits attributes.
+    """
+    fields = tuple(fields)
+    try:
+        return _ROW_CLASSES[fields]
+    except KeyError:
+        slots = tuple(collections.OrderedDict.fromkeys(("id",) + fields + ResultRow.optional))
+        cls = type(str("ResultRow"), (ResultRow,), {"__slots__" : slots, "fields" : fields})
+        _ROW_CLASSES[fields] = cls
+        return cls
+
+def _make_row(fields, values):
+    """Unpickle helper for ResultRow"""
+    row = get_row_class(fields).__new__(get_row_class(fields))
+    for k, v in values.iteritems():
+        setattr(row, k, v)
+    return row
+
+class ResultRow(object):
+    """
+    Compact result row with attributes for the retrieved fields, see get_row_class.
+    Unlike Result, rows cannot hold arbitrary attributes.
+    """
+    __slots__ = ()
+    fields = ()
+    # attributes that are only set when available (hits is set by keywordsearch)
+    optional = ("score", "highlight", "hits")
+
+    def __init__(self, **kwargs):
+        for f in self.fields:
+            setattr(self, f, None)
+        for k, v in kwargs.iteritems():
+            setattr(self, k, v)
+
+    def as_dict(self):
+        "Return the attributes that are set as a fieldname : value dict"
+        return {k : getattr(self, k) for k in self.__slots__ if hasattr(self, k)}
+
+    def __reduce__(self):
+        return _make_row, (self.fields, self.as_dict())
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.as_dict() == other.as_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        d = self.as_dict()
+        items = ("{}={!r}".format(k, d[k]) for k in sorted(d))
+        return "{}({})".format(type(self).__name__, ", ".join(items))
 
 class Result(object):
     """Simple class to hold arbitrary values"""
@@ -133,7 +348,7 @@ class Result(object):
                 if k != "sets":
                     # elastic 1.0 always returns arrays, we only want
                     # sets in a list, the rest should be 'scalarized'
-                    if isinstance(k, list):
+                    if isinstance(v, list):
                         v = v[0]
                 field_dict[k] = v
 
@@ -141,19 +356,199 @@ class Result(object):
         if score: result.score = int(row['_score'])
         if 'highlight' in row: result.highlight = row['highlight']
         if hasattr(result, 'date'):
-            if len(result.date) == 10:
-                result.date = datetime.strptime(result.date, '%Y-%m-%d')
-            else:
-                result.date = datetime.strptime(result.date[:19], '%Y-%m-%dT%H:%M:%S')
+            result.date = _parse_date(result.date)
         return result
 
     def __init__(self, **kwargs):
         self.__dict__.update(kwargs)
+    def as_dict(self):
+        "Return the attributes as a fieldname : value dict"
+        return self.__dict__
     def __repr__(self):
         keys = sorted(self.__dict__)
         items = ("{}={!r}".format(k, self.__dict__[k]) for k in keys)
         return "{}({})".format(type(self).__name__, ", ".join(items))
 
+class BulkIndexer(object):
+    """
+    Pipelined bulk indexer. Article dicts are added from the calling thread (which
+    typically fetches them from the database), serialised in a second thread, and
+    sent to elastic in a third thread. The threads are connected by bounded
+    queues, so memory use is limited to a few bulk requests.
+
+    Requests are limited to max_bytes and max_docs. Documents that fail with a
+    retryable status (429 or 5xx) are retried with exponential backoff; the ids of
+    documents that still fail are collected in .failed.
+
+    Use as a context manager, or call close() when done:
+
+    with BulkIndexer(ES(), total=len(dicts)) as indexer:
+        indexer.add(dicts)
+    """
+    _DONE = object()
+
+    def __init__(self, es, max_bytes=BULK_MAX_BYTES, max_docs=BULK_MAX_DOCS, max_retries=BULK_MAX_RETRIES,
+                 backoff=0.5, queue_size=4, monitor=NullMonitor(), total=None, progress_units=0):
+        """
+        @param es: the ES object to index into
+        @param total: the expected number of documents (if known), used for progress reporting
+        @param progress_units: the number of units to report on monitor for indexing all documents
+        """
+        self.es = es
+        self.max_bytes, self.max_docs = max_bytes, max_docs
+        self.max_retries, self.backoff = max_retries, backoff
+        self.monitor, self.total, self.progress_units = monitor, total, progress_units
+
+        self.docs, self.bytes, self.failed = 0, 0, []
+        self._sets = set()
+        self._abort = threading.Event()
+        self._errors = []
+        self._dicts = Queue(maxsize=queue_size)
+        self._chunks = Queue(maxsize=queue_size)
+        self._threads = [threading.Thread(target=self._run_stage, args=(self._serialize,)),
+                         threading.Thread(target=self._run_stage, args=(self._submit,))]
+        self._start = time.time()
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._abort.set()
+            self._join()
+
+    def add(self, dicts):
+        """
+        Queue the given article dicts for indexing. If dicts is a generator, it will
+        be consumed in the serialisation thread.
+        """
+        self._put(self._dicts, dicts)
+        self._check_errors()
+
+    def close(self):
+        """Wait for all queued documents to be indexed"""
+        self._put(self._dicts, self._DONE)
+        self._join()
+        self._check_errors()
+        if self.failed:
+            log.error("Could not index {n} articles, e.g. {ids}"
+                      .format(n=len(self.failed), ids=self.failed[:10]))
+
+    @property
+    def rates(self):
+        """Return the throughput so far as (docs/sec, bytes/sec)"""
+        elapsed = max(time.time() - self._start, 1e-6)
+        return self.docs / elapsed, self.bytes / elapsed
+
+    def _join(self):
+        for thread in self._threads:
+            thread.join()
+        self.es.refresh()
+        bump_generations(self.es.index, self._sets)
+
+    def _check_errors(self):
+        if self._errors:
+            raise self._errors[0]
+
+    def _put(self, queue, item):
+        while not self._abort.is_set():
+            try:
+                queue.put(item, timeout=.1)
+                return
+            except Full:
+                pass
+
+    def _get(self, queue):
+        while not self._abort.is_set():
+            try:
+                return queue.get(timeout=.1)
+            except Empty:
+                pass
+        return self._DONE
+
+    def _run_stage(self, stage):
+        try:
+            stage()
+        except Exception as e:
+            log.exception("Error in bulk indexer")
+            self._errors.append(e)
+            self._abort.set()
+
+    def _serialize(self):
+        """Stage 2: serialise the article dicts and split them into requests"""
+        chunk, nbytes = [], 0
+        while True:
+            dicts = self._get(self._dicts)
+            if dicts is self._DONE:
+                break
+            for article_dict in dicts:
+                lines = serialize(dict(index={'_id' : article_dict['id']})) + "\n" + serialize(article_dict) + "\n"
+                lines = lines.encode("utf-8")
+                if chunk and (nbytes + len(lines) > self.max_bytes or len(chunk) >= self.max_docs):
+                    self._put(self._chunks, chunk)
+                    chunk, nbytes = [], 0
+                chunk.append((article_dict['id'], lines))
+                nbytes += len(lines)
+                self._sets.update(article_dict.get('sets') or [])
+        if chunk:
+            self._put(self._chunks, chunk)
+        self._put(self._chunks, self._DONE)
+
+    def _submit(self):
+        """Stage 3: send the requests to elastic"""
+        while True:
+            chunk = self._get(self._chunks)
+            if chunk is self._DONE:
+                break
+            self._submit_chunk(chunk)
+            self.docs += len(chunk)
+            self.bytes += sum(len(lines) for (_id, lines) in chunk)
+
+            dps, bps = self.rates
+            units = (float(self.progress_units) * len(chunk) / self.total) if self.total else 0
+            self.monitor.update(units, "Indexed {self.docs}/{total} articles ({dps:.0f} docs/sec, {kbps:.0f} KB/sec)"
+                                .format(total=self.total or "?", kbps=bps / 1024, **locals()))
+
+    def _submit_chunk(self, chunk):
+        """Send a single bulk request, retrying failed documents"""
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                result = self.es.es.bulk(body=b"".join(lines for (_id, lines) in chunk),
+                                         index=self.es.index, doc_type=self.es.doc_type)
+            except (ConnectionError, TransportError) as e:
+                status = getattr(e, 'status_code', None)
+                if attempt == self.max_retries or not _retryable(status):
+                    raise
+                log.warning("Bulk request failed ({e}), retrying".format(**locals()))
+                continue
+
+            retry = []
+            for (aid, lines), item in zip(chunk, result['items']):
+                item = item.get('index', item)
+                status = item.get('status', 200)
+                if status < 300:
+                    continue
+                if _retryable(status) and attempt < self.max_retries:
+                    retry.append((aid, lines))
+                else:
+                    log.warning("Could not index article {aid}: {error}".format(error=item.get('error'), **locals()))
+                    self.failed.append(aid)
+            if not retry:
+                return
+            log.warning("Retrying {n} of {m} documents".format(n=len(retry), m=len(chunk)))
+            chunk = retry
+
+def _retryable(status):
+    """Is it worth retrying a request or document that failed with this http status?"""
+    return not isinstance(status, int) or status == 429 or status >= 500
+
 class ES(object):
     def __init__(self, index=None, doc_type=None, **args):
         elhost = {"host":settings.ES_HOST, "port":settings.ES_PORT}
@@ -164,8 +559,12 @@ class ES(object):
     def flush(self):
         indices.IndicesClient(self.es).flush()
 
+    def refresh(self):
+        """Make all changes to the index visible to searches"""
+        indices.IndicesClient(self.es).refresh(self.index)
+
     def highlight_article(self, aid, query):
-        query = queryparser.parse_to_terms(query).get_dsl()
+        query = queryparser.get_dsl(query)
 
         highlight_opts = {"highlight_query" : query, "number_of_fragments": 0}
         body = dict(filter=build_filter(ids=aid),
@@ -185,14 +584,17 @@ class ES(object):
         try:
             indices.IndicesClient(self.es).delete(self.index)
         except Exception, e:
-            if 'IndexMissingException' in unicode(e): return
-            raise
+            if 'IndexMissingException' not in unicode(e):
+                raise
+        RESULT_CACHE.clear()
+        bump_generations(self.index, [], whole_index=True)
 
     def create_index(self):
         body = {
             "settings" : settings.ES_SETTINGS,
             "mappings" : {settings.ES_ARTICLE_DOCTYPE : settings.ES_MAPPING}}
         indices.IndicesClient(self.es).create(self.index, body)
+        bump_generations(self.index, [], whole_index=True)
 
     def check_index(self):
         """
@@ -225,27 +627,139 @@ class ES(object):
         return self.es.search(body=body, **kargs)
 
 
-    def query_ids(self, query=None, filters={}, **kwargs):
+    def query_ids(self, query=None, filters={}, slices=1, **kwargs):
         """
         Query the index returning a sequence of article ids for the mathced articles
         @param query: a elastic query string (i.e. lucene syntax, e.g. 'piet AND (ja* OR klaas)')
         @param filter: field filter DSL query dict
         @param filters: if filter is None, build filter from filters as accepted by build_query, e.g. sets=12345
+        @param slices: split the scan into this many id ranges that are scrolled in parallel.
+                       If None, use settings.ES_QUERY_IDS_SLICES. Ids are then yielded in no
+                       particular order.
         Note that query and filters can be combined in a single call
         """
         body = dict(build_body(query, filters, query_as_filter=True))
-        log.debug("Query_ids body={body!r}".format(**locals()))
+        log.debug("Query_ids body={body!r}, slices={slices}".format(**locals()))
+        if slices is None:
+            slices = QUERY_IDS_SLICES
+        if slices > 1:
+            batches = self._scan_ids_sliced(body, slices, **kwargs)
+        else:
+            batches = self._scan_ids(body, **kwargs)
+        for batch in batches:
+            for aid in batch:
+                yield aid
+
+    def query_ids_array(self, query=None, filters={}, slices=None, **kwargs):
+        """
+        Like query_ids, but return the ids as a compact integer array rather than
+        a sequence of python ints. Uses parallel scans by default, so the ids are
+        in no particular order.
+        @rtype: array.array
+        """
+        if slices is None:
+            slices = QUERY_IDS_SLICES
+        body = dict(build_body(query, filters, query_as_filter=True))
+        result = array(b'l')
+        for batch in self._scan_ids_sliced(body, slices, **kwargs):
+            result.extend(batch)
+        return result
+
+    def lookup_hashes(self, hashes, fields=["hash", "sets"], chunk_size=HASH_LOOKUP_SIZE):
+        """
+        Find the articles with the given hashes. Hashes are looked up chunk_size at a
+        time, and every matching article is retrieved regardless of the page size.
+        @return: a dict of hash : result row (with the requested fields)
+        """
+        fields = list(fields)
+        if "hash" not in fields:
+            fields.append("hash")
+        result = {}
+        for chunk in splitlist(sorted(set(hashes)), chunk_size):
+            for row in self.query_iter(filters={'hashes' : chunk}, fields=fields, score=False,
+                                       size=chunk_size):
+                result[row.hash] = row
+        return result
+
+    def _scan_ids(self, body, **kwargs):
+        """
+        Walk a single scan/scroll cursor over the given body, yielding a list of ids per page
+        """
         options = dict(scroll="1m", size=1000, fields="")
         options.update(kwargs)
-        res = self.search(body, search_type='scan', **options)
-        sid = res['_scroll_id']
-        while True:
-            res = self.es.scroll(scroll_id=sid, scroll="1m")
-            if not res['hits']['hits']:
-                break
-            for row in res['hits']['hits']:
-                yield int(row['_id'])
-            sid = res['_scroll_id']
+        pages = self._scroll(body, scan=True, **options)
+        try:
+            for hits in pages:
+                yield [int(row['_id']) for row in hits]
+        finally:
+            pages.close() # clears the scroll context if we are closed early
+
+    def _get_id_slices(self, body, slices):
+        """
+        Split the id range of the documents matching body into (at most) slices
+        half-open [start, end) intervals
+        """
+        stats_body = {"query" : {"constant_score" : body}} if body else {}
+        stats_body['facets'] = {'ids' : {'statistical' : {'field' : 'id'}}}
+        stats = self.search(stats_body, size=0)['facets']['ids']
+        if not stats['count']:
+            return []
+        start, end = int(stats['min']), int(stats['max']) + 1
+        step = max(1, -(-(end - start) // slices)) # ceil division
+        return [(i, min(i + step, end)) for i in range(start, end, step)]
+
+    def _scan_ids_sliced(self, body, slices, **kwargs):
+        """
+        Scan the ids matching body using parallel cursors on disjoint id ranges.
+        Workers put pages of ids on a bounded queue, so memory use does not depend
+        on the number of hits and the consumer can start before all scans are done.
+        """
+        ranges = self._get_id_slices(body, slices)
+        if not ranges:
+            return
+        queue = Queue(maxsize=QUERY_IDS_QUEUE_SIZE)
+        done = object()
+        stop = threading.Event()
+
+        def scan(id_range):
+            batches = None
+            try:
+                start, end = id_range
+                id_filter = {'range' : {'id' : {'gte' : start, 'lt' : end}}}
+                slice_body = dict(body)
+                slice_body['filter'] = combine_filters(filter(None, [body.get('filter'), id_filter]))
+                batches = self._scan_ids(slice_body, **kwargs)
+                for batch in batches:
+                    if stop.is_set():
+                        break
+                    queue.put(batch)
+            except Exception as e:
+                queue.put(e)
+            finally:
+                # clear the scroll context of this slice, also if the consumer stopped early
+                if batches is not None:
+                    batches.close()
+                queue.put(done)
+
+        pool = ThreadPool(len(ranges))
+        running = len(ranges)
+        try:
+            pool.map_async(scan, ranges)
+            while running:
+                batch = queue.get()
+                if batch is done:
+                    running -= 1
+                elif isinstance(batch, Exception):
+                    raise batch
+                else:
+                    yield batch
+        finally:
+            # make sure workers blocked on a full queue can finish
+            stop.set()
+            while running:
+                if queue.get() is done:
+                    running -= 1
+            pool.close()
 
     def query(self, query=None, filters={}, highlight=False, lead=False, fields=[], score=True, **kwargs):
         """
@@ -255,82 +769,163 @@ class ES(object):
         @param kwargs: additional keyword arguments to pass to es.search, eg fields, sort, from_, etc
         @return: a list of named tuples containing id, score, and the requested fields
         """
+        body = self._get_query_body(query, filters, highlight, lead, score, sort=bool(kwargs.get('sort')))
+        log.debug("es.search(body={body}, **{kwargs})".format(**locals()))
+        result = self.search(body, fields=fields, **kwargs)
+        return SearchResult(result, fields, score, body)
+
+    def query_iter(self, query=None, filters={}, highlight=False, lead=False, fields=[], score=True,
+                   size=1000, scroll="1m", **kwargs):
+        """
+        Execute a query like query(), but iterate over all results using a scroll cursor.
+        Results are retrieved size hits at a time and yielded as they come in, so memory
+        use does not depend on the number of hits.
+        @param kwargs: additional keyword arguments to pass to es.search, eg sort
+        @return: a generator of Result objects
+        """
+        body = self._get_query_body(query, filters, highlight, lead, score, sort=bool(kwargs.get('sort')))
+        for hits in self._scroll(body, fields=fields, size=size, scroll=scroll,
+                                 scan=not (score or highlight or kwargs.get('sort')), **kwargs):
+            for row in get_rows(get_columns(hits, fields, score), len(hits)):
+                yield row
+
+    def query_all(self, query=None, filters={}, highlight=False, lead=False, fields=[], score=True, **kwargs):
+        """
+        Execute a query like query(), but retrieve all results using a scroll cursor. A scan
+        is used if no scores, highlighting or sorting are needed.
+        @param kwargs: additional keyword arguments to pass to es.search, eg sort, size (per page)
+        @return: a SearchResult containing all hits. Use query_iter to avoid keeping
+                 all results in memory.
+        """
+        kwargs.pop("from_", None)
+        kwargs.setdefault('size', 10000)
+        body = self._get_query_body(query, filters, highlight, lead, score, sort=bool(kwargs.get('sort')))
+        hits = []
+        for page in self._scroll(body, fields=fields, scan=not (score or highlight or kwargs.get('sort')),
+                                 **kwargs):
+            hits += page
+        return SearchResult({'hits' : {'hits' : hits, 'total' : len(hits)}}, fields, score, body)
+
+    def _get_query_body(self, query, filters, highlight, lead, score, sort=False):
+        """Build the search body for query/query_iter/query_all"""
         body = dict(build_body(query, filters, query_as_filter=(not (highlight or score))))
         if (highlight and not score):
             body['query'] = {'constant_score' : {'query' : body['query']}}
 
-        if 'sort' in kwargs: body['track_scores'] = True
+        if sort: body['track_scores'] = True
         if highlight:
             if isinstance(highlight, dict):
                 body['highlight'] = highlight
             else:
                 body['highlight'] = HIGHLIGHT_OPTIONS
         if lead: body['script_fields'] = LEAD_SCRIPT_FIELD
+        return body
 
-        log.debug("es.search(body={body}, **{kwargs})".format(**locals()))
-        result = self.search(body, fields=fields, **kwargs)
-        return SearchResult(result, fields, score, body)
-
-    def query_all(self, *args, **kargs):
-        kargs.update({"from_" : 0})
-        size = kargs.setdefault('size', 10000)
-        result = self.query(*args, **kargs)
-        total = result.total
-        for offset in range(size, total, size):
-            kargs['from_'] = offset
-            result2 = self.query(*args, **kargs)
-            result.hits += result2.hits
-
-        return result
-
+    def _scroll(self, body, scroll="1m", scan=False, **options):
+        """
+        Walk a scroll cursor over the results of body, yielding a list of raw hits per page.
+        The scroll context is cleared when the generator is exhausted or closed, so consumers
+        that stop early do not keep it open on the server until the scroll timeout.
+        @param scan: use search_type=scan, which is faster but does not support sorting or scores
+        """
+        if scan:
+            options['search_type'] = 'scan'
+        log.debug("es.search(body={body}, scroll={scroll}, **{options})".format(**locals()))
+        res = self.search(body, scroll=scroll, **options)
+        scroll_id = res['_scroll_id']
+        try:
+            if not scan: # a scan request only returns the scroll id
+                if not res['hits']['hits']:
+                    return
+                yield res['hits']['hits']
+            while True:
+                res = self.es.scroll(scroll_id=scroll_id, scroll=scroll)
+                scroll_id = res['_scroll_id']
+                if not res['hits']['hits']:
+                    break
+                yield res['hits']['hits']
+        finally:
+            self._clear_scroll(scroll_id)
+
+    def _clear_scroll(self, scroll_id):
+        """Release a scroll context, ignoring contexts that were already released or expired"""
+        try:
+            self.es.clear_scroll(scroll_id=scroll_id)
+        except TransportError as e:
+            log.debug("Could not clear scroll {scroll_id}: {e}".format(**locals()))
 
-    def add_articles(self, article_ids, batch_size = 1000):
+    def add_articles(self, article_ids, batch_size = 1000, monitor=NullMonitor()):
         """
         Add the given article_ids to the index. This is done in batches, so there
         is no limit on the length of article_ids (which can be a generator).
+        Articles are fetched from the database while earlier batches are being
+        serialised and sent to elastic, see BulkIndexer.
         """
         if not article_ids: return
         from amcat.models import Article, ArticleSetArticle
-        n = len(article_ids) / batch_size
-        for i, batch in enumerate(splitlist(article_ids, itemsperbatch=batch_size)):
-            log.info("Adding batch {i}/{n}".format(**locals()))
-            all_sets = multidict((aa.article_id, aa.articleset_id)
-                                 for aa in ArticleSetArticle.objects.filter(article__in=batch))
-            dicts = (get_article_dict(article, list(all_sets.get(article.id, [])))
-                     for article in Article.objects.filter(pk__in=batch))
-            self.bulk_insert(dicts)
-
-    def remove_from_set(self, setid, article_ids, flush=True):
+        total = len(article_ids) if hasattr(article_ids, '__len__') else None
+        n = "?" if total is None else total / batch_size
+        with BulkIndexer(self, monitor=monitor, total=total) as indexer:
+            for i, batch in enumerate(splitlist(article_ids, itemsperbatch=batch_size)):
+                log.info("Adding batch {i}/{n}".format(**locals()))
+                all_sets = multidict(ArticleSetArticle.objects.filter(article__in=batch)
+                                     .values_list("article_id", "articleset_id"))
+                articles = list(Article.objects.filter(pk__in=batch).select_related("medium"))
+                indexer.add(_get_article_dicts(articles, all_sets))
+        dps, bps = indexer.rates
+        log.info("Indexed {indexer.docs} articles, {dps:.0f} docs/sec, {kbps:.0f} KB/sec"
+                 .format(kbps=bps / 1024, **locals()))
+
+    def remove_from_set(self, setid, article_ids, flush=True, monitor=NullMonitor()):
         """Remove the given articles from the given set. This is done in batches, so there
-        is no limit on the length of article_ids (which can be a generator)."""
-        if not article_ids: return
-        for batch in splitlist(article_ids, itemsperbatch=1000):
-            self.bulk_update(batch, UPDATE_SCRIPT_REMOVE_FROM_SET, params={'set' : setid})
+        is no limit on the length of article_ids (which can be a generator).
+        @return: the number of articles that were updated"""
+        return self._update_set(setid, article_ids, UPDATE_SCRIPT_REMOVE_FROM_SET,
+                                monitor=monitor, message="Removed")
 
     def add_to_set(self, setid, article_ids, monitor=NullMonitor()):
         """Add the given articles to the given set. This is done in batches, so there
-        is no limit on the length of article_ids (which can be a generator)."""
-        if not article_ids: return
-        batches = list(splitlist(article_ids, itemsperbatch=1000))
-        nbatches = len(batches)
-        for i, batch in enumerate(batches):
-            monitor.update(40/nbatches, "Added batch {i}/{nbatches}".format(**locals()))
-            self.bulk_update(article_ids, UPDATE_SCRIPT_ADD_TO_SET, params={'set' : setid})
+        is no limit on the length of article_ids (which can be a generator).
+        @return: the number of articles that were updated"""
+        return self._update_set(setid, article_ids, UPDATE_SCRIPT_ADD_TO_SET,
+                                monitor=monitor, message="Added")
 
-    def bulk_insert(self, dicts):
+    def _update_set(self, setid, article_ids, script, monitor=NullMonitor(), message="Updated",
+                    batch_size=SET_UPDATE_BATCH_SIZE, progress_units=40):
         """
-        Add the given article dict objects to the index using a bulk insert call
+        Run the given (idempotent) set update script on the given articles in batches
+        of batch_size. Duplicate ids are removed, so every article is updated once.
+        @return: the number of articles that were updated
         """
-        def get_bulk_body(dicts):
-            for article_dict in dicts:
-                yield serialize(dict(index={'_id' : article_dict['id']}))
-                yield serialize(article_dict)
-        r = self.es.bulk(body=get_bulk_body(dicts), index=self.index, doc_type=settings.ES_ARTICLE_DOCTYPE)
-
+        article_ids = sorted(set(int(aid) for aid in article_ids))
+        if not article_ids: return 0
+        nbatches = (len(article_ids) - 1) // batch_size + 1
+        for i, batch in enumerate(splitlist(article_ids, itemsperbatch=batch_size)):
+            self.bulk_update(batch, script, params={'set' : setid}, invalidate=False)
+            done = min((i + 1) * batch_size, len(article_ids))
+            units = progress_units * (i + 1) // nbatches - progress_units * i // nbatches
+            monitor.update(units, "{message} batch {n}/{nbatches} ({done}/{total} articles)"
+                           .format(n=i + 1, total=len(article_ids), **locals()))
+        self.refresh()
+        bump_generations(self.index, [setid])
+        return len(article_ids)
+
+    def bulk_insert(self, dicts, monitor=NullMonitor()):
+        """
+        Add the given article dict objects to the index using bulk insert calls
+        @return: a list of ids of articles that could not be indexed
+        """
+        total = len(dicts) if hasattr(dicts, '__len__') else None
+        with BulkIndexer(self, monitor=monitor, total=total) as indexer:
+            indexer.add(dicts)
+        return indexer.failed
 
-    def bulk_update(self, article_ids, script, params):
+    def bulk_update(self, article_ids, script, params, invalidate=True):
         """
         Execute a bulk update script with the given params on the given article ids.
+        Each id should only occur once, as every occurrence results in an update.
+        @param invalidate: refresh the index and invalidate the cached results for the
+                           set in params. If False, the caller should do this.
         """
         payload = serialize(dict(script=script, params=params))
         def get_bulk_body(article_ids, payload):
@@ -339,17 +934,66 @@ class ES(object):
                 yield payload
         body = ("\n".join(get_bulk_body(article_ids, payload))) + "\n"
         r = self.es.bulk(body=body, index=self.index, doc_type=settings.ES_ARTICLE_DOCTYPE)
-
-    def synchronize_articleset(self, aset, full_refresh=False):
+        if invalidate:
+            self.refresh()
+            bump_generations(self.index, [params['set']] if 'set' in params else [])
+        if r.get('errors'):
+            failed = [item['update']['_id'] for item in r['items'] if item['update'].get('status', 200) >= 300]
+            log.warning("Bulk update failed for {} articles, eg {}".format(len(failed), failed[:10]))
+
+    def synchronize_articleset(self, aset, full_refresh=False, repair=False):
         """
-        Make sure the given article set is correctly stored in the index
+        Make sure the given article set is correctly stored in the index.
+        Normally, this replays the membership changes journaled since the last
+        synchronisation (see ArticleSetChange), which is cheap for large sets.
         @param full_refresh: if true, re-add all articles to the index. Use this
                              after changing properties of articles
+        @param repair: if true, compare the full set in the database with the index
+                       instead of replaying the journal (implied by full_refresh)
         """
+        from amcat.models import ArticleSetChange
         self.check_index() # make sure index exists and is at least 'yellow'
 
+        checkpoint = ArticleSetChange.get_checkpoint(aset)
+        if full_refresh or repair:
+            self._repair_articleset(aset, full_refresh=full_refresh)
+        elif checkpoint is not None:
+            added, removed = ArticleSetChange.get_changes(aset, checkpoint)
+            self._replay_changes(aset, added, removed)
+        else:
+            log.info("No changes to replay for set {aset.id}".format(**locals()))
+
+        if checkpoint is not None:
+            ArticleSetChange.clear(aset, checkpoint)
+        log.info("Flushing")
+        self.flush()
+
+    def _replay_changes(self, aset, added, removed):
+        """
+        Apply the net membership changes of a set to the index
+        @param added: ids of articles added to the set
+        @param removed: ids of articles removed from the set
+        """
+        in_index = set(self.in_index(added))
+        to_add_docs = added - in_index
+        to_add_set = added & in_index
+
+        log.warn("Replaying changes for set {aset.id}, |added|={nadded}, |removed|={nremoved}, "
+                 "|to_add|={nta}, |to_add_set|={ntas}"
+                 .format(nadded=len(added), nremoved=len(removed), nta=len(to_add_docs),
+                         ntas=len(to_add_set), **locals()))
+
+        self.remove_from_set(aset.id, removed)
+        self.add_to_set(aset.id, to_add_set)
+        self.add_articles(to_add_docs)
+
+    def _repair_articleset(self, aset, full_refresh=False):
+        """
+        Compare the full membership of the set in the database with the index,
+        and add or remove articles as needed
+        """
         log.debug("Getting SOLR ids from set")
-        solr_set_ids = set(self.query_ids(filters=dict(sets=aset.id)))
+        solr_set_ids = set(self.query_ids(filters=dict(sets=aset.id), slices=None))
         log.debug("Getting DB ids")
         db_ids = aset.get_article_ids()
         log.debug("Getting SOLR ids")
@@ -375,8 +1019,23 @@ class ES(object):
         self.add_to_set(aset.id, to_add_set)
         log.info("Adding {} articles to index".format(len(to_add_docs)))
         self.add_articles(to_add_docs)
-        log.info("Flushing")
-        self.flush()
+
+    def _cached(self, name, body, func, **params):
+        """
+        Return func(), using the shared result cache. The cache key consists of the
+        query body and params, and the generations of the sets used in the
+        filter (or of all sets if there is no set filter), so any change to
+        those sets in the index invalidates the cached result. The key also contains
+        the generation of the index itself, which changes when it is deleted or created.
+        """
+        setids = sorted(set(_get_filter_sets(body))) or [ALL_SETS]
+        generations = get_generations(self.index, setids + [WHOLE_INDEX])
+        key = serialize([self.index, self.doc_type, name, body, params, generations], sort_keys=True)
+        key = hash_class(key.encode("utf-8")).hexdigest()
+        result = RESULT_CACHE.get_or_set(key, func)
+        log.debug("Result cache for {name}: {RESULT_CACHE.hits} hits, {RESULT_CACHE.misses} misses"
+                  .format(RESULT_CACHE=RESULT_CACHE, **locals()))
+        return result
 
     def count(self, query=None, filters=None):
         """
@@ -384,16 +1043,22 @@ class ES(object):
         """
         filters=dict(build_body(query, filters, query_as_filter=True))
         body = {"query" : {"constant_score" : filters}}
-        result = self.es.count(index=self.index, doc_type=settings.ES_ARTICLE_DOCTYPE, body=body)
-        return result["count"]
-
+        def count():
+            result = self.es.count(index=self.index, doc_type=settings.ES_ARTICLE_DOCTYPE, body=body)
+            return result["count"]
+        return self._cached("count", body, count)
 
-    def aggregate_query(self, query=None, filters=None, group_by=None, date_interval='month'):
+    def aggregate_query(self, query=None, filters=None, group_by=None, date_interval='month', series=None):
         """
         Compute an aggregate query, e.g. select count(*) where <filters> group by <group_by>
         If date is used as a group_by variable, uses date_interval to bin it
         Currently, group by must be a single field as elastic doesn't support multiple group by
+        @param series: if given, also split the counts on a second dimension in the same request,
+                       see aggregate_series
+        @return: a sequence of (group, count) pairs, or (group, series, count) triples if series is given
         """
+        if series is not None:
+            return self.aggregate_series(query, filters, group_by, date_interval, series)
 
         filters=dict(build_body(query, filters, query_as_filter=True))
 
@@ -405,14 +1070,63 @@ class ES(object):
                 "facets" : {"group" : group}}
         log.debug("es.search(body={body})".format(**locals()))
 
-        result = self.search(body, size=0)
+        def aggregate():
+            result = self.search(body, size=0)
+            if group_by == 'date':
+                return [(get_date(row['time']), row['count']) for row in result['facets']['group']['entries']]
+            else:
+                return [(row['term'], row['count']) for row in result['facets']['group']['terms']]
+        return iter(self._cached("aggregate_query", body, aggregate))
+
+    def aggregate_series(self, query=None, filters=None, group_by=None, date_interval='month', series='mediumid'):
+        """
+        Compute a two-dimensional aggregate (e.g. date x medium) in a single request
+        @param group_by: the field to group by as in aggregate_query, or None to only count per series
+        @param series: either a field name such as 'mediumid', to split each group by that field,
+                       or a sequence of (label, query) pairs to count the matches of each query
+                       (combined with query and filters) separately
+        @return: a sequence of (group, series, count) triples, where series is the field value or
+                 label. If group_by is None, group is None as well.
+        """
+        filters = dict(build_body(query, filters, query_as_filter=True))
+        body = {"query" : {"constant_score" : filters}}
+
         if group_by == 'date':
-            for row in result['facets']['group']['entries']:
-                yield get_date(row['time']), row['count']
+            group = {'date_histogram' : {'field' : group_by, 'interval' : date_interval}}
+        elif group_by is not None:
+            group = {'terms' : {'size' : 999999, 'field' : group_by}}
+        sub_aggs = {"group" : group} if group_by is not None else {}
 
+        if isinstance(series, (str, unicode)):
+            body['aggs'] = {"series" : {'terms' : {'size' : 999999, 'field' : series}, 'aggs' : sub_aggs}}
         else:
-            for row in result['facets']['group']['terms']:
-                yield row['term'], row['count']
+            series = list(series)
+            body['aggs'] = {"series_{i}".format(i=i) :
+                                {'filter' : queryparser.get_filter_dsl(q), 'aggs' : sub_aggs}
+                            for (i, (label, q)) in enumerate(series)}
+        log.debug("es.search(body={body})".format(**locals()))
+
+        def get_group(bucket):
+            return get_date(bucket['key']) if group_by == 'date' else bucket['key']
+
+        def get_counts(series_key, bucket):
+            if group_by is None:
+                yield None, series_key, bucket['doc_count']
+            else:
+                for group_bucket in bucket['group']['buckets']:
+                    yield get_group(group_bucket), series_key, group_bucket['doc_count']
+
+        def aggregate():
+            aggs = self.search(body, size=0)['aggregations']
+            result = []
+            if isinstance(series, (str, unicode)):
+                for bucket in aggs['series']['buckets']:
+                    result += get_counts(bucket['key'], bucket)
+            else:
+                for i, (label, q) in enumerate(series):
+                    result += get_counts(label, aggs["series_{i}".format(**locals())])
+            return result
+        return iter(self._cached("aggregate_series", body, aggregate))
 
     def statistics(self, query=None, filters=None):
         """
@@ -420,15 +1134,18 @@ class ES(object):
         """
         body = {"query" : {"constant_score" : dict(build_body(query, filters, query_as_filter=True))}}
         body['facets'] = {'stats' : {'statistical' : {'field' : 'date'}}}
-        stats = self.search(body, size=0)['facets']['stats']
-        result = Result()
-        result.n = stats['count']
-        if result.n == 0:
-            result.start_date, result.end_data = None, None
-        else:
-            result.start_date=get_date(stats['min'])
-            result.end_date=get_date(stats['max'])
-        return result
+        def statistics():
+            stats = self.search(body, size=0)['facets']['stats']
+            result = Result()
+            result.n = stats['count']
+            if result.n == 0:
+                result.start_date, result.end_data = None, None
+            else:
+                result.start_date=get_date(stats['min'])
+                result.end_date=get_date(stats['max'])
+            return result
+        # return a copy so callers cannot change the cached result
+        return Result(**self._cached("statistics", body, statistics).__dict__)
 
     def list_media(self, query=None, filters=None):
         """
@@ -493,6 +1210,10 @@ class ES(object):
                     yield offset, token
                 offset += len(token)
 
+def _get_article_dicts(articles, all_sets):
+    for article in articles:
+        yield get_article_dict(article, list(all_sets.get(article.id, [])))
+
 def get_date(timestamp):
     d = datetime.fromtimestamp(timestamp/1000)
     return datetime(d.year, d.month, d.day)
@@ -508,7 +1229,8 @@ def get_filter_clauses(start_date=None, end_date=None, on_date=None, **filters):
             return [int(x)]
         elif hasattr(x, 'pk'):
             return [x.pk]
-        return x
+        # sort to normalise the query, e.g. for use as a cache key
+        return sorted(_list(y)[0] for y in x)
 
     def parse_date(d):
         if isinstance(d, list) and len(d) == 1:
@@ -544,8 +1266,8 @@ def get_filter_clauses(start_date=None, end_date=None, on_date=None, **filters):
 
     if 'hash' in f:
         hashes = f['hash']
-        if isinstance(hashes, str): hashes = [hashes]
-        yield dict(terms={'hash': hashes})
+        if isinstance(hashes, (str, unicode)): hashes = [hashes]
+        yield dict(terms={'hash': sorted(hashes)})
 
 def combine_filters(filters):
     if len(filters) == 0:
@@ -569,18 +1291,54 @@ def build_body(query=None, filters={}, query_as_filter=False):
     """
     filters = list(get_filter_clauses(**filters))
     if query:
-        terms = queryparser.parse_to_terms(query)
         if query_as_filter:
-            filters.append(terms.get_filter_dsl())
+            filters.append(queryparser.get_filter_dsl(query))
         else:
-            yield ('query', terms.get_dsl())
+            yield ('query', queryparser.get_dsl(query))
 
     if filters:
         yield ('filter', combine_filters(filters))
 
 
+class _NullBulkClient(object):
+    """Stand-in for the elasticsearch client that accepts bulk requests without sending them"""
+    def __init__(self):
+        self.requests, self.updates = 0, 0
+
+    def bulk(self, body, **kargs):
+        n = body.count("\n") // 2
+        self.requests += 1
+        self.updates += n
+        return {'items' : [{'update' : {'status' : 200}}] * n}
+
+def benchmark(sizes=(10**4, 10**5, 10**6)):
+    """
+    Time ES.add_to_set for increasing numbers of ids against a client that does not
+    send anything. This measures the client side of set updates (deduplication,
+    batching and serialisation), which should scale linearly with the number of ids.
+    @return: a dict of {number of ids : seconds}
+    """
+    result = {}
+    for n in sizes:
+        es = ES(index="amcates_benchmark")
+        es.es = _NullBulkClient()
+        es.refresh = lambda: None
+        t = time.time()
+        es.add_to_set(0, xrange(n))
+        t = time.time() - t
+        if es.es.updates != n:
+            raise AssertionError("{es.es.updates} updates for {n} ids".format(**locals()))
+        result[n] = t
+        print("{n} ids: {t:.2f} seconds in {es.es.requests} requests, {us:.1f} microseconds per id"
+              .format(us=t * 1e6 / n, **locals()))
+    return result
+
 if __name__ == '__main__':
-    ES().check_index()
+    import sys
+    if sys.argv[1:] == ["benchmark"]:
+        benchmark()
+    else:
+        ES().check_index()
 
 ###########################################################################
 #                          U N I T   T E S T S                            #
@@ -588,6 +1346,8 @@ if __name__ == '__main__':
 
 from amcat.tools import amcattest
 from unittest import skipUnless, skip
+import json
+import inspect
 
 class TestAmcatES(amcattest.AmCATTestCase):
 
@@ -617,6 +1377,19 @@ class TestAmcatES(amcattest.AmCATTestCase):
         self.assertEqual(dict(ES().aggregate_query(filters=dict(sets=s1.id), group_by="date", date_interval="month")),
                          {datetime(2001,1,1) : 1, datetime(2002,1,1) : 1, datetime(2001,2,1) : 2})
 
+        # date x medium and date x query in a single request
+        self.assertEqual(set(ES().aggregate_query(filters=dict(sets=s1.id), group_by="date",
+                                                  date_interval="year", series="mediumid")),
+                         {(datetime(2001,1,1), m1.id, 1), (datetime(2001,1,1), m2.id, 2),
+                          (datetime(2002,1,1), m2.id, 1)})
+        self.assertEqual(set(ES().aggregate_series(filters=dict(sets=s1.id), series="mediumid")),
+                         {(None, m1.id, 1), (None, m2.id, 3)})
+        queries = [("a", "aap"), ("w", "wim"), ("x", "xyz")]
+        self.assertEqual(set(ES().aggregate_series(filters=dict(sets=s1.id), group_by="mediumid", series=queries)),
+                         {(m1.id, "a", 1), (m2.id, "w", 3)})
+        self.assertEqual(set(ES().aggregate_series(filters=dict(sets=s1.id), series=queries)),
+                         {(None, "a", 1), (None, "w", 3), (None, "x", 0)})
+
         # set statistics
         stats = ES().statistics(filters=dict(sets=s1.id))
         self.assertEqual(stats.n, 4)
@@ -627,6 +1400,67 @@ class TestAmcatES(amcattest.AmCATTestCase):
         self.assertEqual(set(ES().list_media(filters=dict(sets=s1.id))),
                          {m1.id, m2.id})
 
+    @amcattest.use_elastic
+    def test_result_cache(self):
+        """Are aggregate results cached, and invalidated when the set changes?"""
+        m1, m2 = [amcattest.create_test_medium() for _ in range(2)]
+        a = amcattest.create_test_article(medium=m1)
+        b = amcattest.create_test_article(medium=m2)
+        s1, s2 = amcattest.create_test_set(articles=[a]), amcattest.create_test_set(articles=[a])
+        ES().flush()
+
+        hits = RESULT_CACHE.hits
+        self.assertEqual(ES().count(filters=dict(sets=s1.id)), 1)
+        self.assertEqual(ES().count(filters=dict(sets=[s1.id])), 1)
+        self.assertEqual(ES().count(filters=dict(sets=s2.id)), 1)
+        self.assertEqual(RESULT_CACHE.hits, hits + 1)
+        self.assertEqual(dict(ES().aggregate_query(filters=dict(sets=s1.id), group_by="mediumid")), {m1.id : 1})
+        self.assertEqual(dict(ES().aggregate_query(filters=dict(sets=s1.id), group_by="mediumid")), {m1.id : 1})
+        self.assertEqual(RESULT_CACHE.hits, hits + 2)
+
+        # adding an article should invalidate the results for s1, but not for s2
+        s1.add_articles([b])
+        ES().flush()
+        self.assertEqual(ES().count(filters=dict(sets=s1.id)), 2)
+        self.assertEqual(dict(ES().aggregate_query(filters=dict(sets=s1.id), group_by="mediumid")),
+                         {m1.id : 1, m2.id : 1})
+        self.assertEqual(ES().count(filters=dict(sets=s2.id)), 1)
+        self.assertEqual(RESULT_CACHE.hits, hits + 3)
+
+    @amcattest.use_elastic
+    def test_result_cache_refresh(self):
+        """Are results computed before the index is refreshed not cached as the new state?"""
+        a, b, c = [amcattest.create_test_article() for _ in range(3)]
+        s = amcattest.create_test_set(articles=[a])
+        ES().flush()
+        es = ES()
+        self.assertEqual(es.count(filters=dict(sets=s.id)), 1)
+
+        # count in between the bulk request and the refresh, ie on the old state
+        refresh = es.refresh
+        def count_and_refresh():
+            es.count(filters=dict(sets=s.id))
+            refresh()
+        es.refresh = count_and_refresh
+
+        es.add_to_set(s.id, [b.id])
+        self.assertEqual(es.count(filters=dict(sets=s.id)), 2)
+        es.bulk_update([c.id], UPDATE_SCRIPT_ADD_TO_SET, params={'set' : s.id})
+        self.assertEqual(es.count(filters=dict(sets=s.id)), 3)
+        es.remove_from_set(s.id, [a.id, b.id])
+        self.assertEqual(es.count(filters=dict(sets=s.id)), 1)
+
+    def test_bump_generations(self):
+        """Does changing a set invalidate only that set, and recreating the index everything?"""
+        index = "test_index_{}".format(_new_generation())
+        before = get_generations(index, [1, 2, ALL_SETS, WHOLE_INDEX])
+        bump_generations(index, [1])
+        after = get_generations(index, [1, 2, ALL_SETS, WHOLE_INDEX])
+        self.assertEqual({k for k in before if before[k] != after[k]}, {1, ALL_SETS})
+        bump_generations(index, [], whole_index=True)
+        after2 = get_generations(index, [1, 2, ALL_SETS, WHOLE_INDEX])
+        self.assertEqual({k for k in after if after[k] != after2[k]}, {ALL_SETS, WHOLE_INDEX})
+
     @amcattest.use_elastic
     def test_list_media(self):
         """Test that list media works for more than 10 media"""
@@ -661,9 +1495,192 @@ class TestAmcatES(amcattest.AmCATTestCase):
 
         r = ES().query_all(filters=dict(sets=s.id), size=10)
         self.assertEqual(len(list(r)), len(arts))
-
-
-
+        self.assertEqual(r.total, len(arts))
+
+        # query_iter should stream all results, with or without scores/sorting
+        for kargs in [dict(score=False), dict(score=True), dict(score=False, sort="id")]:
+            r = ES().query_iter(filters=dict(sets=s.id), fields=["headline"], size=3, **kargs)
+            self.assertTrue(inspect.isgenerator(r))
+            r = list(r)
+            self.assertEqual({a.id for a in r}, {a.id for a in arts})
+            self.assertEqual({a.headline for a in r}, {a.headline for a in arts})
+        r = [a.id for a in ES().query_iter(filters=dict(sets=s.id), score=False, sort="id:desc", size=3)]
+        self.assertEqual(r, sorted(r, reverse=True))
+
+
+
+
+    def test_search_result(self):
+        """Are raw hits converted into columns and slotted rows?"""
+        import pickle
+        hits = [dict(_id="1", _score=2.0, fields=dict(date=["2001-01-02"], headline=["a"], sets=[1, 2])),
+                dict(_id="2", _score=1.0, fields=dict(date=["2001-01-02T10:11:12.000"], lead=["x"]),
+                     highlight=dict(headline=["<em>b</em>"]))]
+        r = SearchResult(dict(hits=dict(hits=hits, total=2)), ["date", "headline", "sets"], True, {})
+
+        self.assertEqual(list(r.columns['id']), [1, 2])
+        self.assertEqual(r.columns['date'], [datetime(2001, 1, 2), datetime(2001, 1, 2, 10, 11, 12)])
+        self.assertEqual(r.columns['headline'], ["a", None])
+        self.assertEqual(r.columns['sets'], [[1, 2], None])
+        self.assertEqual(r.columns['lead'], [None, "x"])
+        self.assertEqual(r.columns['score'], [2, 1])
+
+        a, b = r
+        self.assertEqual((a.id, a.headline, a.score, a.sets), (1, "a", 2, [1, 2]))
+        self.assertEqual((b.lead, b.highlight), ("x", {"headline" : ["<em>b</em>"]}))
+        self.assertFalse(hasattr(a, "highlight"))
+        self.assertFalse(hasattr(a, "__dict__"))
+        self.assertIs(type(a), type(b))
+        a.hits = {"q" : 1}
+        self.assertRaises(AttributeError, setattr, a, "foo", 1)
+        self.assertEqual(pickle.loads(pickle.dumps(a)), a)
+        self.assertEqual(r.as_dicts()[1]["highlight"], b.highlight)
+
+        # rows should have the same values as Result.from_hit
+        for hit, row in zip(hits, r):
+            for k, v in Result.from_hit(hit, r.fields).as_dict().items():
+                self.assertEqual(getattr(row, k), v)
+
+    def test_bulk_indexer(self):
+        """Are failed documents retried, and are requests split by size?"""
+        class FakeClient(object):
+            def __init__(self):
+                self.requests, self.attempts = [], collections.Counter()
+            def bulk(self, body, **kargs):
+                ids = [json.loads(line)['index']['_id'] for line in body.splitlines()[::2]]
+                self.requests.append(ids)
+                items = []
+                for aid in ids:
+                    self.attempts[aid] += 1
+                    # article 2 fails once, article 3 always fails, article 4 has a mapping error
+                    status = {2 : 503 if self.attempts[aid] == 1 else 201, 3 : 503, 4 : 400}.get(aid, 201)
+                    items.append({'index' : {'_id' : aid, 'status' : status}})
+                return {'items' : items}
+        es = ES()
+        es.es = FakeClient()
+        es.refresh = lambda: None
+        dicts = [{'id' : i, 'text' : 'x' * 100} for i in range(10)]
+
+        with BulkIndexer(es, max_docs=3, max_retries=2, backoff=0) as indexer:
+            indexer.add(iter(dicts))
+        self.assertEqual(sorted(indexer.failed), [3, 4])
+        self.assertEqual(indexer.docs, 10)
+        self.assertEqual(es.es.attempts[2], 2)
+        self.assertEqual(es.es.attempts[3], 3)
+        self.assertEqual(es.es.attempts[4], 1)
+        self.assertEqual([r for r in es.es.requests if len(r) > 1], [[0, 1, 2], [3, 4, 5], [6, 7, 8]])
+
+        es.es = FakeClient()
+        with BulkIndexer(es, max_bytes=300, max_retries=2, backoff=0) as indexer:
+            indexer.add(dicts)
+        self.assertEqual(max(len(r) for r in es.es.requests), 2)
+        self.assertEqual(sum(len(r) for r in es.es.requests), 10 + 1 + 2)
+
+    def test_update_set_batches(self):
+        """Is every article updated exactly once, in one bulk request per batch? See benchmark for timing"""
+        class FakeClient(object):
+            def __init__(self):
+                self.requests = []
+            def bulk(self, body, **kargs):
+                lines = body.splitlines()
+                self.requests.append([json.loads(line)['update']['_id'] for line in lines[::2]])
+                return {'items' : [{'update' : {'status' : 200}}] * (len(lines) // 2)}
+        class Monitor(object):
+            def __init__(self):
+                self.units = 0
+            def update(self, units, message):
+                self.units += units
+
+        for n in (2500, 25000):
+            es = ES()
+            es.es = FakeClient()
+            es.refresh = lambda: None
+            monitor = Monitor()
+            ids = range(n) + range(10) # duplicates should only be updated once
+            self.assertEqual(es.add_to_set(123, iter(ids), monitor=monitor), n)
+            updates = [aid for r in es.es.requests for aid in r]
+            self.assertEqual(sorted(updates), range(n))
+            self.assertEqual(len(es.es.requests), (n - 1) // SET_UPDATE_BATCH_SIZE + 1)
+            self.assertEqual(monitor.units, 40)
+
+        es.es = FakeClient()
+        self.assertEqual(es.remove_from_set(123, [3, 1, 3]), 2)
+        self.assertEqual(es.es.requests, [[1, 3]])
+
+    def test_scroll_cleared(self):
+        """Is the scroll context cleared when a scroll is exhausted or stopped early?"""
+        class FakeClient(object):
+            def __init__(self, npages):
+                self.npages, self.page, self.cleared = npages, 0, []
+            def search(self, search_type=None, **kargs):
+                if search_type == "scan": # only returns a scroll id
+                    return {'_scroll_id' : "scroll0", 'hits' : {'hits' : []}}
+                return self.scroll(None)
+            def scroll(self, scroll_id, **kargs):
+                self.page += 1
+                hits = [{'_id' : str(self.page), '_score' : 1}] if self.page <= self.npages else []
+                return {'_scroll_id' : "scroll{self.page}".format(**locals()), 'hits' : {'hits' : hits}}
+            def clear_scroll(self, scroll_id):
+                self.cleared.append(scroll_id)
+
+        es = ES()
+        es.es = FakeClient(npages=3)
+        self.assertEqual([r.id for r in es.query_iter()], [1, 2, 3])
+        self.assertEqual(es.es.cleared, ["scroll4"])
+
+        es.es = FakeClient(npages=3)
+        r = es.query_iter()
+        self.assertEqual(next(r).id, 1)
+        r.close()
+        self.assertEqual(es.es.cleared, ["scroll1"])
+
+        es.es = FakeClient(npages=3)
+        self.assertEqual(list(es.query_ids(slices=1)), [1, 2, 3])
+        self.assertEqual(es.es.cleared, ["scroll4"])
+
+    def test_sliced_scroll_cleared(self):
+        """Does every slice of a parallel id scan clear its scroll context, also if the consumer stops early?"""
+        class FakeClient(object):
+            def __init__(self, npages):
+                self.npages, self.lock = npages, threading.Lock()
+                self.scrolls, self.cleared = {}, [] # scroll id : (slice start, page)
+            def _result(self, start, page):
+                scroll_id = "{start}-{page}".format(**locals())
+                with self.lock:
+                    self.scrolls[scroll_id] = (start, page)
+                hits = [{'_id' : str(start + page)}] if 0 < page <= self.npages else []
+                return {'_scroll_id' : scroll_id, 'hits' : {'hits' : hits}}
+            def search(self, body, **kargs):
+                return self._result(body['filter']['range']['id']['gte'], 0)
+            def scroll(self, scroll_id, **kargs):
+                start, page = self.scrolls[scroll_id]
+                return self._result(start, page + 1)
+            def clear_scroll(self, scroll_id):
+                with self.lock:
+                    self.cleared.append(self.scrolls[scroll_id])
+
+        es = ES()
+        es._get_id_slices = lambda body, slices: [(0, 10), (10, 20), (20, 30)]
+        es.es = FakeClient(npages=3)
+        self.assertEqual(sorted(es.query_ids(slices=3)), [1, 2, 3, 11, 12, 13, 21, 22, 23])
+        self.assertEqual(sorted(es.es.cleared), [(0, 4), (10, 4), (20, 4)])
+
+        # stop after the first batch, with workers blocked on a full queue or not
+        global QUERY_IDS_QUEUE_SIZE
+        queue_size = QUERY_IDS_QUEUE_SIZE
+        try:
+            for QUERY_IDS_QUEUE_SIZE in (1, 10):
+                es.es = FakeClient(npages=3)
+                r = es.query_ids(slices=3)
+                next(r)
+                r.close()
+                # every slice cleared the last scroll id it got
+                cleared = dict(es.es.cleared)
+                self.assertEqual(sorted(cleared), [0, 10, 20])
+                for start, page in es.es.scrolls.values():
+                    self.assertLessEqual(page, cleared[start])
+        finally:
+            QUERY_IDS_QUEUE_SIZE = queue_size
 
     @amcattest.use_elastic
     def test_filters(self):
@@ -706,6 +1723,30 @@ class TestAmcatES(amcattest.AmCATTestCase):
         ids = set(ES().query_ids(filters=dict(mediumid=a.medium_id)))
         self.assertEqual(ids, {a.id})
 
+    @amcattest.use_elastic
+    def test_query_ids_sliced(self):
+        "Do parallel scans return the same ids as a single scan?"
+        arts = [amcattest.create_test_article() for _ in range(25)]
+        s = amcattest.create_test_set(articles=arts)
+        ES().add_articles([a.id for a in arts])
+        ES().flush()
+        ids = {a.id for a in arts}
+
+        self.assertEqual(set(ES().query_ids(filters=dict(sets=s.id))), ids)
+        for slices in (2, 3, 7, 100):
+            result = list(ES().query_ids(filters=dict(sets=s.id), slices=slices, size=2))
+            self.assertEqual(len(result), len(ids))
+            self.assertEqual(set(result), ids)
+
+        result = ES().query_ids_array(filters=dict(sets=s.id), slices=3)
+        self.assertEqual(sorted(result), sorted(ids))
+
+        # empty result and early termination of the consumer
+        self.assertEqual(list(ES().query_ids(filters=dict(sets=-1), slices=3)), [])
+        gen = ES().query_ids(filters=dict(sets=s.id), slices=3, size=1)
+        self.assertIn(next(gen), ids)
+        gen.close()
+
 
     @amcattest.use_elastic
     def test_articlesets(self):
@@ -773,6 +1814,23 @@ class TestAmcatES(amcattest.AmCATTestCase):
         arts[1].medium = amcattest.create_test_medium()
         arts[1].save()
 
+    @amcattest.use_elastic
+    def test_refresh_index_repair(self):
+        """Does repair find changes that were not journaled?"""
+        from amcat.models import ArticleSetArticle
+        s = amcattest.create_test_set()
+        a, b = [amcattest.create_test_article() for _ in range(2)]
+        s.add_articles([a, b], add_to_index=False)
+        s.refresh_index()
+        self.assertEqual({a.id, b.id}, set(ES().query_ids(filters=dict(sets=s.id))))
+
+        # remove b behind the back of the journal
+        ArticleSetArticle.objects.filter(articleset=s, article=b).delete()
+        s.refresh_index()
+        self.assertEqual({a.id, b.id}, set(ES().query_ids(filters=dict(sets=s.id))))
+        s.refresh_index(repair=True)
+        self.assertEqual({a.id}, set(ES().query_ids(filters=dict(sets=s.id))))
+
 
     @amcattest.use_elastic
     def test_full_refresh(self):
@@ -26,6 +26,9 @@ value on the object
 @invalidates will clear the cache for this object for all cached functions
 
 Use reset and set_cache to manually clear and set the cache
+
+LRUCache is a bounded in-memory cache for (expensive) results that can be
+shared between objects
 """
 
 from __future__ import unicode_literals, print_function, absolute_import
@@ -168,6 +171,78 @@ def clear_cache(model):
     key = CACHE_PREFIX + model.__name__
     setattr(_object_cache, key , {})
 
+###########################################################################
+#                        R E S U L T   C A C H I N G                      #
+###########################################################################
+
+import time
+import collections
+
+_MISSING = object()
+
+class LRUCache(object):
+    """
+    Thread-safe in-memory cache holding at most `size` entries. If full, the
+    least recently used entry is evicted. If ttl (seconds) is given, entries
+    expire after that time. Keeps hit/miss counters for monitoring.
+    """
+    def __init__(self, size=1000, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.hits, self.misses = 0, 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the value for key (marking it as recently used), or default if not present"""
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < time.time():
+                self.misses += 1
+                return default
+            self._data[key] = (value, expires)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Store value for key, evicting the least recently used entries if needed"""
+        expires = None if self.ttl is None else time.time() + self.ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+        return value
+
+    def get_or_set(self, key, func):
+        """Return the value for key, calling func() and storing the result if not present"""
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = self.set(key, func())
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def reset_stats(self):
+        self.hits, self.misses = 0, 0
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else None
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
 ###########################################################################
 #                  D J A N G O  M O D E L  C A C H I N G                  #
 ###########################################################################
@@ -298,6 +373,35 @@ class TestCaching(amcattest.AmCATTestCase):
         self.assertEqual(t.get_y(), 1)
         self.assertTrue(t.changed)
 
+    def test_lru_cache(self):
+        """Does the LRU cache evict the least recently used entries?"""
+        c = LRUCache(size=2)
+        c.set("a", 1)
+        c.set("b", 2)
+        self.assertEqual(c.get("a"), 1) # a is now more recent than b
+        c.set("c", 3)
+        self.assertNotIn("b", c)
+        self.assertEqual(c.get("b"), None)
+        self.assertEqual((c.get("a"), c.get("c")), (1, 3))
+        self.assertEqual((c.hits, c.misses), (3, 1))
+        self.assertEqual(c.hit_rate, .75)
+
+        calls = []
+        func = lambda : calls.append(1) or len(calls)
+        self.assertEqual(c.get_or_set("d", func), 1)
+        self.assertEqual(c.get_or_set("d", func), 1)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(c), 2)
+
+    def test_lru_cache_ttl(self):
+        """Do entries expire?"""
+        c = LRUCache(ttl=-1)
+        c.set("a", 1)
+        self.assertEqual(c.get("a"), None)
+        c = LRUCache(ttl=60)
+        c.set("a", None)
+        self.assertEqual(c.get("a", "missing"), None)
+
     def test_object_cache(self):
         from amcat.models.project import Project
         pid = amcattest.create_test_project().id
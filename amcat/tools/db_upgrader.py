@@ -38,6 +38,19 @@ def execute_sql_file(filename):
     cursor.execute(sql)
     cursor.close()
 
+def upgrade_from_22():
+    """
+    Add the version column to coded_articles. The column is only added if it does not
+    exist yet, as syncdb creates it for the tables it creates.
+    """
+    cursor = connection.cursor()
+    cursor.execute("SELECT 1 FROM information_schema.columns"
+                   " WHERE table_name = 'coded_articles' AND column_name = 'version'")
+    if not cursor.fetchall():
+        cursor.execute("ALTER TABLE coded_articles ADD version integer NOT NULL DEFAULT 0")
+    cursor.execute("UPDATE amcat_system SET db_version = 23")
+    cursor.close()
+
 def _upgrade_from(version):
     function = "upgrade_from_{version}".format(**locals())
     if function in globals():
@@ -29,12 +29,13 @@ from __future__ import unicode_literals, print_function, absolute_import
 
 from django.db import models
 import collections
+import itertools
 import logging
 from amcat.tools.amcates import ES
 from amcat.tools.table import table3
 from amcat.models import Medium, Label
 import re
-from amcat.tools.toolkit import stripAccents,readDate
+from amcat.tools.toolkit import stripAccents, readDate, splitlist
 from django.core.exceptions import ValidationError
 from dateutil.relativedelta import relativedelta
 from amcat.models import Project
@@ -42,6 +43,9 @@ from amcat.tools.progress import NullMonitor
 
 log = logging.getLogger(__name__)
 
+# Number of streamed articles for which the hits are retrieved in one query per search term
+HITS_BATCH_SIZE = 1000
+
 def _get_filter_date(cleaned_data, prop):
     if prop not in cleaned_data: return "*"
     return cleaned_data[prop].isoformat() + "Z"
@@ -126,9 +130,14 @@ def get_ids(form):
     else:
         query = None
                          
-    return ES().query_ids(query=query, filters=filters)
+    return ES().query_ids(query=query, filters=filters, slices=None)
 
-def getArticles(form, **kargs):
+def getArticles(form, stream=False, **kargs):
+    """
+    Return the articles matching the form as Result objects
+    @param stream: if True, return a generator that retrieves the results using a scroll
+                   cursor rather than a single page.
+    """
     fields = ['mediumid', 'date', 'headline', 'medium']
     
     sort = form.get('sortColumn', None)
@@ -146,22 +155,32 @@ def getArticles(form, **kargs):
 
 
     score = 'hits' in form['columns']
+    if stream:
+        kargs.pop("from_", None)
+        kargs.pop("size", None)
+        result = ES().query_iter(query, filters=filters, fields=fields, sort=sort, score=score, **kargs)
+        if score:
+            batches = splitlist(result, itemsperbatch=HITS_BATCH_SIZE)
+            result = itertools.chain.from_iterable(_add_hits(form, batch) for batch in batches)
+        return result
+
     result = list(ES().query(query, filters=filters, fields=fields, sort=sort, score=score, **kargs))
+    if score:
+        _add_hits(form, result)
+    return result
 
-    if 'hits' in form['columns']:
-        # add hits columns
-        def add_hits_column(r):
-            r.hits = {q.label : 0 for q in form['queries']}
-            return r
-            
-        result_dict = {r.id : add_hits_column(r) for r in result}
+def _add_hits(form, results):
+    """Add a hits dict of query label : score to each of the results"""
+    result_dict = {}
+    for r in results:
+        r.hits = {q.label : 0 for q in form['queries']}
+        result_dict[r.id] = r
+    if result_dict:
         f = dict(ids=list(result_dict.keys()))
-        
         for q in queries_from_form(form):
-            for hit in ES().query(q.query, filters=f, fields=[]):
+            for hit in ES().query(q.query, filters=f, fields=[], size=len(result_dict)):
                 result_dict[hit.id].hits[q.label] = hit.score
-
-    return result
+    return results
     
 def getTable(form, progress_monitor=NullMonitor):
     table = table3.DictTable(default=0)
@@ -179,16 +198,18 @@ def getTable(form, progress_monitor=NullMonitor):
         _add_column(table, 'total', query, filters, group_by, dateInterval)
         progress_monitor.update(90, "Got results")
     elif yAxis == 'medium':
-        media = Medium.objects.filter(pk__in=ES().list_media(query, filters)).only("name")
+        # get the whole group_by x medium matrix in a single request
+        series = _get_series(query, filters, group_by, dateInterval, "mediumid")
+        media = Medium.objects.filter(pk__in=series.keys()).only("name")
         
         for medium in sorted(media):
-            filters['mediumid'] = medium.id
             name = u"{medium.id} - {}".format(medium.name.replace(",", " ").replace(".", " "), **locals())
-            _add_column(table, name, query, filters, group_by, dateInterval)
+            _fill_column(table, name, series[medium.id], group_by)
             progress_monitor.update(90 / len(media), "Got results for medium {medium.id}".format(**locals()))
     elif yAxis == 'searchTerm':
-        for q in queries:
-            _add_column(table, q.label, q.query, filters, group_by, dateInterval)
+        series = _get_series(None, filters, group_by, dateInterval, [(i, q.query) for (i, q) in enumerate(queries)])
+        for i, q in enumerate(queries):
+            _fill_column(table, q.label, series[i], group_by)
             progress_monitor.update(90 / len(queries), "Got results for {q.label!r}".format(**locals()))
     else:
         raise Exception('yAxis {yAxis} not recognized'.format(**locals()))
@@ -208,10 +229,27 @@ def add_medium_names(result):
     
 def _add_column(table, column_name, query, filters, group_by, dateInterval):
     if group_by == "total":
-        n = ES().count(query, filters)
-        table.addValue("Total", column_name, n)
+        results = [(None, ES().count(query, filters))]
     else:        
         results = ES().aggregate_query(query, filters, group_by, dateInterval)
+    _fill_column(table, column_name, results, group_by)
+
+def _get_series(query, filters, group_by, dateInterval, series):
+    """
+    Get the counts for all columns with one aggregate query
+    @return: a dict of series : [(group, n), ...]
+    """
+    result = collections.defaultdict(list)
+    group_by = None if group_by == "total" else group_by
+    for group, serie, n in ES().aggregate_series(query, filters, group_by, dateInterval, series):
+        result[serie].append((group, n))
+    return result
+
+def _fill_column(table, column_name, results, group_by):
+    """Add the (group, n) results to the table as column_name"""
+    if group_by == "total":
+        table.addValue("Total", column_name, sum(n for (group, n) in results))
+    else:
         if group_by == "mediumid": 
             results = add_medium_names(results)
 
@@ -461,3 +499,28 @@ class TestKeywordSearch(amcattest.AmCATTestCase):
         self.assertEquals(SearchQuery._get_label_delimiter("abc", "ab"), "a")
         self.assertEquals(SearchQuery._get_label_delimiter("abc", "ba"), "b")
         self.assertEquals(SearchQuery._get_label_delimiter("abc", "d"), None)
+
+    @amcattest.use_elastic
+    def test_get_articles_hits(self):
+        """Are hits added to all articles, also when streaming more than a page of results?"""
+        global HITS_BATCH_SIZE
+        s = amcattest.create_test_set()
+        arts = [amcattest.create_test_article(text='aap noot aap', articleset=s) for _i in range(15)]
+        amcattest.create_test_article(text='noot mies', articleset=s)
+        ES().flush()
+
+        form = dict(columns=['hits'], query='aap', articlesets=[s.id], datetype='all', sortColumn='id')
+        form['queries'] = list(queries_from_form(form))
+        label = form['queries'][0].label
+
+        old_batch_size, HITS_BATCH_SIZE = HITS_BATCH_SIZE, 4
+        try:
+            streamed = list(getArticles(form, stream=True))
+        finally:
+            HITS_BATCH_SIZE = old_batch_size
+        self.assertEqual({r.id for r in streamed}, {a.id for a in arts})
+        self.assertTrue(all(r.hits[label] > 0 for r in streamed))
+
+        result = getArticles(form, size=15)
+        self.assertEqual({r.id for r in result}, {a.id for a in arts})
+        self.assertTrue(all(r.hits[label] > 0 for r in result))
@@ -0,0 +1,200 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+
+"""
+MinHash signatures and locality sensitive hashing (LSH) to find near-duplicate texts.
+
+A text is represented by its set of character shingles (n-grams). The MinHash
+signature of a text is a short array of integers such that the fraction of equal
+positions in two signatures estimates the Jaccard similarity of their shingle sets.
+Signatures are computed with one permutation hashing: every shingle is hashed once,
+the hash determines the position in the signature, and each position keeps the
+minimum value. Empty positions are filled from the next non-empty position.
+
+The LSHIndex splits signatures into bands and reports texts that share at least one
+band as candidate pairs. With b bands of r rows, texts with similarity s become
+candidates with probability 1 - (1 - s^r)^b. get_lsh_bands chooses the number of bands
+for a minimum Levenshtein ratio between the texts.
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import collections
+import struct
+import zlib
+from array import array
+
+# Parameters of the signatures. Change SIGNATURE_VERSION if these are changed,
+# so stored signatures are recomputed.
+SHINGLE_SIZE = 5
+SIGNATURE_SIZE = 64
+SIGNATURE_VERSION = 2
+
+# Default LSH banding: 16 bands of 4 rows, ie candidates from a similarity of about .5
+LSH_BANDS = 16
+
+# Minimum probability that get_lsh_bands guarantees for finding a pair
+LSH_RECALL = .99
+
+_MAX = 0xffffffff
+
+# Stored signatures are little endian unsigned 32 bit integers, independent of the platform
+_FORMAT = b"<{}I"
+
+def get_shingles(text, size=SHINGLE_SIZE):
+    """Return the set of character n-grams in the text, after lowercasing and normalising whitespace"""
+    text = " ".join((text or "").lower().split()).encode("utf-8")
+    if len(text) <= size:
+        return {text}
+    return {text[i:i+size] for i in xrange(len(text) - size + 1)}
+
+def get_signature(text, size=SIGNATURE_SIZE):
+    """
+    Compute the MinHash signature of the given text
+    @return: an array of size unsigned integers
+    """
+    signature = array(b'L', [_MAX]) * size
+    for shingle in get_shingles(text):
+        h = zlib.crc32(shingle) & _MAX
+        i, value = h % size, h // size
+        if value < signature[i]:
+            signature[i] = value
+    # densify: fill empty positions from the next filled position
+    filled = [i for i in xrange(size) if signature[i] != _MAX]
+    if filled and len(filled) < size:
+        for i in xrange(size):
+            if signature[i] == _MAX:
+                j = next((j for j in filled if j > i), filled[0])
+                signature[i] = signature[j]
+    return signature
+
+def to_bytes(signature):
+    """Serialise a signature for storage (see amcat.models.article.ArticleSignature)"""
+    return struct.pack(_FORMAT.format(len(signature)), *signature)
+
+def from_bytes(data):
+    """Deserialise a stored signature"""
+    data = bytes(data)
+    return array(b'L', struct.unpack(_FORMAT.format(len(data) // 4), data))
+
+def similarity(signature1, signature2):
+    """Estimate the Jaccard similarity of two texts from their signatures"""
+    same = sum(1 for (a, b) in zip(signature1, signature2) if a == b)
+    return float(same) / len(signature1)
+
+def get_min_similarity(ratio, size=SHINGLE_SIZE):
+    """
+    Return a lower bound for the (shingle) Jaccard similarity of two texts with the given
+    Levenshtein ratio. Texts of length n with ratio r differ by at most 2n(1-r) insertions
+    and deletions, and each of those changes at most size shingles.
+    """
+    changed = 2 * size * (1 - ratio)
+    return max(0.0, (1 - changed) / (1 + changed))
+
+def get_recall(similarity, bands, size=SIGNATURE_SIZE):
+    """Return the probability that texts with the given similarity share a band"""
+    return 1 - (1 - similarity ** (size // bands)) ** bands
+
+def get_lsh_bands(ratio, recall=LSH_RECALL, size=SIGNATURE_SIZE):
+    """
+    Return the smallest number of bands (ie the fewest candidates) for which texts with at least
+    the given Levenshtein ratio are candidates with at least the given probability.
+    @return: the number of bands, or None if no banding gives that recall for this ratio
+    """
+    similarity = get_min_similarity(ratio)
+    for bands in xrange(1, size + 1):
+        if size % bands == 0 and get_recall(similarity, bands, size) >= recall:
+            return bands
+
+def get_bands(signature, bands=LSH_BANDS):
+    """Split the signature into the given number of bands, yielding (band number, values) keys"""
+    rows = len(signature) // bands
+    for b in xrange(bands):
+        yield (b, tuple(signature[b*rows:(b+1)*rows]))
+
+class LSHIndex(object):
+    """
+    Index of signatures that finds candidate near-duplicates by banding.
+    Items are added with a partition key (eg medium and date); only items with
+    the same partition key are considered candidates.
+    """
+    def __init__(self, bands=LSH_BANDS):
+        self.bands = bands
+        self.buckets = collections.defaultdict(list) # (partition, band key) : [id, ..]
+
+    def add(self, id, signature, partition=None):
+        for band in get_bands(signature, self.bands):
+            self.buckets[partition, band].append(id)
+
+    def get_candidates(self, signature, partition=None):
+        """Return the set of ids of indexed items that share a band with the given signature"""
+        result = set()
+        for band in get_bands(signature, self.bands):
+            result.update(self.buckets.get((partition, band), ()))
+        return result
+
+    def __len__(self):
+        return len(self.buckets)
+
+###########################################################################
+#                          U N I T   T E S T S                            #
+###########################################################################
+
+from amcat.tools import amcattest
+
+class TestMinHash(amcattest.AmCATTestCase):
+    TEXT = ("The quick brown fox jumps over the lazy dog while the cat watches "
+            "from the window, wondering why anyone would jump over a dog at all.")
+
+    def test_signature(self):
+        s = get_signature(self.TEXT)
+        self.assertEqual(len(s), SIGNATURE_SIZE)
+        self.assertEqual(s, get_signature("  " + self.TEXT.upper()))
+        self.assertEqual(similarity(s, s), 1.0)
+
+        near = get_signature(self.TEXT.replace("lazy", "sleepy"))
+        other = get_signature("Something completely different about parliament and the budget")
+        self.assertGreater(similarity(s, near), .6)
+        self.assertLess(similarity(s, other), .2)
+
+        # short and empty texts should get a (filled) signature as well
+        self.assertNotIn(_MAX, get_signature("ab"))
+        self.assertNotIn(_MAX, get_signature(""))
+
+        self.assertEqual(from_bytes(to_bytes(s)), s)
+        self.assertEqual(len(to_bytes(s)), 4 * SIGNATURE_SIZE)
+
+    def test_lsh_bands(self):
+        self.assertEqual(get_lsh_bands(1), 1)
+        self.assertEqual(get_lsh_bands(.99), LSH_BANDS)
+        self.assertEqual(get_lsh_bands(.95), SIGNATURE_SIZE)
+        self.assertEqual(get_lsh_bands(.5), None)
+        for ratio in (.92, .95, .97, .98, .99, .995, 1):
+            self.assertGreaterEqual(get_recall(get_min_similarity(ratio), get_lsh_bands(ratio)), LSH_RECALL)
+
+    def test_index(self):
+        index = LSHIndex()
+        index.add(1, get_signature(self.TEXT), partition="a")
+        index.add(2, get_signature("Something completely different about parliament"), partition="a")
+        index.add(3, get_signature(self.TEXT), partition="b")
+
+        near = get_signature(self.TEXT.replace("lazy", "sleepy"))
+        self.assertEqual(index.get_candidates(near, partition="a"), {1})
+        self.assertEqual(index.get_candidates(near, partition="b"), {3})
+        self.assertEqual(index.get_candidates(near, partition="c"), set())
@@ -26,8 +26,9 @@ Also paves the way for more customization, i.e. allowing Lexis style queries
 
 from __future__ import unicode_literals, print_function, absolute_import
 from pyparsing import ParseResults, ParserElement
-import itertools, collections
+import itertools, collections, copy, threading, time
 from amcat.tools.toolkit import stripAccents
+from amcat.tools.caching import LRUCache
 
 ParserElement.enablePackrat()
 
@@ -210,7 +211,8 @@ class Span(Boolean, FieldTerm):
 
 def lucene_span(quote, field, slop):
     '''Create a span query from a lucene style string, i.e. "terms"~10'''
-    clause = parse_to_terms(quote, simplify_terms=False)
+    # not cached, as Span modifies the terms
+    clause = _parse_to_terms(quote, simplify_terms=False)
     if not (isinstance(clause, Boolean) and clause.operator == "OR" and clause.implicit):
         raise ParseError("Lucene-style proximity queries must contain a list of terms, not {clause!r}"
                          .format(**locals()))
@@ -311,7 +313,7 @@ def simplify(term):
 class QueryParseError(Exception):
     pass
         
-def parse_to_terms(s, simplify_terms=True, strip_accents=True):
+def _parse_to_terms(s, simplify_terms=True, strip_accents=True):
     if strip_accents:
         s = stripAccents(s)
     try:
@@ -322,11 +324,82 @@ def parse_to_terms(s, simplify_terms=True, strip_accents=True):
     if simplify_terms:
         terms = simplify(terms)
     return terms
+
+###########################################################################
+#                       Q U E R Y   C A C H I N G                         #
+###########################################################################
+
+# Parsed queries keyed by (normalised query, simplify_terms, strip_accents)
+QUERY_CACHE = LRUCache(size=1000)
+
+# Per-thread (ie per-request) parse statistics, see get_stats
+_stats = threading.local()
+
+class _ParsedQuery(object):
+    """Cache entry holding the term tree of a query and its DSL (computed when needed)"""
+    __slots__ = ("terms", "dsl", "filter_dsl")
+    def __init__(self, terms):
+        self.terms = terms
+        self.dsl, self.filter_dsl = None, None
+
+def _normalise(s):
+    """Whitespace only separates tokens, so collapse it to get a canonical cache key"""
+    return " ".join(s.split())
+
+def reset_stats():
+    "Reset the parse statistics of the current thread, eg at the start of a request"
+    _stats.parses, _stats.hits, _stats.parse_time = 0, 0, 0.
+
+def get_stats():
+    """
+    @return: a dict with the number of queries parsed in the current thread, the number and
+             fraction of those found in the cache, and the time (in seconds) spent parsing
+    """
+    if not hasattr(_stats, "parses"):
+        reset_stats()
+    hit_rate = float(_stats.hits) / _stats.parses if _stats.parses else None
+    return dict(parses=_stats.parses, hits=_stats.hits, hit_rate=hit_rate, parse_time=_stats.parse_time)
+
+def _get_parsed(s, simplify_terms=True, strip_accents=True):
+    if not hasattr(_stats, "parses"):
+        reset_stats()
+    key = (_normalise(s), simplify_terms, strip_accents)
+    parsed = QUERY_CACHE.get(key)
+    if parsed is None:
+        start = time.time()
+        try:
+            parsed = _ParsedQuery(_parse_to_terms(key[0], simplify_terms, strip_accents))
+        finally:
+            _stats.parse_time += time.time() - start
+        QUERY_CACHE.set(key, parsed)
+    else:
+        _stats.hits += 1
+    _stats.parses += 1
+    return parsed
+
+def parse_to_terms(s, simplify_terms=True, strip_accents=True):
+    """
+    Parse the query string into a tree of terms. Parsed queries are cached (see QUERY_CACHE),
+    so the returned terms are shared and should not be modified.
+    """
+    return _get_parsed(s, simplify_terms, strip_accents).terms
+
+def get_dsl(s, strip_accents=True):
+    """Return the elastic query DSL for the query string, using the query cache"""
+    parsed = _get_parsed(s, strip_accents=strip_accents)
+    if parsed.dsl is None:
+        parsed.dsl = parsed.terms.get_dsl()
+    return copy.deepcopy(parsed.dsl)
+
+def get_filter_dsl(s, strip_accents=True):
+    """Return the elastic filter DSL for the query string, using the query cache"""
+    parsed = _get_parsed(s, strip_accents=strip_accents)
+    if parsed.filter_dsl is None:
+        parsed.filter_dsl = parsed.terms.get_filter_dsl()
+    return copy.deepcopy(parsed.filter_dsl)
     
 def parse(s):
-    terms = parse_to_terms(s)
-    dsl = terms.get_dsl()
-    return dsl
+    return get_dsl(s)
 
 
 ###########################################################################
@@ -404,6 +477,33 @@ class TestQueryParser(amcattest.AmCATTestCase):
 
         self.assertEqual(q('a W/10 (b c)'), expected)
 
+    def test_cache(self):
+        QUERY_CACHE.clear()
+        reset_stats()
+        t = parse_to_terms('a AND (b c)')
+        self.assertIs(parse_to_terms(' a  AND\n(b c) '), t)
+        self.assertIsNot(parse_to_terms('a AND (b c)', simplify_terms=False), t)
+        stats = get_stats()
+        self.assertEqual((stats['parses'], stats['hits'], stats['hit_rate']), (3, 1, 1/3.))
+        self.assertGreater(stats['parse_time'], 0)
+
+        # dsl should be cached but returned as a copy
+        dsl = get_dsl('a AND (b c)')
+        self.assertEqual(dsl, t.get_dsl())
+        dsl['bool']['must'] = []
+        self.assertEqual(get_dsl('a AND (b c)'), t.get_dsl())
+        self.assertEqual(get_filter_dsl('a AND (b c)'), t.get_filter_dsl())
+        self.assertEqual(get_stats()['parses'], 6)
+
+        # accent stripping is part of the key
+        self.assertEqual(unicode(parse_to_terms('\xe9')), '_all::e')
+        self.assertEqual(unicode(parse_to_terms('\xe9', strip_accents=False)), '_all::\xe9')
+
+        # span queries should not modify cached terms
+        parse_to_terms('x:a b', simplify_terms=False)
+        self.assertEqual(unicode(parse_to_terms('x:"a b"~5')), 'x::PROX/5[a b]')
+        self.assertEqual(unicode(parse_to_terms('x:a b', simplify_terms=False)), 'OR[x::a _all::b]')
+
     def todo_test_rewrite(self):
         t = parse_to_terms("(a (b c)) NOT ((a (b c)) d e (f AND (g AND (i OR k))))")
         #t = parse_to_terms("(a (b c)) NOT (x y)")
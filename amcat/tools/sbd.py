@@ -18,17 +18,34 @@
 ###########################################################################
 
 """
-Simple regex-based sentence boundary detection
+Simple rule-based sentence boundary detection
+
+Sentences end at a period, question or exclamation mark, unless it follows an
+abbreviation or single letter, or is followed by a word character, comma or
+lower case word. Paragraph breaks (empty lines) always end a sentence.
+The rules are implemented by SentenceSplitter in a single scan over the
+candidate boundaries; split_regex is the equivalent (but slower) regular
+expression, kept as a reference.
 """
 
-import re, collections
+import re, collections, itertools, string, time, random
 from amcat.tools import toolkit
 
 abbrevs = ["ir","mr","dr","dhr","ing","drs","mrs","sen","sens","gov","st",
            "jr","rev","vs","gen","adm","sr","lt","sept"]
 months = ["Jan", "Feb", "Mar", "Apr", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
 
+# Extra abbreviations per language, used in addition to abbrevs and months
+language_abbrevs = {
+    "nl" : ["bijv", "blz", "ca", "evt", "jhr", "mevr", "mw", "prof", "resp", "zgn"],
+    "en" : ["capt", "col", "corp", "inc", "ltd", "prof", "sgt"],
+}
+
 from amcat.models.sentence import Sentence
+from amcat.models.article import Article
+
+# Number of sentences per insert statement in create_sentences_bulk
+BULK_INSERT_SIZE = 10000
 
 def get_split_regex():
     global _split_regex
@@ -60,14 +77,26 @@ def get_or_create_sentences(article):
         create_sentences(article)
     return article.sentences.all()
 
+def get_sentences(headline, byline, text):
+    """
+    Split the headline, byline and text of an article into paragraphs and sentences
+    @return: a list of (parnr, sentnr, sentence) tuples
+    """
+    pars = [headline]
+    if byline: pars += [byline]
+    pars += re.split(r"\n\s*\n[\s\n]*", text.strip())
+    return [(parnr+1, sentnr+1, sent)
+            for parnr, par in enumerate(pars)
+            for sentnr, sent in enumerate(split(par))]
+
+def _split_article(args):
+    """Split an (id, headline, byline, text) tuple, for use in multiprocessing"""
+    aid, headline, byline, text = args
+    return aid, get_sentences(headline, byline, text)
+
 def _create_sentences(article):
-    pars = [article.headline]
-    if article.byline: pars += [article.byline]
-    pars += re.split(r"\n\s*\n[\s\n]*", article.text.strip())
-    for parnr, par in enumerate(pars):
-        for sentnr, sent in enumerate(split(par)):
-            yield Sentence(parnr=parnr+1, sentnr=sentnr+1,
-                            article=article, sentence=sent)
+    for parnr, sentnr, sent in get_sentences(article.headline, article.byline, article.text):
+        yield Sentence(parnr=parnr, sentnr=sentnr, article=article, sentence=sent)
 
 def create_sentences(article):
     """
@@ -80,11 +109,128 @@ def create_sentences(article):
     Sentence.objects.bulk_create(sents)
     return sents
 
+def create_sentences_bulk(article_ids, pool=None):
+    """
+    Split the given articles into sentences and save them using a single bulk insert.
+    Callers should make sure the articles are not split yet.
+    @param article_ids: the ids of the articles to split
+    @param pool: an optional multiprocessing pool to split the articles with
+    @return: the number of sentences created
+    """
+    articles = Article.objects.filter(pk__in=article_ids).values_list("id", "headline", "byline", "text")
+    imap = pool.imap_unordered if pool else itertools.imap
+    sents = [Sentence(article_id=aid, parnr=parnr, sentnr=sentnr, sentence=sent)
+             for aid, sentences in imap(_split_article, articles)
+             for (parnr, sentnr, sent) in sentences]
+    Sentence.objects.bulk_create(sents, batch_size=BULK_INSERT_SIZE)
+    return len(sents)
+
+_WORD = frozenset(string.ascii_letters + string.digits + "_")
+_LETTER = frozenset(string.ascii_letters)
+_LOWER = frozenset(string.ascii_lowercase)
+_DIGIT = frozenset(string.digits)
+_SPACE = frozenset(" \t\n\r\f\v")
+_END = None # marks a complete abbreviation in the trie
+
+# Candidate boundaries: paragraph breaks, punctuation that is not followed by a
+# period, word character, comma or lower case word (which is then checked for a
+# preceding abbreviation), and periods followed by a space (a possible month)
+_CANDIDATES = re.compile(r"(\n\n+)|([.?!])(?!\.\.|[\w,]|\s[a-z])|\.(?= \D)")
+_WHITESPACE = re.compile(r"\s+")
+
+class SentenceSplitter(object):
+    """
+    Sentence splitter that finds all candidate boundaries in one scan and checks
+    the word before a candidate by walking a trie of reversed abbreviations.
+    """
+    def __init__(self, abbreviations=abbrevs + months, months=months):
+        """
+        @param abbreviations: words that are not a sentence end if followed by a period
+        @param months: month abbreviations, which are a sentence end if followed by a
+                       space and a non-digit (eg 'in Jan. Then' but not 'on Jan. 3')
+        """
+        self.trie = {}
+        for abbrev in abbreviations:
+            for a in (abbrev, abbrev.title()):
+                node = self.trie
+                for c in reversed(a):
+                    node = node.setdefault(c, {})
+                node[_END] = True
+        self.months = frozenset(months)
+
+    def is_abbreviated(self, text, i):
+        """Is the punctuation at text[i] preceded by a single letter, a period or an abbreviation?"""
+        if i == 0:
+            return False
+        c = text[i-1]
+        if c in _LETTER and (i == 1 or text[i-2] not in _WORD):
+            return True
+        if c == "." and text[i] == ".":
+            return True
+        node, j = self.trie, i - 1
+        while j >= 0:
+            node = node.get(text[j])
+            if node is None:
+                return False
+            if _END in node and (j == 0 or text[j-1] not in _WORD):
+                return True
+            j -= 1
+        return False
+
+    def is_month(self, text, i):
+        """Is text[i] a period after a month abbreviation, followed by a space and a non-digit?"""
+        return (text[i] == "." and i >= 3 and text[i-3:i] in self.months
+                and text[i+1:i+2] == " " and text[i+2:i+3] not in _DIGIT and i + 2 < len(text))
+
+    def get_spans(self, text):
+        """Yield the (start, end) offsets of the sentences (including whitespace) in the text"""
+        start = 0
+        for m in _CANDIDATES.finditer(text):
+            i = m.start()
+            if m.lastindex == 1: # paragraph break
+                end = m.end()
+            elif m.lastindex == 2 and not self.is_abbreviated(text, i):
+                end = i + 1
+            elif self.is_month(text, i):
+                end = i + 2
+            else:
+                continue
+            yield start, i
+            start = end
+        yield start, len(text)
 
-def split(text):
+    def split(self, text):
+        """Split the text into sentences and yield the (whitespace normalized) sentence strings"""
+        text = text.replace(".'", "'.")
+        for start, end in self.get_spans(text):
+            sent = text[start:end].strip()
+            if sent:
+                yield _WHITESPACE.sub(' ', sent)
+
+_splitters = {}
+
+def get_splitter(language=None):
+    """
+    Get the (cached) sentence splitter for the given language
+    @param language: a language code in language_abbrevs, or None for the default rules
+    """
+    try:
+        return _splitters[language]
+    except KeyError:
+        splitter = SentenceSplitter(abbrevs + months + language_abbrevs.get(language, []))
+        return _splitters.setdefault(language, splitter)
+
+def split(text, language=None):
     """
     Split the text into sentences and yield the sentence strings
     """
+    return get_splitter(language).split(text)
+
+def split_regex(text):
+    """
+    Split the text into sentences using a single regular expression.
+    This gives the same result as split (for the default language), but is slower.
+    """
     text = re.sub("\n\n+", "\n\n", text)
     text = text.replace(".'", "'.")
 
@@ -92,6 +238,47 @@ def split(text):
             for sent in get_split_regex().split(text)
             if sent.strip())
 
+def _get_test_text(rnd, nwords=100):
+    """Generate a random text with many (near) sentence boundaries, to compare split and split_regex"""
+    words = (abbrevs + months + [a.title() for a in abbrevs] +
+             ["a", "B", "x", "the", "zin", "Word", "12", "3", "_", u"\xe9t\xe9", "s.v.p."])
+    seps = [" ", " ", " ", ". ", "! ", "? ", ", ", ".", ".. ", "... ", "\n", "\n\n", "\n\n\n",
+            ". \n", ".' ", "'. ", " .", ".,", "\t", ".\t"]
+    return "".join(rnd.choice(words) + rnd.choice(seps) for _ in range(nwords))
+
+def _get_benchmark_text(rnd, nsentences=50):
+    """Generate a random text of sentences with occasional abbreviations, months and numbers"""
+    words = ["the", "minister", "said", "that", "government", "would", "not", "comment", "on",
+             "report", "de", "het", "een", "kabinet", "heeft", "gisteren", "besloten", "over"]
+    specials = ["Mr.", "dr.", "Jan.", "Sept. 3", "3.5", "e.g.,", "U.S.", "St."]
+    sentences = []
+    for _ in range(nsentences):
+        sent = [rnd.choice(specials) if rnd.random() < .05 else rnd.choice(words)
+                for _ in range(rnd.randint(5, 30))]
+        sentences.append(" ".join(sent).capitalize() + rnd.choice(".....?!"))
+        if rnd.random() < .2:
+            sentences.append("\n\n")
+    return " ".join(sentences)
+
+def benchmark(ntexts=1000, nsentences=50, seed=0):
+    """
+    Compare the speed of split and split_regex on random texts, and check that they give the same result
+    @return: a dict of {method : sentences/sec}
+    """
+    rnd = random.Random(seed)
+    texts = [_get_benchmark_text(rnd, nsentences) for _ in range(ntexts)]
+    result, rates = {}, {}
+    for name, func in [("regex", split_regex), ("scan", split)]:
+        t = time.time()
+        sentences = [list(func(text)) for text in texts]
+        t = time.time() - t
+        n = sum(map(len, sentences))
+        result[name], rates[name] = sentences, n / t
+        print("{name}: {n} sentences in {t:.2f} seconds, {rate:.0f} sentences/sec"
+              .format(rate=n/t, **locals()))
+    if result["regex"] != result["scan"]:
+        raise AssertionError("split and split_regex give different results")
+    return rates
 
 ###########################################################################
 #                          U N I T   T E S T S                            #
@@ -123,3 +310,26 @@ class TestSBD(amcattest.AmCATTestCase):
 
                                           
         
+
+    def test_create_sentences_bulk(self):
+        a = amcattest.create_test_article(headline="Headline", text="A sentence. Another one")
+        b = amcattest.create_test_article(headline="Other", byline="By me", text="Text")
+        self.assertEqual(create_sentences_bulk([a.id, b.id]), 6)
+        sents = set(Sentence.objects.filter(article__in=[a, b]).values_list("article_id", "parnr", "sentnr", "sentence"))
+        self.assertEqual(sents, {(a.id, 1, 1, "Headline"), (a.id, 2, 1, "A sentence"), (a.id, 2, 2, "Another one"),
+                                 (b.id, 1, 1, "Other"), (b.id, 2, 1, "By me"), (b.id, 3, 1, "Text")})
+
+    def test_split_regex(self):
+        """Does split give the same result as the regular expression?"""
+        rnd = random.Random(0)
+        for _ in range(1000):
+            text = _get_test_text(rnd, rnd.randint(1, 30))
+            self.assertEqual(list(split(text)), list(split_regex(text)))
+
+    def test_language(self):
+        text = "Zie bijv. de tekst. En prof. Jansen"
+        self.assertEqual(list(split(text)), ["Zie bijv. de tekst", "En prof", "Jansen"])
+        self.assertEqual(list(split(text, language="nl")), ["Zie bijv. de tekst", "En prof. Jansen"])
+
+if __name__ == '__main__':
+    benchmark()
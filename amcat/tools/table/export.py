@@ -20,16 +20,23 @@
 # exportfunction(table, outfile
 
 from cStringIO import StringIO
-import csv, zipfile, io
+from functools import partial
+import csv, zipfile, io, os, tempfile
+
+# Approximate size of the chunks yielded by TableExporter.export_chunks
+CHUNK_SIZE = 64 * 1024
 
 class TableExporter():
     """
     General export class for tables
-    Subclasses or instantiators should provide either a to_stream or a to_bytes method
+    Subclasses or instantiators should provide either a to_chunks, to_stream or a to_bytes method.
+    to_chunks should yield the output as byte strings of about chunk_size bytes, so large
+    tables can be exported with bounded memory use.
     """
-    def __init__(self, to_stream=None, to_bytes=None, name=None):
+    def __init__(self, to_stream=None, to_bytes=None, to_chunks=None, name=None):
         if to_stream is not None: self.to_stream = to_stream
         if to_bytes is not None: self.to_bytes = to_bytes
+        if to_chunks is not None: self.to_chunks = to_chunks
         if name: self.name = name
 
     @property
@@ -42,36 +49,62 @@ class TableExporter():
         Export the table to the given stream. 
         @return: str if stream is None, otherwise undefined
         """
+        if stream is not None and hasattr(self, "to_stream") and not hasattr(self, "to_chunks"):
+            self.to_stream(table, stream, encoding=encoding, **kargs)
+            return
+        chunks = self.export_chunks(table, encoding=encoding, **kargs)
+        if stream is None:
+            return b"".join(chunks)
+        for chunk in chunks:
+            stream.write(chunk)
+
+    def export_chunks(self, table, encoding="utf-8", chunk_size=CHUNK_SIZE, **kargs):
+        """
+        Export the table as a sequence of byte strings, eg to use in a StreamingHttpResponse.
+        Memory use is only bounded by chunk_size if the exporter has a to_chunks method.
+        """
+        if hasattr(self, "to_chunks"):
+            return self.to_chunks(table, encoding=encoding, chunk_size=chunk_size, **kargs)
         if hasattr(self, "to_stream"):
-            if stream is None:
-                stream = StringIO()
+            stream = StringIO()
             self.to_stream(table, stream, encoding=encoding, **kargs)
-            try:
-                return stream.getvalue()
-            except AttributeError:
-                return
-        else:
-            bytes = self.to_bytes(table, encoding=encoding, **kargs)
-            if stream is not None:
-                stream.write(bytes)
-                return
-            else:
-                return bytes
+            return [stream.getvalue()]
+        return [self.to_bytes(table, encoding=encoding, **kargs)]
+
+class _ChunkBuffer(object):
+    """Write-only file-like object that collects output until it is popped"""
+    def __init__(self):
+        self.data, self.size = [], 0
+    def write(self, s):
+        self.data.append(s)
+        self.size += len(s)
+    def pop(self):
+        result = b"".join(self.data)
+        self.data, self.size = [], 0
+        return result
+
+def _read_chunks(f, chunk_size):
+    """Yield the contents of the file f from the current position in chunks"""
+    return iter(partial(f.read, chunk_size), b"")
 
 class CSV(TableExporter):
     extension="csv"
     dialect = csv.excel
-    def to_stream(self, table, stream, encoding):
+    def to_chunks(self, table, encoding, chunk_size=CHUNK_SIZE):
         def encode(val):
             if val is None: return val
             return unicode(val).encode(encoding)
-        
-        csvwriter = csv.writer(stream, dialect=self.dialect)
+
+        buffer = _ChunkBuffer()
+        csvwriter = csv.writer(buffer, dialect=self.dialect)
         
         cols = list(table.getColumns())
         csvwriter.writerow([encode(col) for col in cols])
-        for row in table.getRows():            
-            csvwriter.writerow([encode(table.getValue(row, col)) for col in cols])
+        for values in table.getRowValues(cols):
+            csvwriter.writerow([encode(val) for val in values])
+            if buffer.size >= chunk_size:
+                yield buffer.pop()
+        yield buffer.pop()
 
 class CSV_semicolon(CSV):
     name = "CSV (semicolon)"
@@ -81,40 +114,171 @@ class CSV_semicolon(CSV):
 
 class XLSX(TableExporter):
     extension = "xlsx"
-    def to_bytes(self, table, **kargs):
+    def to_chunks(self, table, chunk_size=CHUNK_SIZE, **kargs):
         # Import openpyxl "lazy" to prevent global dependency
         from openpyxl.workbook import Workbook
         from openpyxl.writer.dump_worksheet import ExcelDumpWriter
 
         wb = Workbook(optimized_write = True)
         ws = wb.create_sheet()
+
+        columns = list(table.getColumns())
+        ws.append(([""] if table.rowNamesRequired else []) + map(unicode, columns)) # write column names
         
-        ws.append(([""] if table.rowNamesRequired else []) + map(unicode, list(table.getColumns()))) # write column names
-        
-        for row in table.getRows():
-            values = [unicode(row)] if table.rowNamesRequired else []
-            values += [table.getValue(row, column) for column in table.getColumns()]
+        for values in table.getRowValues(columns, rowNames=table.rowNamesRequired):
+            if table.rowNamesRequired:
+                values[0] = unicode(values[0])
             ws.append(values)
         writer = ExcelDumpWriter(wb)
-        # need to do a little bit more work here, since the openpyxl library only supports writing to a filename, while we need a buffer here..
-        #buffer = StringIO()
-        buffer = io.BytesIO()
-        zf = zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED)
-        writer.write_data(zf)
-        zf.close()
-        buffer.flush()
-        return buffer.getvalue()
+        # openpyxl (optimized_write) keeps the rows in temporary files, but needs a seekable
+        # file to write the zip to, so write it to a temporary file and stream that
+        with tempfile.TemporaryFile() as f:
+            zf = zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED)
+            writer.write_data(zf)
+            zf.close()
+            f.seek(0)
+            for chunk in _read_chunks(f, chunk_size):
+                yield chunk
 
 class SPSS(TableExporter):
     extension = 'spss'
-    def to_bytes(self, table, **kargs):
+    def to_chunks(self, table, chunk_size=CHUNK_SIZE, **kargs):
         from . import table2spss
         
         filename = table2spss.table2sav(table)
-        return open(filename, 'rb').read()
+        try:
+            with open(filename, 'rb') as f:
+                for chunk in _read_chunks(f, chunk_size):
+                    yield chunk
+        finally:
+            os.remove(filename)
         
 EXPORTERS = {'csv' : CSV(),
              'csv2' : CSV_semicolon(),
              'xlsx' : XLSX(),
              'spss' : SPSS(),
              }
+
+def benchmark(format, nrows, ncols=10):
+    """
+    Export a generated table of nrows x ncols to /dev/null in the given format
+    @return: a tuple of rows/sec and peak RSS (in KB) of the current process
+    """
+    import time, resource, datetime
+    from amcat.tools.table import table3
+    t = table3.ObjectTable(rows=xrange(nrows))
+    for i in range(ncols):
+        if i % 3 == 0:
+            t.addColumn(table3.ObjectColumn("int{i}".format(**locals()), lambda r: r, fieldtype=int))
+        elif i % 3 == 1:
+            t.addColumn(table3.ObjectColumn("str{i}".format(**locals()), lambda r: "row %i" % r, fieldtype=unicode))
+        else:
+            t.addColumn(table3.ObjectColumn("date{i}".format(**locals()), lambda r: datetime.datetime(2001, 1, 1),
+                                            fieldtype=datetime.datetime))
+    start = time.time()
+    with open(os.devnull, 'wb') as out:
+        EXPORTERS[format].export(t, stream=out)
+    rate = nrows / (time.time() - start)
+    return rate, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+if __name__ == '__main__':
+    # Benchmark the exporters, each in a separate process to measure peak memory use
+    # usage: python -m amcat.tools.table.export [nrows]
+    import sys
+    from multiprocessing import Pool
+    nrows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for format in sorted(EXPORTERS):
+        pool = Pool(1)
+        try:
+            rate, rss = pool.apply(benchmark, (format, nrows))
+            print("{format:5}: {rate:10.0f} rows/sec, peak RSS {rss} KB".format(**locals()))
+        except Exception, e:
+            print("{format:5}: failed: {e}".format(**locals()))
+        finally:
+            pool.terminate()
+
+###########################################################################
+#                          U N I T   T E S T S                            #
+###########################################################################
+
+from amcat.tools import amcattest
+import unittest
+
+class TestExport(amcattest.AmCATTestCase):
+    def _get_table(self, nrows=1000):
+        from amcat.tools.table import table3
+        t = table3.ColumnarTable(["id", "label"], columnTypes=dict(id=int, label=unicode))
+        t.extend((i, u"row \xe9 {i}".format(**locals())) for i in range(nrows))
+        return t
+
+    def test_csv_chunks(self):
+        """Are CSV exports split in chunks of about chunk_size bytes?"""
+        t = self._get_table()
+        chunks = list(CSV().export_chunks(t, chunk_size=1000))
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks[:-1]:
+            # a chunk is yielded as soon as it reaches chunk_size, so it exceeds it by at most a row
+            self.assertGreaterEqual(len(chunk), 1000)
+            self.assertLess(len(chunk), 1100)
+        self.assertEqual(b"".join(chunks), CSV().export(t))
+        self.assertEqual(b"".join(chunks).decode("utf-8").splitlines()[:2], [u"id,label", u"0,row \xe9 0"])
+
+    def test_export_stream(self):
+        """Does export write the chunks to the stream?"""
+        t = self._get_table()
+        for exporter in [CSV(), CSV_semicolon()]:
+            stream = StringIO()
+            self.assertIsNone(exporter.export(t, stream=stream))
+            self.assertEqual(stream.getvalue(), exporter.export(t))
+
+        # exporters with only to_stream or to_bytes
+        to_stream = TableExporter(to_stream=lambda table, stream, **kargs: stream.write(b"stream"))
+        self.assertEqual(list(to_stream.export_chunks(t)), [b"stream"])
+        self.assertEqual(to_stream.export(t), b"stream")
+        to_bytes = TableExporter(to_bytes=lambda table, **kargs: b"bytes")
+        stream = StringIO()
+        to_bytes.export(t, stream=stream)
+        self.assertEqual(stream.getvalue(), b"bytes")
+
+    def test_xlsx(self):
+        """Is the XLSX export a valid workbook, also if it is streamed in chunks?"""
+        try:
+            from openpyxl import load_workbook
+        except ImportError:
+            raise unittest.SkipTest("OpenPyxl not installed, skipping excel test")
+        t = self._get_table()
+        chunks = list(XLSX().export_chunks(t, chunk_size=1000))
+        self.assertGreater(len(chunks), 1)
+
+        wb = load_workbook(io.BytesIO(b"".join(chunks)))
+        ws = wb.get_sheet_by_name(wb.get_sheet_names()[0])
+        rows = [[cell.value for cell in row] for row in ws.rows]
+        self.assertEqual(rows, [[u"id", u"label"]] + [list(r) for r in t])
+
+    def test_spss(self):
+        """Does the SPSS export remove its .sav file, also if it is not read completely?"""
+        from distutils.spawn import find_executable
+        if not find_executable("pspp"):
+            raise unittest.SkipTest("pspp not installed, skipping spss test")
+        from amcat.tools.table import table2spss
+        t = self._get_table()
+
+        filenames = []
+        table2sav = table2spss.table2sav
+        def _table2sav(table):
+            filenames.append(table2sav(table))
+            return filenames[-1]
+        table2spss.table2sav = _table2sav
+        try:
+            chunks = SPSS().export_chunks(t, chunk_size=100)
+            data = b"".join(chunks)
+            self.assertTrue(data.startswith(b"$FL2"))
+            self.assertFalse(os.path.exists(filenames[-1]))
+
+            chunks = SPSS().export_chunks(t, chunk_size=100)
+            next(chunks)
+            self.assertTrue(os.path.exists(filenames[-1]))
+            chunks.close()
+            self.assertFalse(os.path.exists(filenames[-1]))
+        finally:
+            table2spss.table2sav = table2sav
@@ -66,11 +66,10 @@ def table2spss(t, writer=sys.stdout, saveas=None):
 
     log.debug("Writing data")
     valuelabels = collections.defaultdict(dict) # col : id : label
-    for row in t.getRows():
-        for i, col in enumerate(cols):
+    for values in t.getRowValues(cols):
+        for i, (col, val) in enumerate(zip(cols, values)):
             if i: writer.write(",")
             typ = vartypes[col]
-            val = t.getValue(row, col)
             oval = val
             #if val and issubclass(col.fieldtype, (idlabel.IDLabel, )):
             #    if type(val) == int:
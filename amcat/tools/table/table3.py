@@ -37,6 +37,8 @@ from amcat.tools.table import tableoutput
 from amcat.tools.table.export import EXPORTERS
 
 from collections import namedtuple
+from array import array
+from itertools import izip
 
 import types, re
 from amcat.contrib.oset import OrderedSet
@@ -92,6 +94,23 @@ class Table(object):
         if column in self.columnTypes:
             return self.columnTypes[column]
         return getattr(column, "fieldtype", None)
+
+    # Bulk access, overridden by column-oriented tables
+    def getColumnValues(self, column):
+        """Get a sequence of the values of the given column, in the order of getRows()"""
+        return [self.getValue(row, column) for row in self.getRows()]
+    def getRowValues(self, columns=None, rowNames=False):
+        """
+        Iterate over the rows, yielding a list of values per row
+        @param columns: the columns to include, defaults to getColumns()
+        @param rowNames: if True, the row object is inserted as the first value
+        """
+        columns = list(self.getColumns() if columns is None else columns)
+        getValue = self.getValue
+        for row in self.getRows():
+            values = [getValue(row, col) for col in columns]
+            if rowNames: values.insert(0, row)
+            yield values
         
     # Convenience access using iteration / index and NamedRows
     def getNamedRows(self):
@@ -362,6 +381,126 @@ class ListTable(Table):
         if col.id >= len(row): return None
         return row[col.id]
 
+# Array typecodes used by ColumnarTable for compact storage of numeric columns
+COLUMN_TYPECODES = {int : b'l', long : b'l', float : b'd'}
+
+class _ColumnData(object):
+    """
+    Values of a ColumnarTable column. Numeric columns are stored in an array, with
+    the indexes of missing (None) values in a set. Other columns are stored in a list,
+    with equal strings stored only once. If a value does not fit in the array (eg a
+    string in an int column), the column falls back to a list.
+    """
+    def __init__(self, fieldtype=None):
+        self.fieldtype = fieldtype
+        typecode = COLUMN_TYPECODES.get(fieldtype)
+        self.values = array(typecode) if typecode else []
+        self.nulls = set() if typecode else None
+        self.strings = {} if fieldtype in (str, unicode) else None
+
+    def append(self, value):
+        if self.nulls is not None and value is None:
+            self.nulls.add(len(self.values))
+            value = 0
+        elif self.strings is not None and value is not None:
+            value = self.strings.setdefault(value, value)
+        try:
+            self.values.append(value)
+        except (TypeError, OverflowError):
+            self.values = list(self)
+            self.values.append(value)
+            self.nulls = None
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, i):
+        if self.nulls and i in self.nulls:
+            return None
+        return self.values[i]
+
+    def __iter__(self):
+        if not self.nulls:
+            return iter(self.values)
+        return (None if i in self.nulls else v for (i, v) in enumerate(self.values))
+
+class ColumnarTable(Table):
+    """
+    Table that stores its values per column. Columns with type int or float are stored in
+    compact arrays, and equal strings in str/unicode columns are stored only once. Rows are
+    identified by their index. Use getColumnValues and getRowValues for bulk access.
+    """
+    def __init__(self, columns=None, columnTypes=None, rowNamesRequired=False):
+        """
+        @param columns: a sequence of column names
+        @param columnTypes: a dict of column name : type (eg int, float, unicode)
+        """
+        super(ColumnarTable, self).__init__(columns=[], cellfunc=None, rowNamesRequired=rowNamesRequired)
+        self.nrows = 0
+        self._data = []
+        columnTypes = columnTypes or {}
+        for name in columns or []:
+            self.addColumn(name, columnTypes.get(name))
+
+    @classmethod
+    def from_table(cls, table):
+        """Create a columnar copy of the given table"""
+        columns = list(table.getColumns())
+        result = cls(rowNamesRequired=table.rowNamesRequired)
+        for col in columns:
+            result.addColumn(unicode(col), table.getColumnType(col))
+        result.extend(table.getRowValues(columns))
+        return result
+
+    def addColumn(self, label, fieldtype=None, values=None):
+        """
+        Add a column with the given label and type
+        @param values: the values for the existing rows (defaults to all None)
+        @return: the new column object
+        """
+        data = _ColumnData(fieldtype)
+        data.extend([None] * self.nrows if values is None else values)
+        if len(data) != self.nrows:
+            raise ValueError("Column {label!r} has {n} values, table has {self.nrows} rows"
+                             .format(n=len(data), **locals()))
+        col = idlabel.IDLabel(len(self.columns), label)
+        self.columns.append(col)
+        self._data.append(data)
+        return col
+
+    def addRow(self, *values):
+        """Append a row with the given values (one for each column)"""
+        if len(values) != len(self._data):
+            raise ValueError("Expected {} values, got {}".format(len(self._data), len(values)))
+        for data, value in zip(self._data, values):
+            data.append(value)
+        self.nrows += 1
+
+    def extend(self, rows):
+        """Append the given rows (sequences of values)"""
+        for row in rows:
+            self.addRow(*row)
+
+    def getRows(self):
+        return xrange(self.nrows)
+    def getValue(self, row, column):
+        return self._data[column.id][row]
+    def getColumnType(self, column):
+        return self._data[column.id].fieldtype
+    def getColumnValues(self, column):
+        return self._data[column.id]
+    def getRowValues(self, columns=None, rowNames=False):
+        columns = self.columns if columns is None else columns
+        values = [self._data[col.id] for col in columns]
+        if rowNames:
+            values.insert(0, self.getRows())
+        for row in izip(*values):
+            yield list(row)
+
 class WrappedTable(Table):
     """Base class for encapsulating another table to provide a different 'view' on it"""
     def __init__(self, table, *args, **kargs):
@@ -401,7 +540,15 @@ class SortedTable(WrappedTable):
             return cmp(*ab) * (1 if asc else -1)
         return 0
     def getRows(self):
-        return sorted(self.table.getRows(), cmp=self.cmp)
+        rows = list(self.table.getRows())
+        if not self.sort:
+            return rows
+        # Sort an index on the column values, using stable sorts from the least significant column
+        index = range(len(rows))
+        for col, asc in reversed(self.sort):
+            values = self.table.getColumnValues(col)
+            index.sort(key=values.__getitem__, reverse=not asc)
+        return [rows[i] for i in index]
 
 class MergedTable(Table):
     """
@@ -422,8 +569,8 @@ class MergedTable(Table):
                        if self.columnfilter(table, c)]
         return result
     def getRows(self):
-        # Iterators would be good here!
-        rowss = [t.getRows() for t in self.tables]
+        # getRows can return a generator (e.g. for a MergedTable), so copy the rows
+        rowss = [list(t.getRows()) for t in self.tables]
         for i in range(max(len(rows) for rows in rowss)):
             row = []
             for rows in rowss:
@@ -435,6 +582,11 @@ class MergedTable(Table):
         row = row[self.tables.index(table)]
         if not row: return None
         return table.getValue(row, col)
+    def getColumnValues(self, col):
+        table, col = col.id
+        values = list(table.getColumnValues(col))
+        nrows = max(len(list(t.getRows())) for t in self.tables)
+        return values + [None] * (nrows - len(values))
 
 class ColumnViewTable(WrappedTable):
     """Table wrapper that hides unselected columns"""
@@ -533,6 +685,49 @@ UKKKKKKHKKKKHKKKKKKKKKX'''
         s = SortedTable(p, t.getColumns()[2])
         self.assertEqual([list(row) for row in s], [[1, 4, 9], [16, 25, 16], [49, 64, 81]])
         
+    def test_columnar_table(self):
+        """Does the columnar table store typed columns and support bulk access?"""
+        t = ColumnarTable(["a", "b", "c"], columnTypes=dict(a=int, b=unicode))
+        t.addRow(3, "x", None)
+        t.extend([(None, "y", 1.5), (1, "x", "z")])
+        a, b, c = t.getColumns()
+        self.assertEqual(list(t.getRows()), [0, 1, 2])
+        self.assertEqual(t.getValue(1, a), None)
+        self.assertEqual(list(t.getColumnValues(a)), [3, None, 1])
+        self.assertIsInstance(t.getColumnValues(a).values, array)
+        self.assertIs(t.getValue(0, b), t.getValue(2, b))
+        self.assertEqual(list(t.getRowValues([c, a], rowNames=True)), [[0, None, 3], [1, 1.5, None], [2, "z", 1]])
+        self.assertEqual(t.getColumnType(a), int)
+
+        # values that do not fit the array should be kept
+        t.addRow(2**80, "x", None)
+        self.assertEqual(list(t.getColumnValues(a)), [3, None, 1, 2**80])
+
+        d = t.addColumn("d", float, values=[1, 2, 3, None])
+        self.assertEqual([list(r) for r in t], [[3, "x", None, 1.], [None, "y", 1.5, 2.],
+                                                [1, "x", "z", 3.], [2**80, "x", None, None]])
+        self.assertRaises(ValueError, t.addRow, 1, 2)
+        self.assertRaises(ValueError, t.addColumn, "e", values=[1])
+
+        # should work with the wrappers and exporters
+        s = SortedTable(t, [(b, False), d])
+        self.assertEqual([list(r) for r in s], [[None, "y", 1.5, 2.], [2**80, "x", None, None],
+                                                [3, "x", None, 1.], [1, "x", "z", 3.]])
+        self.assertEqual(t.to_csv().splitlines()[1], "3,x,,1.0")
+
+        l = ListTable(colnames = ["a1", "a2"], data = [[1, 2], [7, 8], [4, 5]])
+        t2 = ColumnarTable.from_table(l)
+        self.assertEqual(t2.to_csv(), l.to_csv())
+        m = MergedTable(l, t2)
+        self.assertEqual(list(m.getColumnValues(m.getColumns()[2])), [1, 7, 4])
+
+        # merged tables have generator rows, and should be mergeable as well
+        l2 = ListTable(colnames = ["b"], data = [[1], [2], [3], [4]])
+        m2 = MergedTable(m, l2)
+        self.assertEqual(list(m2.getColumnValues(m2.getColumns()[0])), [1, 7, 4, None])
+        self.assertEqual(list(m2.getColumnValues(m2.getColumns()[4])), [1, 2, 3, 4])
+        self.assertEqual(len(list(m2.getRows())), 4)
+
             
 # if __name__ == '__main__':
 #     import tableoutput
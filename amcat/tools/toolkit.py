@@ -520,7 +520,7 @@ class _DateFormat(object):
         self.swapamerican = swapamerican
     def readDate(self, date, american=False):
         """Read the given date, producing a y,m,d tuple"""
-        match = re.search(self.expr, date)
+        match = self.expr.search(date)
         if not match: return
         y, m, d = [match.group(x)
                    for x in (self.yeargroup, self.monthgroup, self.daygroup)]
@@ -631,9 +631,6 @@ def read_date(string, lax=False, rejectPre1970=False, american=False):
         if not time: time = (0, 0, 0)
         return datetime.datetime(*(date + time))
     except Exception,e:
-        import traceback
-        trace = traceback.format_exc()
-        #warn("Exception on reading datetime %s:\n%s\n%s" % (string, e, trace))
         if lax: return None
         else: raise
 readDate = read_date
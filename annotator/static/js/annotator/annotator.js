@@ -882,7 +882,8 @@ annotator = (function(self){
     self.pre_serialise_coded_article = function () {
         return {
             status_id : self.state.coded_article.status,
-            comments : self.state.coded_article.comments
+            comments : self.state.coded_article.comments,
+            version : self.state.coded_article.version
         }
     };
 
@@ -936,6 +937,7 @@ annotator = (function(self){
             "codings" : $.map(self.get_codings(), self.pre_serialise_coding)
         })).done(function(data, textStatus, jqXHR){
             self.loading_dialog.dialog("close");
+            self.state.coded_article.version = data.version;
 
             $.pnotify({
                 "title" : "Done",
@@ -958,7 +960,14 @@ annotator = (function(self){
             if (success_callback !== undefined && success_callback.currentTarget === undefined){
                 success_callback(data, textStatus, jqXHR);
             }
-        }).error(error_callback);
+        }).error(function(jqXHR, textStatus, errorThrown){
+            if (jqXHR.status === 409){
+                self.loading_dialog.dialog("close");
+                self.message_dialog.text("These codings were changed by someone else since you opened this " +
+                                         "article. Please reload the article before saving.").dialog("open");
+            }
+            error_callback(jqXHR, textStatus, errorThrown);
+        });
     };
 
     self.set_status = function(state){
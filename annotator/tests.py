@@ -5,7 +5,22 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+import json
+import logging
+import threading
+import time
+import unittest
+
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.client import Client
+from django.core.urlresolvers import reverse
+
+from amcat.models import CodedArticle
+from amcat.tools import amcattest
+from annotator.views.codingjob import save
+
+log = logging.getLogger(__name__)
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -21,3 +36,124 @@ Another way to test that 1 + 1 is equal to 2.
 True
 """}
 
+class TestSave(amcattest.AmCATTestCase):
+    def setUp(self):
+        self.schema, _, self.strf, self.intf, _ = amcattest.create_test_schema_with_fields(isarticleschema=True)
+        self.job = amcattest.create_test_job(articleschema=self.schema)
+        self.coded_article = self.job.coded_articles.get()
+        self.client = Client()
+        self.assertTrue(self.client.login(username=self.job.coder.username, password="test"))
+        self.url = reverse(save, kwargs=dict(project_id=self.job.project_id, codingjob_id=self.job.id,
+                                             coded_article_id=self.coded_article.id))
+
+    def _save(self, intval, version=None):
+        data = {"coded_article" : {"status_id" : 1, "comments" : "test", "version" : version},
+                "codings" : [{"sentence_id" : None, "start" : None, "end" : None,
+                              "values" : [{"codingschemafield_id" : self.intf.id, "intval" : intval}]}]}
+        return self.client.post(self.url, json.dumps(data), content_type="application/json")
+
+    def test_save(self):
+        response = self._save(1, version=0)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(json.loads(response.content), {"version" : 1})
+        self.assertEqual([[v.intval for v in vs] for (c, vs) in self.coded_article.get_codings()], [[1]])
+
+        # the codingjob data is cached in the session for the next saves
+        self.assertIn("annotator_codingjob_{}".format(self.job.id), self.client.session.keys())
+        response = self._save(2, version=1)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([[v.intval for v in vs] for (c, vs) in self.coded_article.get_codings()], [[2]])
+
+        # a save based on an old version is refused
+        response = self._save(3, version=1)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(json.loads(response.content)["version"], 2)
+        self.assertEqual([[v.intval for v in vs] for (c, vs) in self.coded_article.get_codings()], [[2]])
+
+        # clients that don't send a version can always save
+        self.assertEqual(self._save(4).status_code, 201)
+        self.assertEqual(CodedArticle.objects.get(pk=self.coded_article.id).version, 3)
+
+    def test_permission(self):
+        other = amcattest.create_test_user()
+        self.client.logout()
+        self.assertTrue(self.client.login(username=other.username, password="test"))
+        self.assertEqual(self._save(1).status_code, 403)
+
+def is_test_database():
+    """Is the configured database a database created for testing?"""
+    name = connection.settings_dict["NAME"]
+    return name == ":memory:" or name == connection.settings_dict.get("TEST_NAME") or name.startswith("test_")
+
+def benchmark(ncoders=10, nsaves=20, ncodings=20):
+    """
+    Simulate coders that concurrently autosave through the save view. Every coder has a
+    codingjob with an article with ncodings sentence codings, and changes one value before
+    every save. The test data is committed, as every coder uses its own connection, so this
+    refuses to run on a database that is not a test database. See TestSaveBenchmark.
+
+    @return: the number of saves per second
+    """
+    if not is_test_database():
+        raise Exception("Refusing to create benchmark data in database {!r}, which is not a test database"
+                        .format(connection.settings_dict["NAME"]))
+
+    schema, codebook, strf, intf, codef = amcattest.create_test_schema_with_fields()
+    project = amcattest.create_test_project()
+    jobs = []
+    for _ in range(ncoders):
+        job = amcattest.create_test_job(project=project, unitschema=schema, articleschema=schema)
+        coded_article = job.coded_articles.get()
+        sentences = [amcattest.create_test_sentence(article=coded_article.article) for _ in range(ncodings)]
+        jobs.append((job, coded_article, sentences))
+
+    errors = []
+    def code(job, coded_article, sentences):
+        client = Client()
+        url = reverse(save, kwargs=dict(project_id=project.id, codingjob_id=job.id,
+                                        coded_article_id=coded_article.id))
+        version = 0
+        try:
+            if not client.login(username=job.coder.username, password="test"):
+                raise Exception("Could not log in as {job.coder.username}".format(**locals()))
+            for i in range(nsaves):
+                codings = [{"sentence_id" : sentence.id, "start" : None, "end" : None,
+                            "values" : [{"codingschemafield_id" : intf.id, "strval" : None,
+                                         "intval" : i if j == i % ncodings else j}]}
+                           for (j, sentence) in enumerate(sentences)]
+                data = {"coded_article" : {"status_id" : 1, "comments" : None, "version" : version},
+                        "codings" : codings}
+                response = client.post(url, json.dumps(data), content_type="application/json")
+                if response.status_code != 201:
+                    raise Exception("Save failed: {response.status_code} {response.content}".format(**locals()))
+                version = json.loads(response.content)["version"]
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=code, args=args) for args in jobs]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.time() - start
+    if errors:
+        raise errors[0]
+
+    n = ncoders * nsaves
+    rate = n / duration
+    log.info("{ncoders} coders: {n} saves in {duration:.2f} seconds, {rate:.1f} saves/sec".format(**locals()))
+    return rate
+
+class TestSaveBenchmark(TransactionTestCase):
+    """
+    Run the save benchmark in the test database, which is emptied afterwards. This is a
+    TransactionTestCase, as the coders use their own connections and need committed data.
+    """
+    @amcattest.require_postgres
+    def test_benchmark(self):
+        if amcattest.skip_slow_tests():
+            raise unittest.SkipTest("Skipping slow test")
+        self.assertGreater(benchmark(ncoders=4, nsaves=5), 0)
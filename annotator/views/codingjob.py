@@ -20,6 +20,7 @@ from functools import partial
 
 import json
 import logging
+import time
 from django.core.exceptions import PermissionDenied
 from django.db import transaction, connection
 from django.db.models import sql
@@ -32,9 +33,13 @@ from amcat.models.authorisation import ROLE_PROJECT_ADMIN
 
 
 from amcat.models import CodingJob, Project, Article, CodingValue, Coding, CodedArticle
+from amcat.models.coding.codedarticle import get_field_ids, VersionConflict
 
 log = logging.getLogger(__name__)
 
+# Number of seconds the codingjob data and permission check of a coder are kept in the session
+SESSION_CACHE_TTL = 300
+
 def index(request, project_id, codingjob_id):
     """returns the HTML for the main annotator page"""
     return render(request, "annotator/codingjob.html", {
@@ -43,37 +48,67 @@ def index(request, project_id, codingjob_id):
         'coder' : request.user,
     })
 
+def _get_codingjob_data(request, codingjob_id):
+    """
+    Check whether the user can code in the given codingjob, and return the data needed to save
+    codings: a dict with the 'project_id' and the coding schema 'field_ids' of the codingjob.
+    The result is cached in the session (for SESSION_CACHE_TTL seconds), so saves don't need to
+    query the codingjob, its schemas and the roles of the user every time.
+    """
+    key = "annotator_codingjob_{codingjob_id}".format(**locals())
+    data = request.session.get(key)
+    if data and data["user_id"] == request.user.id and time.time() - data["time"] < SESSION_CACHE_TTL:
+        return data
+
+    codingjob = CodingJob.objects.select_related("project").get(id=codingjob_id)
+    if codingjob.coder_id != request.user.id:
+        # the user is not the assigned coder. Is s/he project admin?
+        if not request.user.get_profile().has_role(ROLE_PROJECT_ADMIN, codingjob.project):
+            raise PermissionDenied("Only {codingjob.coder} or project admins can edit this codingjob.".format(**locals()))
+
+    data = dict(user_id=request.user.id, time=time.time(), project_id=codingjob.project_id,
+                field_ids=list(get_field_ids([codingjob.id])[codingjob.id]))
+    request.session[key] = data
+    return data
+
 @transaction.atomic
 def save(request, project_id, codingjob_id, coded_article_id):
     """
     Big fat warning: we don't do server side validation for the codingvalues. We
     do check if the codingjob and logged in user correspond, but it's the users
     responsibilty to send correct data (we don't care!).
+
+    Only the codings that were changed are written. If the client sends the version of the
+    coded article it started from and the coded article was saved by someone else since,
+    nothing is saved and 409 (Conflict) is returned. The response contains the new version.
     """
-    coded_article = CodedArticle.objects.select_related("project", "codingjob", "article").get(id=coded_article_id)
+    codingjob = _get_codingjob_data(request, int(codingjob_id))
 
     # sanity checks
-    if coded_article.codingjob.project_id != int(project_id):
-        raise PermissionDenied("Given codingjob ({coded_article.codingjob}) does not belong to project ({coded_article.codingjob.project})!".format(**locals()))
-    if coded_article.codingjob_id != int(codingjob_id):
-        raise PermissionDenied("CodedArticle has codingjob_id={coded_article.codingjob_id} but {codingjob_id} given in url!")
-
-    if coded_article.codingjob.coder_id != request.user.id:
-        # the user is not the assigned coder. Is s/he project admin?
-        if not request.user.get_profile().has_role(ROLE_PROJECT_ADMIN, coded_article.codingjob.project):
-            raise PermissionDenied("Only {request.user} or project admins can edit this codingjob.".format(**locals()))
+    if codingjob["project_id"] != int(project_id):
+        raise PermissionDenied("Given codingjob ({codingjob_id}) does not belong to project ({project_id})!".format(**locals()))
+    try:
+        coded_article = CodedArticle.objects.get(id=coded_article_id, codingjob_id=codingjob_id)
+    except CodedArticle.DoesNotExist:
+        raise PermissionDenied("CodedArticle {coded_article_id} does not belong to codingjob {codingjob_id}!".format(**locals()))
 
     try:
         codings = json.loads(request.body)
     except ValueError:
         return HttpResponseBadRequest("Invalid JSON in POST body")
 
-    coded_article.status_id = codings["coded_article"]["status_id"]
-    coded_article.comments = codings["coded_article"]["comments"]
-    coded_article.save()
-    coded_article.replace_codings(codings["codings"])
+    try:
+        version = coded_article.update_status(codings["coded_article"]["status_id"],
+                                              codings["coded_article"]["comments"],
+                                              version=codings["coded_article"].get("version"))
+    except VersionConflict as e:
+        return HttpResponse(json.dumps({"error" : unicode(e), "version" : coded_article.version}),
+                            status=409, content_type="application/json")
+    coded_article.update_codings(codings["codings"], field_ids=set(codingjob["field_ids"]))
 
-    return HttpResponse(status=201)
+    response = HttpResponse(json.dumps({"version" : version}), status=201, content_type="application/json")
+    response["ETag"] = '"{version}"'.format(**locals())
+    return response
 
 def redirect(request, codingjob_id):
     cj = CodingJob.objects.get(id=codingjob_id)
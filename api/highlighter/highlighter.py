@@ -1,11 +1,58 @@
-from django.http import HttpResponse, HttpResponseBadRequest 
-from amcat.models.coding.codingjob import CodingJob 
-from amcat.models.article import Article 
-from django.core.cache import cache 
-import json 
-import snowballstemmer 
-import random 
+"""
+Keyword highlighting for the annotator.
+
+For every sentence of an article a score in [0, 1] is computed for each field of
+a coding schema, based on the keywords of the field and an LDA topic model:
+the topic distribution of each sentence is inferred with a few Gibbs sampling
+iterations, and the score of a field is the probability of its keywords given
+that distribution.
+
+The topic model is read from HIGHLIGHTER_MODEL_DIR once per process. Results are
+cached (for HIGHLIGHTER_CACHE_TIMEOUT seconds) under a hash of the sentences and
+keywords, and can be precomputed for all articles of a coding job when the job is
+created (see HIGHLIGHTER_PRECOMPUTE).
+"""
+
+import bisect
+import hashlib
+import itertools
+import json
+import logging
 import math
+import operator
+import os
+import random
+import threading
+from array import array
+
+import snowballstemmer
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.http import HttpResponse, HttpResponseBadRequest
+
+from amcat.amcatcelery import app
+from amcat.models.amcat import TIMEOUT_INFINITY
+from amcat.models.coding.codingjob import CodingJob
+from amcat.models.sentence import Sentence
+from amcat.tools import toolkit
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MODEL_DIR = "/amcat/jgibblda/models/pol"
+
+# Change when the computation changes, so cached results are not used anymore
+HIGHLIGHTING_VERSION = 1
+
+GIBBS_ITERATIONS = 10
+LAMBDA_INFLUENCE = 0.5
+
+# Maximum number of stemmed words kept in memory
+STEM_CACHE_SIZE = 100000
+
+# Number of articles for which sentences are fetched in one query when precomputing
+PRECOMPUTE_BATCH_SIZE = 100
 
 def articleschema(request):
     return highlight(request, 'articleschema')
@@ -22,324 +69,299 @@ def highlight(request, schematype):
         return HttpResponseBadRequest()
 
     cj = CodingJob.objects.get(pk=codingjob_id)
-    article = Article.objects.get(pk=article_id)
-
-    keywords = []
-
-    # create variable keywords list
     if schematype == "articleschema":
         schema = cj.articleschema
     else:
         schema = cj.unitschema
-    for csf in schema.fields.order_by('id').all():
-        keywords.append(csf.keywords)
-
-    article_matrix = []
-    current_parnr = 0;
-
-    # create matrix article sentences
-    for sentence in article.sentences.all():
-        if sentence.parnr != current_parnr:
-            article_matrix.append([])
-            current_parnr = sentence.parnr
-        article_matrix[-1].append(sentence.sentence)
-
-    # get and respond with highlighting scores
-    hash_value = highlighting_hash(article_matrix, keywords)
-    result = from_cache(article_id, schema.id, hash_value)
-    if result is None:
-        ha = HighlighterArticles()
-        result = ha.getHighlightingsArticle(article_matrix, keywords, None)
-        to_cache(article_id, schema.id, hash_value, result)
+
+    keywords = get_keywords(schema)
+    article_matrix = get_article_matrices([int(article_id)])[int(article_id)]
+    result = get_cached_highlighting(article_matrix, keywords)
     return HttpResponse(json.dumps(result), content_type='application/json')
 
+def get_keywords(schema):
+    """Return the (comma separated) keywords of the fields of the schema, ordered by field id"""
+    return list(schema.fields.order_by('id').values_list("keywords", flat=True))
+
+def get_article_matrices(article_ids):
+    """
+    Return the sentences of the given articles per paragraph
+    @return: a dict of {article_id : [[sentence, ..], ..]}
+    """
+    result = {aid: [] for aid in article_ids}
+    sentences = (Sentence.objects.filter(article__in=article_ids)
+                 .order_by("article", "parnr", "sentnr")
+                 .values_list("article_id", "parnr", "sentence"))
+    for (aid, parnr), paragraph in itertools.groupby(sentences, operator.itemgetter(0, 1)):
+        result[aid].append([sentence for (_aid, _parnr, sentence) in paragraph])
+    return result
+
+def get_cache_key(article_matrix, keywords):
+    """
+    Return the cache key for the highlighting of the given sentences and keywords. As
+    opposed to hash(), the key is the same in every process.
+    """
+    content = json.dumps([HIGHLIGHTING_VERSION, get_model_dir(), article_matrix, keywords])
+    return "highlighting-{}".format(hashlib.sha1(content).hexdigest())
+
+def get_cache_timeout():
+    """
+    Return the number of seconds highlightings are cached (HIGHLIGHTER_CACHE_TIMEOUT).
+    This defaults to (almost) forever, as the keys change when the sentences or keywords do.
+    """
+    return getattr(settings, 'HIGHLIGHTER_CACHE_TIMEOUT', TIMEOUT_INFINITY)
+
+def get_cached_highlighting(article_matrix, keywords):
+    """Return the highlighting of the given sentences and keywords, computing it if it is not cached"""
+    key = get_cache_key(article_matrix, keywords)
+    result = cache.get(key)
+    if result is None:
+        result = get_highlighting(article_matrix, keywords)
+        cache.set(key, result, get_cache_timeout())
+    return result
+
+def precompute_highlighting(codingjob):
+    """
+    Compute and cache the highlighting of all articles in the coding job, for both of its schemas
+    @return: the number of highlightings computed (ie not in the cache yet)
+    """
+    schemas = {codingjob.articleschema_id: codingjob.articleschema,
+               codingjob.unitschema_id: codingjob.unitschema}
+    keywords = [get_keywords(schema) for schema in schemas.values() if schema is not None]
+
+    n = 0
+    article_ids = codingjob.articleset.articles.values_list("id", flat=True)
+    for batch in toolkit.splitlist(list(article_ids), PRECOMPUTE_BATCH_SIZE):
+        matrices = get_article_matrices(batch).values()
+        todo = {get_cache_key(matrix, kw): (matrix, kw)
+                for matrix in matrices for kw in keywords}
+        cached = cache.get_many(todo.keys())
+        cache.set_many({key: get_highlighting(matrix, kw)
+                        for (key, (matrix, kw)) in todo.items() if key not in cached},
+                       get_cache_timeout())
+        n += len(todo) - len(cached)
+    log.info("Precomputed {n} highlightings for codingjob {codingjob.id}".format(**locals()))
+    return n
+
+@app.task(bind=True, max_retries=3)
+def precompute_highlighting_task(self, codingjob_id):
+    try:
+        codingjob = CodingJob.objects.get(pk=codingjob_id)
+    except CodingJob.DoesNotExist as e:
+        # the transaction creating the job might not have been committed yet
+        raise self.retry(exc=e, countdown=10)
+    return precompute_highlighting(codingjob)
+
+@receiver(post_save, sender=CodingJob)
+def schedule_precompute_highlighting(sender, instance=None, created=None, **kwargs):
+    """Precompute the highlighting of a new coding job if HIGHLIGHTER_PRECOMPUTE is set"""
+    if created and getattr(settings, 'HIGHLIGHTER_PRECOMPUTE', False):
+        precompute_highlighting_task.delay(instance.id)
+
+_stemmer = snowballstemmer.stemmer("german")
+_stemmer_lock = threading.Lock()
+_stem_cache = {}
+
+def stem(word):
+    """Stem the word with a stemmer shared by all requests, remembering the results"""
+    try:
+        return _stem_cache[word]
+    except KeyError:
+        pass
+    # stemmer objects keep state while stemming, so they can't be used by two threads at once
+    with _stemmer_lock:
+        result = _stemmer.stemWord(word)
+    if len(_stem_cache) < STEM_CACHE_SIZE:
+        _stem_cache[word] = result
+    return result
+
+class TopicModel(object):
+    """
+    The word index and p(w|z) of a (JGibbLDA) topic model. The probabilities are
+    kept in a single array of doubles, one row of nwords values per topic.
+    """
+    def __init__(self, wordmap, phi):
+        """
+        @param wordmap: file with the number of words on the first line, and a word and its index on the others
+        @param phi: file with a line of space separated probabilities per topic, in word index order
+        """
+        self.index = {}
+        lines = iter(wordmap)
+        next(lines)
+        for line in lines:
+            word, index = line.split()[:2]
+            self.index.setdefault(word.decode("utf-8"), int(index))
+
+        self.phi = array(b'd')
+        self.ntopics = 0
+        for line in phi:
+            self.phi.extend(float(p) for p in line.split())
+            self.ntopics += 1
+        self.nwords = len(self.phi) // self.ntopics if self.ntopics else 0
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "wordmap.txt")) as wordmap:
+            with open(os.path.join(path, "model-final.phi")) as phi:
+                return cls(wordmap, phi)
+
+    def get_word_topics(self, word_index):
+        """Return p(w|z) for all topics z of the word with the given index"""
+        return self.phi[word_index::self.nwords]
+
+_models = {}
+_models_lock = threading.Lock()
+
+def get_model_dir():
+    return getattr(settings, 'HIGHLIGHTER_MODEL_DIR', DEFAULT_MODEL_DIR)
+
+def get_model(path=None):
+    """Return the topic model in the given (or configured) directory, loading it only once"""
+    if path is None:
+        path = get_model_dir()
+    with _models_lock:
+        if path not in _models:
+            log.info("Loading topic model from {path}".format(**locals()))
+            _models[path] = TopicModel.load(path)
+        return _models[path]
+
+def get_highlighting(article, keywords, model=None, iterations=GIBBS_ITERATIONS):
+    """
+    Compute the highlighting scores for the sentences of an article.
+    @param article: the paragraphs of the article, each a list of sentences
+    @param keywords: the comma separated keywords (or None) per variable
+    @return: a list of sentence scores per paragraph. The scores of a sentence are a
+             list of a 0 followed by a score in [0, 1] for each variable
+    """
+    if model is None:
+        model = get_model()
+    K = model.ntopics
+    topics = range(K)
+    alpha = K / 50.0
+    lambda_influence = LAMBDA_INFLUENCE
+
+    # replace words by their index in the topic model, or -1 if they are not in the model
+    def get_index(word):
+        return model.index.get(stem(word), -1)
+    sentences = [[get_index(w.replace(",", "").lower()) for w in sentence.split(" ")]
+                 for paragraph in article for sentence in paragraph]
+    keywords = [[get_index(kw.strip().lower()) for kw in kws.split(",")] if kws else None
+                for kws in keywords]
+
+    used = {w for sentence in sentences for w in sentence}
+    used.update(w for kws in keywords if kws for w in kws)
+    used.discard(-1)
+    pwz = {w: model.get_word_topics(w) for w in used}
+
+    # random initial topic assignment
+    nmk = [0] * K
+    z = []
+    for sentence in sentences:
+        zs = [int(math.floor(random.random() * K)) for w in sentence]
+        for topic in zs:
+            nmk[topic] += 1
+        z.append(zs)
+    nm = sum(nmk)
+
+    # gibbs sampling: every word is resampled given the topics of all other words,
+    # so the number of words during sampling is always nm - 1
+    denominator = (nm - 1) + K * alpha
+    for _i in range(iterations):
+        for sentence, zs in zip(sentences, z):
+            for n, w in enumerate(sentence):
+                if w == -1:
+                    continue
+                nmk[zs[n]] -= 1
+                phi = pwz[w]
+                pword = [phi[topic] * ((nmk[topic] + alpha) / denominator) for topic in topics]
+                psum = sum(pword)
+                cumulative, p = [], 0.0
+                for pw in pword:
+                    p = pw / psum + p
+                    cumulative.append(p)
+                topic = bisect.bisect_right(cumulative, random.random())
+                zs[n] = topic if topic < K else 0
+                nmk[zs[n]] += 1
+
+    # p(z|w) given the final topic assignment, per distinct word
+    denominator = nm + K * alpha
+    ptopic = {}
+    for w in used:
+        phi = pwz[w]
+        pw = [phi[topic] * (nmk[topic] + alpha) / denominator for topic in topics]
+        psum = sum(pw)
+        ptopic[w] = [p / psum for p in pw]
+
+    # lambda * sum of p(w|z) over the keywords, per variable
+    keyword_topics = []
+    for kws in keywords:
+        if kws is None:
+            keyword_topics.append(None)
+            continue
+        kt = [0] * K
+        for w in kws:
+            if w != -1:
+                kt = [t + lambda_influence * p for (t, p) in zip(kt, pwz[w])]
+        keyword_topics.append((kt, lambda_influence / len(kws)))
+
+    scores = []
+    for sentence in sentences:
+        sentence_topics = [0] * K
+        for w in sentence:
+            if w != -1:
+                sentence_topics = map(operator.add, sentence_topics, ptopic[w])
+        sentence_topics = [p / K for p in sentence_topics]
+        scores.append([0 if kt is None else sum(map(operator.mul, kt[0], sentence_topics)) * kt[1]
+                       for kt in keyword_topics])
+
+    # normalise by the maximum score, and restore the paragraph structure
+    maximum = max([0] + [s for sentence in scores for s in sentence])
+    if maximum > 0:
+        scores = [[s / maximum for s in sentence] for sentence in scores]
+    scores = iter(scores)
+    return [[[0] + next(scores) for _sentence in paragraph] for paragraph in article]
+
+###########################################################################
+#                          U N I T   T E S T S                            #
+###########################################################################
+
+from amcat.tools import amcattest
+
+class TestHighlighter(amcattest.AmCATTestCase):
+    # words 0-1 belong to topic 0, words 2-3 to topic 1
+    WORDS = [u"haus", u"garten", u"auto", u"strasse"]
+    PHI = ["0.45 0.45 0.05 0.05\n", "0.05 0.05 0.45 0.45\n"]
+
+    def get_model(self):
+        wordmap = ["4\n"] + ["{} {}\n".format(stem(w).encode("utf-8"), i) for (i, w) in enumerate(self.WORDS)]
+        return TopicModel(wordmap, self.PHI)
+
+    def test_model(self):
+        model = self.get_model()
+        self.assertEqual(model.ntopics, 2)
+        self.assertEqual(model.nwords, 4)
+        self.assertEqual(model.index[stem(u"auto")], 2)
+        self.assertEqual(list(model.get_word_topics(0)), [0.45, 0.05])
+        self.assertEqual(list(model.get_word_topics(3)), [0.05, 0.45])
 
-def highlighting_hash(article_matrix, keywords):
-    return hash(str(article_matrix) + ":" + str(keywords))
-
-
-def from_cache(article_id, schema_id, hash_value):
-    article_cache = cache.get("highlighting-{0}".format(article_id))
-    #print(article_cache)
-    if article_cache is None:
-        return None
-    codingjob_cache = None
-    if schema_id in article_cache:
-        codingjob_cache = article_cache[schema_id]
-    if codingjob_cache is None:
-        return None
-    if not codingjob_cache['hash'] == hash_value:
-        return None
-    return codingjob_cache['value']
-
-def to_cache(article_id, schema_id, hash_value, result):
-    article_cache = cache.get("highlighting-{0}".format(article_id))
-    if article_cache is None:
-        article_cache = {}
-    article_cache[schema_id] = {}
-    article_cache[schema_id]['hash'] = hash_value
-    article_cache[schema_id]['value'] = result
-    cache.set("highlighting-{0}".format(article_id), article_cache)
-    # print(article_cache)
-    article_cache = cache.get("highlighting-{0}".format(article_id))
-    # print(article_cache)
-    cache.close()
-
-
-class HighlighterArticles:
-# input: 
-# article: two-dimensional array of the article: the first dimension corresponds to the paragraph, second corresponds to sentences. 
-# variable_keywords: one-dimenstional array of comma-separated keywords
-# variable_pages: array of the page numbers assigned to the variables (index identical to variable_keywords).
-# output: three-dimensional array: paragraph-sentence-variable, meaning that for every sentence in a paragraph we have scores \in [0,1] giving the highlighting for each variable
-	def getHighlightingsArticle(self, article, variable_keywords, variable_pages):
-		stemmer = snowballstemmer.stemmer("german")
-		word_idx = {}
-		word_count = {}
-	 	words_used = []
-	 	index_used = []
-	 	total_words = 0;
-		for i in range(0, len(article)):
-			for j in range(0, len(article[i])):
-				article[i][j] = article[i][j].split(" ");
-				for k in range(0, len(article[i][j])):
-					# article[i][j][k]=chrtran(article[i][j][k], goodchars, "")
-					article[i][j][k]=article[i][j][k].replace(",","").lower();
-					article[i][j][k]=stemmer.stemWord(article[i][j][k])
-					words_used.append(article[i][j][k])
-					
-		print "Variables:"
-		for i in range(0, len(variable_keywords)):
-			if ((variable_keywords[i] != None) and (variable_keywords[i]!="")):
-				keywords_split = variable_keywords[i].split(",")
-				print "%d" % i
-				print "%s" % variable_keywords[i]
-				# variable_keywords[i]=chrtran(variable_keywords[i], goodchars, "")
-	 			for j in range(0, len(keywords_split)):
-						keywords_split[j]=stemmer.stemWord(keywords_split[j].strip().lower())
-		 				words_used.append(keywords_split[j])
-						variable_keywords[i]=keywords_split
-		 		
-		words_used = set(words_used)		
-		
-		# get word index
-		f = open("/amcat/jgibblda/models/pol/wordmap.txt", "r")
-		first = True
-		line_counter = 0
-		for line in f:	
-			if (line_counter == 0):
-				total_words = int(line)
-			if (line_counter > 0):
-				line_split=line.split(" ")
-				word = line_split[0]
-				count = line_split[1]
-				if (word in words_used):
-					index_used.append(int(count))
-					#word_count[line_counter-1]=count
-					#print word," ",int(count)
-					word_idx[word]=int(count)
-					words_used.remove(word)
-			line_counter+=1
-		set(index_used)
-		
-		for i in range(0, len(article)):
-			for j in range(0, len(article[i])):
-				for k in range(0, len(article[i][j])):
-					if (k in range(0, len(article[i][j]))):
-						if (not article[i][j][k] in word_idx):
-							article[i][j][k]=-1
-		
-		for i in range(0, len(variable_keywords)):
-			if ((variable_keywords[i] != None) and (variable_keywords[i]!="")):
-	 			for j in range(0, len(variable_keywords[i])):
-	 				if (j in range(0, len(variable_keywords[i]))):
-						if (not variable_keywords[i][j] in word_idx):
-							variable_keywords[i][j]=-1
-		# get p(w|z) only for used words in article & keywords
-		pwz = {}
-		f = open("/amcat/jgibblda/models/pol/model-final.phi", "r")
-		# number of topics
-		K = 0
-		line_counter=0;
-		for line in f:
-			line_values = line.split(" ");
-			word_values = [];
-			for j in range(0, len(line_values)):
-				#skip words which do not appear in the keywords
-				if (j in index_used):
-					if (not (j in pwz)):
-						pwz[j]=[]
-					pwz[j].append(float(line_values[j]))
-			K+=1
-			
-		
-		# get p(z|d)
-		#  each sentence is stored in article[i][j]
-		# double[] pp = new double[K];
-		# 		for (int qiter = 0; qiter < niter; qiter++) {
-		# 			for (int m = 0; m < nmkq.length; m++) {
-		# 				for (int n = 0; n < wq[m].length; n++) {
-		# 					// decrement
-		# 					int k = zq[m][n];
-		# 					int t = wq[m][n];
-		# 					nmkq[m][k]--;
-		# 					// compute weights
-		# 					double psum = 0;
-		# 					for (int kk = 0; kk < pp.length; kk++) {
-		# 						pp[kk] = (nmkq[m][kk] + alpha) * phi[kk][t];
-		# 						psum += pp[kk];
-		# 					}
-		# 					// sample
-		# 					double u = rand.nextDouble() * psum;
-		# 					psum = 0;
-		# 					int kk = 0;
-		# 					for (kk = 0; kk < pp.length; kk++) {
-		# 						psum += pp[kk];
-		# 						if (u <= psum) {
-		# 							break;
-		# 						}
-		# 					}
-		# 					// reassign and increment
-		# 					zq[m][n] = kk;
-		# 					try {
-		# 						nmkq[m][kk]++;
-		# 					} catch (Exception e) {	
-		# 						System.out.println(Vectors.print(pp));
-		# 					}
-		# 				} // n
-		# 			} // m
-		# 		} // i
-		qiter = 10
-		nmk = [0]*K
-		nm = 0
-		z = []
-		mu = 1
-		alpha=K/50.0
-		lambda_influence=0.5
-		for i in range(0, len(article)):
-			zi = []
-			for j in range(0, len(article[i])):
-				zij = []
-				for k in range(0, len(article[i][j])):
-					topic_chosen = int(math.floor(random.random()*K))
-					zij.append(topic_chosen)
-					nmk[topic_chosen] += 1
-					nm += 1
-					if (k in range(0, len(article[i][j])) and j in range(0, len(article[i])) and i in range(0, len(article))):
-						if (article[i][j][k]!=-1 and article[i][j][k] in word_idx):
-							#print i," ",j," ",k," ",article[i][j][k]
-							article[i][j][k] = word_idx[article[i][j][k]]
-							#print "index: ",article[i][j][k]
-				zi.append(zij)
-			z.append(zi)
-
-		#for i in range(0, len(article)):
-		#	zi = []
-		#	for j in range(0, len(article[i])):
-		#		zij = []
-		#		for k in range(0, len(article[i][j])):
-		#			print i," ",j," ",k," ",article[i][j][k]
-				
-		for i in range(0, len(variable_keywords)):
-			if ((variable_keywords[i]!=None) and (variable_keywords[i]!="")):
-					for j in range(0, len(variable_keywords[i])):	
-						if (variable_keywords[i][j]!=-1 and variable_keywords[i][j] in word_idx):		
-							variable_keywords[i][j] = word_idx[variable_keywords[i][j]]
-
-		for i in range(0, qiter):
-			#assign new topics
-			#z = [[]] * len(article)
-			for i in range(0, len(article)):
-				#z[i]=[[]]*len(article[i])
-				for j in range(0, len(article[i])):
-					for k in range(0, len(article[i][j])):
-						if (article[i][j][k] != -1):
-							nmk[z[i][j][k]]-=1
-							nm-=1
-							psum=0
-							pword=[0]*K
-							for topic in range(0,K):
-								#print "debug:",i," ",j," ",k," ",topic," ",article[i][j][k]
-								pword[topic] = pwz[article[i][j][k]][topic]
-								pword[topic]*= (nmk[topic]+alpha)/(nm+K*alpha)
-								psum+=pword[topic]
-							for topic in range(0,K):
-								pword[topic]/=psum
-								if(topic>0):
-									pword[topic]+=pword[topic-1]
-												
-							random_p=random.random()
-							z[i][j][k]=0
-							for topic in range(0,K):
-								if random_p < pword[topic]:
-									z[i][j][k]=topic
-									break
-							nmk[z[i][j][k]]+=1
-							nm+=1
-							
-		highlight = [[]]*len(article)
-		sum_p_keywords = [0]*len(variable_keywords)
-		max_p_keywords = 0;
-		for i in range(0, len(article)):
-			highlight[i] = [[0]]*len(article[i])
-			for j in range(0, len(article[i])):
-				ptopic_sentence=[0]*K
-				keyword_found = [0]*len(variable_keywords)
-				for k in range(0, len(article[i][j])):
-					if(article[i][j][k]!=-1):
-						for p in range(0, len(variable_keywords)):
-							if(article[i][j][k] != -1):
-								if (isinstance(article[i][j][k], basestring) and article[i][j][k] in variable_keywords[p]):
-									keyword_found[p]+=1
-						psum=0
-						ptopic=[0]*K
-						for topic in range(0,K):
-							ptopic[topic]=pwz[article[i][j][k]][topic]*(nmk[topic]+alpha)/(nm+K*alpha)
-							psum+=ptopic[topic]
-						for topic in range(0,K):
-							ptopic[topic]/=psum
-							ptopic_sentence[topic]+=ptopic[topic]
-				for topic in range(0,K):
-					ptopic_sentence[topic]/=K
-				p_keywords = [0]*len(variable_keywords)
-				for p in range(0, len(variable_keywords)):
-					if ((variable_keywords[p]!=None) and (variable_keywords[p]!="")):
-						for q in range(0, len(variable_keywords[p])):
-							if (variable_keywords[p][q] != -1):
-								for topic in range(0,K):
-									p_keywords[p]+= lambda_influence * pwz[variable_keywords[p][q]][topic] * ptopic_sentence[topic]
-						if (len(variable_keywords[p])>0):
-							p_keywords[p] *= (lambda_influence / len(variable_keywords[p]))
-						#p_keywords[p]+= (1-lambda_influence) * (1-(len(article[i]) / (len(article[i]) + mu)) * (word_count[variable_keywords[p][q]]/total_words)
-						#(len(article[i]) / (len(article[i]) + mu)) 
-						if (len(article[i][j])>0):
-							p_keywords[p]+= (1-lambda_influence) * keyword_found[p] / len(article[i][j])
-							#print keyword_found
-					sum_p_keywords[p] += p_keywords[p]
-					max_p_keywords = max(max_p_keywords,p_keywords[p])
-				highlight[i][j]=p_keywords
-				
-		for i in range(0, len(article)):
-			for j in range(0, len(article[i])):
-				for p in range(0, len(variable_keywords)):
-					#highlight[i][j][p]/=sum_p_keywords[p]
-					if (max_p_keywords > 0):
-						highlight[i][j][p]/=max_p_keywords
-		for i in range(0, len(article)):
-			for j in range(0, len(article[i])):
-				p_keywords_old = highlight[i][j];
-				p_keywords = [0]*(len(variable_keywords)+1)
-				for p in range(0, len(variable_keywords)):
-					p_keywords[p+1] = p_keywords_old[p]
-				highlight[i][j]=p_keywords
-		return highlight
-	pass	
-
-
-#article=[["eins zwei"],["drei vier funf","sechs sieben acht"]]
-#variable_keywords = ["test,bla,eins","test,vier,eins","vier,acht,bla"]
-#highlighter = HighlighterArticles()
-#variable_pages = []
-#highlighting = highlighter.getHighlightingsArticle(article,variable_keywords,variable_pages)
-#print(highlighting)
+    def test_highlighting(self):
+        model = self.get_model()
+        article = [[u"Das Haus, der Garten", u"Das Auto"], [u"Die Strasse"]]
+        random.seed(1)
+        result = get_highlighting(article, [u"Haus", None, u"Auto, Strasse"], model=model)
+        self.assertEqual([len(p) for p in result], [2, 1])
+        for sentence in itertools.chain(*result):
+            self.assertEqual(len(sentence), 4)
+            self.assertEqual(sentence[:1] + sentence[2:3], [0, 0])
+            for score in sentence:
+                self.assertTrue(0 <= score <= 1)
+        self.assertEqual(max(s for sentence in itertools.chain(*result) for s in sentence), 1)
+        # the house sentence should score higher on the house variable
+        self.assertGreater(result[0][0][1], result[0][1][1])
+        self.assertGreater(result[0][1][3], result[0][0][3])
 
+        # same input, same cache key
+        key = get_cache_key(article, [u"Haus", None])
+        self.assertEqual(key, get_cache_key([[u"Das Haus, der Garten", u"Das Auto"], [u"Die Strasse"]],
+                                            [u"Haus", None]))
+        self.assertNotEqual(key, get_cache_key(article, [u"Auto", None]))
@@ -20,3 +20,6 @@
 """
 Models for api app. Currently here because without it, tests wont run.
 """
+
+# connect the signal receivers of the api modules
+import api.highlighter.highlighter
@@ -1 +1,2 @@
-from api.webscripts.webscript import webscript_task
\ No newline at end of file
+from api.webscripts.webscript import webscript_task
+from api.highlighter.highlighter import precompute_highlighting_task
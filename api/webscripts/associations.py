@@ -27,6 +27,9 @@ import re
 import logging
 import collections
 import datetime
+from array import array
+from itertools import izip, groupby
+from operator import itemgetter
 from django.template.loader import render_to_string
 import json
 from django.http import HttpResponse
@@ -96,33 +99,16 @@ class ShowAssociations(WebScript):
         
         es = amcates.ES()
         for q in queries:
-            for r in es.query_all(query=q.query, **qargs):
+            for r in es.query_iter(query=q.query, **qargs):
                 s = score_func(r.score) if score_func else 1
                 i = interval_func(r.date) if interval_func else None
                 yield i, q, r.id, s
 
     def get_table(self):
-        probs = collections.defaultdict(lambda : collections.defaultdict(dict))
-        for (i, q, id, s) in self.get_probs():
-            probs[i][q.label][id] = s
-
-
-        
-        assocTable = table3.ListTable(colnames=["Interval", "From", "To", "Association"])
-        for i in sorted(probs):
-            for q in probs[i]:
-                sumprob1 = float(sum(probs[i][q].values()))
-                if sumprob1 == 0: continue
-                for q2 in probs[i]:
-                    if q == q2: continue
-                    sumproduct = 0
-                    for id, p1 in probs[i][q].iteritems():
-                        p2 = probs[i][q2].get(id)
-                        if not p2: continue
-                        sumproduct += p1*p2
-                    p = sumproduct / sumprob1
-                    assocTable.addRow(i, q, q2, p)
-        return assocTable
+        matrix = AssociationMatrix()
+        for q, probs in groupby(self.get_probs(), itemgetter(1)):
+            matrix.add_hits(q.label, ((i, id, s) for (i, _q, id, s) in probs))
+        return matrix.get_table()
                 
     def run(self):
         assocTable = self.get_table()
@@ -233,6 +219,134 @@ class Intervals(object):
         d = d + datetime.timedelta(days=-d.weekday())
         return "{d.year}-{d.month:02}-{d.day:02}".format(**locals())
 
-        
+
+class AssociationMatrix(object):
+    """
+    Sparse article-by-query score matrix. Articles, queries and intervals are mapped
+    onto integer indexes, and each article row is a short list of (query, score) pairs.
+    The association between queries q1 and q2 in an interval is sum(s1*s2) / sum(s1)
+    over the articles in that interval, ie the normalised product of the matrix with
+    its transpose, which is computed in a single pass over the nonzero cells.
+    """
+    def __init__(self):
+        self.queries = {} # label : index
+        self.intervals = {} # interval : index
+        self.articles = {} # article id : row index
+        self.bins = array(b'l') # row index : interval index
+        self.rows = [] # row index : [(query index, score), ...]
+
+    def add(self, interval, query, article_id, score):
+        """Set the score for the given article and query (label)"""
+        self.add_hits(query, [(interval, article_id, score)])
+
+    def add_hits(self, query, hits):
+        """
+        Set the scores for the given query (label)
+        @param hits: a sequence of (interval, article id, score) tuples
+        """
+        j = self.queries.setdefault(query, len(self.queries))
+        articles, rows, bins, intervals = self.articles, self.rows, self.bins, self.intervals
+        for interval, article_id, score in hits:
+            n = articles.get(article_id)
+            if n is None:
+                articles[article_id] = len(rows)
+                b = intervals.get(interval)
+                if b is None:
+                    b = intervals[interval] = len(intervals)
+                bins.append(b)
+                rows.append([(j, score)])
+                continue
+            row = rows[n]
+            for k, (q, _s) in enumerate(row):
+                if q == j:
+                    row[k] = (j, score)
+                    break
+            else:
+                row.append((j, score))
+
+    def get_sums(self):
+        """
+        Compute the per-interval sums of scores and of products of scores
+        @return: a dict of interval : (counts, sums, products), where counts and sums are arrays
+                 with the number of hits and sum of scores per query, and products is a flattened
+                 nq x nq array with the sum of score products per query pair
+        """
+        nq = len(self.queries)
+        counts = [array(b'l', [0]) * nq for _i in self.intervals]
+        sums = [array(b'd', [0.]) * nq for _i in self.intervals]
+        products = [array(b'd', [0.]) * (nq * nq) for _i in self.intervals]
+        for b, row in izip(self.bins, self.rows):
+            c, s, p = counts[b], sums[b], products[b]
+            for j, sj in row:
+                c[j] += 1
+                s[j] += sj
+                if not sj: continue
+                offset = j * nq
+                for k, sk in row:
+                    p[offset + k] += sj * sk
+        return {i : (counts[b], sums[b], products[b]) for (i, b) in self.intervals.iteritems()}
+
+    def get_table(self):
+        """
+        @return: a ListTable with a row (interval, from, to, association) for every pair of
+                 queries that both have hits in an interval
+        """
+        nq = len(self.queries)
+        labels = sorted(self.queries, key=self.queries.get)
+        assocTable = table3.ListTable(colnames=["Interval", "From", "To", "Association"])
+        for i, (counts, sums, products) in sorted(self.get_sums().iteritems()):
+            present = [j for j in range(nq) if counts[j]]
+            for j in present:
+                sumprob1 = sums[j]
+                if sumprob1 == 0: continue
+                for k in present:
+                    if j == k: continue
+                    assocTable.addRow(i, labels[j], labels[k], products[j * nq + k] / sumprob1)
+        return assocTable
+
 def _condprob(f):
     return 1 - (.5 ** f)
+
+###########################################################################
+#                          U N I T   T E S T S                            #
+###########################################################################
+
+from amcat.tools import amcattest
+
+class TestAssociationMatrix(amcattest.AmCATTestCase):
+    def test_get_table(self):
+        """Are associations sum(s1*s2)/sum(s1) per interval, as in the nested dict computation?"""
+        m = AssociationMatrix()
+        m.add_hits("a", [("2010", 1, 1.), ("2010", 2, .5), ("2011", 3, 1.)])
+        # a zero score counts as a hit, but adds nothing to the sums
+        m.add_hits("b", [("2010", 1, .5), ("2010", 2, 0.)])
+        m.add_hits("c", [("2010", 2, 1.), ("2011", 3, .5)])
+        # a second query with the same label adds its hits to the first
+        m.add("2010", "c", 1, .25)
+        # a query with only zero scores has no associations from it, only to it
+        m.add("2011", "d", 3, 0.)
+
+        # 2010: a={1:1, 2:.5}, b={1:.5, 2:0}, c={1:.25, 2:1}
+        # 2011: a={3:1}, c={3:.5}, d={3:0} (b has no hits)
+        self.assertEqual([tuple(row) for row in m.get_table()], [
+            ("2010", "a", "b", .5 / 1.5),
+            ("2010", "a", "c", .75 / 1.5),
+            ("2010", "b", "a", .5 / .5),
+            ("2010", "b", "c", .125 / .5),
+            ("2010", "c", "a", .75 / 1.25),
+            ("2010", "c", "b", .125 / 1.25),
+            ("2011", "a", "c", .5 / 1.),
+            ("2011", "a", "d", 0.),
+            ("2011", "c", "a", .5 / .5),
+            ("2011", "c", "d", 0.),
+        ])
+
+    def test_replace_score(self):
+        """Does a later score for the same article and label replace the earlier one?"""
+        m = AssociationMatrix()
+        m.add_hits("a", [(None, 1, 1.), (None, 2, 1.)])
+        m.add_hits("b", [(None, 1, 1.)])
+        m.add_hits("b", [(None, 1, .5), (None, 2, .5)])
+        self.assertEqual([tuple(row) for row in m.get_table()],
+                         [(None, "a", "b", 1. / 2), (None, "b", "a", 1. / 1)])
+        self.assertEqual(list(AssociationMatrix().get_table()), [])
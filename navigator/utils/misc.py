@@ -25,6 +25,8 @@ import logging;
 
 from django.core.cache import cache
 
+from amcat.tools import queryparser
+
 log = logging.getLogger(__name__)
 
 def gen_random(n=8):
@@ -42,6 +44,22 @@ class UUIDLogMiddleware(object):
             log.info("End of request {}".format(request.uuid))
         return response
 
+class QueryStatsMiddleware(object):
+    """
+    Logs the number of queries parsed during a request, the query cache hit
+    rate and the time spent parsing (see amcat.tools.queryparser.get_stats)
+    """
+    def process_request(self, request):
+        queryparser.reset_stats()
+
+    def process_response(self, request, response):
+        stats = queryparser.get_stats()
+        if stats["parses"]:
+            log.info("Parsed {parses} queries for {path} in {ms:.1f}ms, {hits} from cache ({pct:.0f}%)"
+                     .format(path=request.path, ms=stats["parse_time"] * 1000,
+                             pct=stats["hit_rate"] * 100, **stats))
+        return response
+
 def session_pop(session, key, default=None):
     """
     Pops a key from a session object, but does not raise a KeyError when
@@ -18,7 +18,7 @@
 ###########################################################################
 
 from navigator.views.articleset_views import ArticleSetDetailsView
-from amcat.models import Article, ArticleSet, Sentence
+from amcat.models import Article, ArticleSet, ArticleSetChange, Sentence
 from navigator.views.projectview import ProjectViewMixin, HierarchicalViewMixin, BreadCrumbMixin, ProjectFormView, ProjectActionRedirectView
 from django.views.generic.detail import DetailView
 from django import forms
@@ -226,6 +226,8 @@ def handle_split(form, project, article, sentences):
         ArticleSet.articles.through(articleset=aset, article=art) for
             art in articles for aset in form_data["add_splitted_to_sets"]
     ])
+    for aset in form_data["add_splitted_to_sets"]:
+        ArticleSetChange.record(aset, [art.id for art in articles])
 
     # Collect changed sets
     for field in ("add_splitted_to_sets", "remove_from_sets", "add_to_sets"):
@@ -239,6 +241,8 @@ def handle_split(form, project, article, sentences):
             ArticleSet.articles.through(articleset=asetart.articleset, article=art)
                 for art in articles for asetart in articlesetarts
         ])
+        for asetart in articlesetarts:
+            ArticleSetChange.record(asetart.articleset, [art.id for art in articles])
 
         dirty_sets |= project.all_articlesets().filter(articles=article).only("id")
 
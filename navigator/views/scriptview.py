@@ -23,7 +23,7 @@ from django.views.generic.base import TemplateResponseMixin
 from django.forms.widgets import HiddenInput
 
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 from django import forms
 
 from navigator.utils.auth import check
@@ -83,7 +83,6 @@ class TableExportMixin():
         table = self.get_script().run_script(form)
         exporter = table3.EXPORTERS[form.cleaned_data["format"]]
         filename = "{fn}.{exporter.extension}".format(fn=self.export_filename(form), **locals())
-        response = HttpResponse(content_type='text/csv', status=200)
+        response = StreamingHttpResponse(exporter.export_chunks(table), content_type='text/csv', status=200)
         response['Content-Disposition'] = 'attachment; filename="{filename}"'.format(**locals())
-        exporter.export(table, stream = response)
         return response
@@ -124,6 +124,7 @@ MIDDLEWARE_CLASSES = [
     'navigator.utils.auth.RequireLoginMiddleware',
     'navigator.utils.auth.SetRequestContextMiddleware',
     'navigator.utils.auth.NginxRequestMethodFixMiddleware',
+    'navigator.utils.misc.QueryStatsMiddleware',
     #'navigator.utils.misc.UUIDLogMiddleware',
     #'debug_toolbar.middleware.DebugToolbarMiddleware',
 ]